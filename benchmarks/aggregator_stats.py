@@ -0,0 +1,104 @@
+"""
+Compare the speed of the tables of `StatsAggregator.stats` to `calc_stats`
+over the same games, and check that both give the same tables.
+
+Games are random matches among `--bots` bots on `--maps` maps.
+The previous win times table, filled pair by pair with `.loc`,
+is timed as well.
+
+Run from the repository root:
+
+    python -m benchmarks.aggregator_stats
+"""
+import argparse
+import time
+
+import numpy as np
+import pandas as pd
+from pandas.testing import assert_frame_equal, assert_series_equal
+
+from scbw_mq.tournament.benchmark.aggregator import StatsAggregator
+from scbw_mq.tournament.benchmark.stats import RACES, RESULT_COLUMNS, calc_stats
+
+NAMES = ["rr_winrate", "overall_winrate", "gametimes", "race_wintimes",
+         "botrace_winrate", "maps", "bot_races", "elos"]
+
+
+def synthetic_results(n_games: int, n_bots: int, n_maps: int, seed: int) -> pd.DataFrame:
+    rng = np.random.RandomState(seed)
+    winners = rng.randint(n_bots, size=n_games)
+    # shift, so that a bot never plays itself
+    losers = (winners + rng.randint(1, n_bots, size=n_games)) % n_bots
+    bots = np.array([f"bot{i}" for i in range(n_bots)])
+    races = np.array(list(RACES.values()))
+    return pd.DataFrame({"game_name": [f"GAME_{i:08d}" for i in range(n_games)],
+                         "map": np.array([f"map{i}" for i in range(n_maps)])[
+                             rng.randint(n_maps, size=n_games)],
+                         "winner": bots[winners],
+                         "winner_race": races[winners % len(races)],
+                         "loser": bots[losers],
+                         "loser_race": races[losers % len(races)],
+                         "game_time": rng.uniform(60, 3600, size=n_games)},
+                        columns=RESULT_COLUMNS).set_index("game_name")
+
+
+def loc_wintimes(aggregator: StatsAggregator) -> pd.DataFrame:
+    # the previous implementation
+    bots = sorted(aggregator.bots)
+    df_wintimes = pd.DataFrame(0., index=bots, columns=bots)
+    for (winner, loser), count in aggregator.wins.items():
+        df_wintimes.loc[winner, loser] = count
+    return df_wintimes
+
+
+def same_table(name: str, expected, actual) -> bool:
+    if name == "gametimes":
+        actual = actual.astype({"bot": object, "race": object})
+    if name in ("overall_winrate", "elos"):
+        # ties and bots are in no particular order
+        expected, actual = expected.sort_index(), actual.sort_index()
+    try:
+        if isinstance(expected, pd.DataFrame):
+            assert_frame_equal(expected, actual, check_dtype=False, check_names=False)
+        else:
+            assert_series_equal(expected, actual, check_dtype=False, check_names=False)
+    except AssertionError as e:
+        print(f"{name} differs: {e}")
+        return False
+    return True
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('--games', type=int, default=200000)
+    parser.add_argument('--bots', type=int, default=300)
+    parser.add_argument('--maps', type=int, default=20)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    df = synthetic_results(args.games, args.bots, args.maps, args.seed)
+    aggregator = StatsAggregator()
+    aggregator.add_frame(df)
+
+    start = time.perf_counter()
+    loc_wintimes(aggregator)
+    loc_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    aggregated = aggregator.stats()
+    aggregator_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    expected = calc_stats(df, None)
+    calc_time = time.perf_counter() - start
+
+    identical = all([same_table(name, e, a) for name, e, a in zip(NAMES, expected, aggregated)])
+    print(f"identical to calc_stats on {args.games} games: {identical}")
+    print(f"loc win times    {loc_time:8.2f}s")
+    print(f"aggregator stats {aggregator_time:8.2f}s")
+    print(f"calc_stats       {calc_time:8.2f}s")
+
+
+if __name__ == '__main__':
+    main()
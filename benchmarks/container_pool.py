@@ -0,0 +1,128 @@
+"""
+Measure the startup latency of jobs run in fresh containers, `docker run`,
+and in pre-started containers of a pool, `docker exec`.
+
+Docker is replaced by a fake docker CLI, which takes --startup seconds
+to start a container, as Wine and X do in the real images, and --job seconds
+to run a job. Jobs run one after another, as in one worker. The latency
+of a job is the time it takes beyond the job itself.
+
+Run from the repository root:
+
+    python -m benchmarks.container_pool
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from typing import List
+
+from scbw_mq.container_pool import ContainerPool
+
+# Fake docker CLI: containers are files in the state dir.
+FAKE_DOCKER = """#!{python}
+import os, sys, time
+
+state = os.environ["FAKE_DOCKER_STATE"]
+startup = float(os.environ["FAKE_DOCKER_STARTUP"])
+job = float(os.environ["FAKE_DOCKER_JOB"])
+command, args = sys.argv[1], sys.argv[2:]
+
+if command == "run":
+    name = args[args.index("--name") + 1]
+    if os.path.exists(os.path.join(state, name)):
+        sys.exit("Conflict, container name is already in use")
+    open(os.path.join(state, name), "w").close()
+    time.sleep(startup)
+    if "-d" not in args:
+        time.sleep(job)
+        os.remove(os.path.join(state, name))
+
+elif command == "exec":
+    while args[0] == "-e":
+        args = args[2:]
+    if not os.path.exists(os.path.join(state, args[0])):
+        sys.exit("No such container: " + args[0])
+    if args[1] != "test":
+        time.sleep(job)
+
+elif command == "rm":
+    for name in args:
+        if os.path.exists(os.path.join(state, name)):
+            os.remove(os.path.join(state, name))
+"""
+
+
+def write_fake_docker(directory: str) -> str:
+    path = os.path.join(directory, "docker")
+    with open(path, "w") as f:
+        f.write(FAKE_DOCKER.format(python=sys.executable))
+    os.chmod(path, 0o755)
+    return path
+
+
+def run_cold(docker: str, jobs: int) -> List[float]:
+    times = []
+    for i in range(jobs):
+        start = time.perf_counter()
+        subprocess.run([docker, "run", "--name", f"COLD_{i}", "image", "job"], check=True)
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def run_pooled(docker: str, jobs: int, size: int, max_jobs: int,
+               warmup: float) -> List[float]:
+    times = []
+    with ContainerPool("POOL", ["image", "--idle"], size=size, max_jobs=max_jobs,
+                       ready_cmd=["test", "-e", "ready"], docker=docker) as pool:
+        # workers start their pools before they take the first job
+        time.sleep(warmup)
+        for _ in range(jobs):
+            start = time.perf_counter()
+            container = pool.acquire()
+            ret_code = subprocess.run(pool.exec_cmd(container, ["job"],
+                                                    env={"GUI_STARTED": "1"})).returncode
+            pool.release(container, healthy=ret_code == 0)
+            times.append(time.perf_counter() - start)
+    return times
+
+
+def report(name: str, times: List[float], job: float):
+    latencies = sorted((t - job) * 1000 for t in times)
+    p95 = latencies[min(len(latencies) - 1, int(0.95 * len(latencies)))]
+    print(f"{name:>10} {statistics.mean(latencies):>10.1f} {statistics.median(latencies):>10.1f} "
+          f"{p95:>10.1f} {max(latencies):>10.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('--jobs', type=int, default=30)
+    parser.add_argument('--startup', type=float, default=1.5,
+                        help="Seconds to start a container.")
+    parser.add_argument('--job', type=float, default=0.5,
+                        help="Seconds to run a job.")
+    parser.add_argument('--pool_size', type=int, default=2)
+    parser.add_argument('--max_jobs', type=int, default=5,
+                        help="Recycle pooled containers after this many jobs.")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        os.environ.update(FAKE_DOCKER_STATE=tmp,
+                          FAKE_DOCKER_STARTUP=str(args.startup),
+                          FAKE_DOCKER_JOB=str(args.job))
+        docker = write_fake_docker(tmp)
+
+        print(f"{args.jobs} jobs of {args.job}s, containers start in {args.startup}s, "
+              f"pool of {args.pool_size} recycled after {args.max_jobs} jobs")
+        print(f"{'latency':>10} {'mean ms':>10} {'median ms':>10} {'p95 ms':>10} {'max ms':>10}")
+        report("run", run_cold(docker, args.jobs), args.job)
+        report("pool", run_pooled(docker, args.jobs, args.pool_size, args.max_jobs,
+                                  args.startup + 0.5), args.job)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+"""
+Simulate a tournament published in random order and longest first,
+by durations predicted from an earlier tournament of the same bots.
+
+Each pair of bots has a typical game time on each map, drawn from a log-normal
+distribution. The earlier tournament and the simulated one both play around
+those times with --noise. A --new_bots fraction of bots didn't play
+in the earlier tournament, their games are not predicted.
+
+Workers take games from the queue in order, the makespan is the time
+until the last game is finished. It is reported both as predicted from
+the earlier games and as actually played.
+
+Run from the repository root:
+
+    python -m benchmarks.duration_order
+"""
+import argparse
+import random
+from typing import Dict, Tuple
+
+from scbw_mq.tournament.durations import DurationModel, pair_key, predict_makespan
+from scbw_mq.tournament.schedule import AllVsAllSchedule, LongestFirstSchedule
+
+
+def typical_times(bots, maps, mean: float, sigma: float,
+                  rng: random.Random) -> Dict[Tuple, float]:
+    return {(pair_key((a, b)), map_name): rng.lognormvariate(0, sigma) * mean
+            for i, a in enumerate(bots) for b in bots[i + 1:] for map_name in maps}
+
+
+def play(typical: float, noise: float, rng: random.Random) -> float:
+    return typical * rng.lognormvariate(0, noise)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('--bots', type=int, default=30)
+    parser.add_argument('--maps', type=int, default=3)
+    parser.add_argument('--repeat_games', type=int, default=1)
+    parser.add_argument('--history_games', type=int, default=2,
+                        help="Games of each pair and map in the earlier tournament.")
+    parser.add_argument('--new_bots', type=float, default=0.1,
+                        help="Fraction of bots without earlier games.")
+    parser.add_argument('--workers', type=int, nargs='+', default=[4, 16, 64])
+    parser.add_argument('--mean_duration', type=float, default=600.,
+                        help="Median game duration in seconds.")
+    parser.add_argument('--sigma', type=float, default=0.6,
+                        help="Spread of the typical game times of pairs and maps.")
+    parser.add_argument('--noise', type=float, default=0.3,
+                        help="Spread of game times around the typical time.")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    bots = [f"bot{i}" for i in range(args.bots)]
+    maps = [f"map{i}" for i in range(args.maps)]
+    new_bots = set(rng.sample(bots, int(args.new_bots * len(bots))))
+    typical = typical_times(bots, maps, args.mean_duration, args.sigma, rng)
+
+    model = DurationModel()
+    for (pair, map_name), typical_time in typical.items():
+        if new_bots.isdisjoint(pair):
+            for _ in range(args.history_games):
+                model.add(pair, map_name, play(typical_time, args.noise, rng))
+
+    schedule = AllVsAllSchedule(bots, maps, args.repeat_games, args.seed)
+    actual = {game.game_name: play(typical[pair_key(game.bots), game.map], args.noise, rng)
+              for game in schedule.games()}
+    ordered = LongestFirstSchedule(
+        schedule, lambda game: model.predict(game.bots, game.map) or model.mean)
+
+    orders = (
+        ("random", ordered.durations, schedule),
+        ("longest", list(ordered.predicted_durations()), ordered),
+    )
+    print(f"{len(schedule)} games of {args.bots} bots, {len(new_bots)} new, "
+          f"{sum(actual.values()) / 3600:.1f} hours of play")
+    print(f"{'workers':>7} {'order':>8} {'predicted h':>12} {'actual h':>9} {'vs bound':>9}")
+    for workers in args.workers:
+        bound = max(sum(actual.values()) / workers, max(actual.values()))
+        for name, predicted_durations, order in orders:
+            predicted = predict_makespan(predicted_durations, workers)
+            makespan = predict_makespan((actual[game.game_name] for game in order.games()),
+                                        workers)
+            print(f"{workers:>7} {name:>8} {predicted / 3600:>12.2f} {makespan / 3600:>9.2f} "
+                  f"{makespan / bound:>9.3f}")
+
+
+if __name__ == '__main__':
+    main()
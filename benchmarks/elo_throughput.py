@@ -0,0 +1,96 @@
+"""
+Compare the speed of rating games with the array Elo engine
+to the previous walk over DataFrame rows with `iloc`.
+
+Games are random matches among `--bots` bots. The previous way is timed
+on the first `--baseline_games` games only, as it takes too long for all of them,
+and both ways must give identical ratings on those games.
+If the `elo` package is installed, it is checked as well.
+
+Run from the repository root:
+
+    python -m benchmarks.elo_throughput
+"""
+import argparse
+import time
+
+import numpy as np
+import pandas as pd
+
+from scbw_mq.tournament.benchmark.elo_engine import BETA, INITIAL, K_FACTOR
+from scbw_mq.tournament.benchmark.elo_engine import calc_elo, rate_1vs1
+
+
+def synthetic_results(n_games: int, n_bots: int, seed: int) -> pd.DataFrame:
+    rng = np.random.RandomState(seed)
+    winners = rng.randint(n_bots, size=n_games)
+    # shift, so that a bot never plays itself
+    losers = (winners + rng.randint(1, n_bots, size=n_games)) % n_bots
+    bots = np.array([f"bot{i}" for i in range(n_bots)])
+    return pd.DataFrame({"winner": bots[winners], "loser": bots[losers]})
+
+
+def iloc_elo(ratings, df_game_results: pd.DataFrame) -> pd.Series:
+    # the previous implementation, with the rating formula inlined
+    ratings = dict(ratings)
+    for i in np.arange(len(df_game_results)):
+        winner = df_game_results.iloc[i]['winner']
+        loser = df_game_results.iloc[i]['loser']
+        ratings[winner], ratings[loser] = rate_1vs1(ratings[winner], ratings[loser])
+    return pd.Series(ratings, name="elo")
+
+
+def package_elo(ratings, df_game_results: pd.DataFrame):
+    try:
+        import elo
+    except ImportError:
+        return None
+
+    elo_calc = elo.Elo(k_factor=K_FACTOR, beta=BETA, rating_class=elo.Rating)
+    ratings = {bot: elo.Rating(value=value) for bot, value in ratings.items()}
+    for winner, loser in zip(df_game_results['winner'], df_game_results['loser']):
+        ratings[winner], ratings[loser] = elo_calc.rate_1vs1(ratings[winner], ratings[loser])
+    return pd.Series({bot: rating.value for bot, rating in ratings.items()}, name="elo")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('--games', type=int, default=1000000)
+    parser.add_argument('--bots', type=int, default=100)
+    parser.add_argument('--baseline_games', type=int, default=20000)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    df = synthetic_results(args.games, args.bots, args.seed)
+    initial = {bot: INITIAL for bot in sorted(set(df['winner']) | set(df['loser']))}
+    df_baseline = df.iloc[:args.baseline_games]
+
+    start = time.perf_counter()
+    ser_iloc = iloc_elo(initial, df_baseline)
+    iloc_time = time.perf_counter() - start
+
+    ser_engine = calc_elo(initial, df_baseline)
+    identical = (ser_iloc.reindex(ser_engine.index).values == ser_engine.values).all()
+    print(f"identical to iloc on {len(df_baseline)} games: {identical}")
+
+    ser_package = package_elo(initial, df_baseline)
+    if ser_package is not None:
+        identical = (ser_package.reindex(ser_engine.index).values == ser_engine.values).all()
+        print(f"identical to elo package on {len(df_baseline)} games: {identical}")
+
+    start = time.perf_counter()
+    calc_elo(initial, df)
+    engine_time = time.perf_counter() - start
+
+    iloc_rate = len(df_baseline) / iloc_time
+    engine_rate = len(df) / engine_time
+    print(f"iloc rows      {iloc_rate:12.0f} games/s "
+          f"(~{args.games / iloc_rate:.0f}s for {args.games} games)")
+    print(f"array engine   {engine_rate:12.0f} games/s "
+          f"({engine_time:.2f}s for {args.games} games)")
+    print(f"speedup        {engine_rate / iloc_rate:12.1f}x")
+
+
+if __name__ == '__main__':
+    main()
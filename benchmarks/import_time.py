@@ -0,0 +1,189 @@
+"""
+Measure how long it takes to start each console entry point of setup.py,
+and guard that none of them loads the analytics stack at startup.
+
+Every entry point is imported in a fresh interpreter with `-X importtime`,
+which reports the cumulative import time of each module. The peak RSS
+of the interpreter afterwards is what every forked worker starts with.
+
+The script fails if an entry point takes longer than --max_ms to import,
+or if a module of this package imports one of the --forbidden modules
+at startup. Heavy modules are allowed only once a command, e.g. the benchmark,
+actually needs them. Forbidden modules imported by dependencies are reported,
+but don't fail the check.
+
+Run from the repository root:
+
+    python -m benchmarks.import_time
+"""
+import argparse
+import ast
+import re
+import subprocess
+import sys
+from typing import Dict, List, Optional, Tuple
+
+PACKAGE = "scbw_mq"
+
+FORBIDDEN = "pandas,numpy,matplotlib,tqdm,requests,elo"
+
+IMPORT_TIME_LINE = re.compile(r"import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)")
+
+# Imports the entry point and prints the peak RSS in kB.
+PROBE = """
+import importlib, resource
+getattr(importlib.import_module({module!r}), {function!r})
+print(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+"""
+
+
+def literal(node):
+    try:
+        return ast.literal_eval(node)
+    except ValueError:
+        return None
+
+
+def read_entry_points(setup_file: str) -> List[Tuple[str, str, str]]:
+    """
+    :returns: name, module and function of each console script
+    """
+    with open(setup_file, "r") as f:
+        tree = ast.parse(f.read())
+
+    scripts = None
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Dict):
+            for key, value in zip(node.keys, node.values):
+                if key is not None and literal(key) == 'console_scripts':
+                    scripts = ast.literal_eval(value)
+    if scripts is None:
+        raise ValueError(f"No console_scripts found in {setup_file}")
+
+    entry_points = []
+    for script in scripts:
+        name, target = (part.strip() for part in script.split("="))
+        module, function = target.split(":")
+        entry_points.append((name, module, function))
+    return entry_points
+
+
+def parse_import_times(stderr: str) -> Tuple[Dict[str, int], Dict[str, Optional[str]]]:
+    """
+    :returns: cumulative import time of each module in microseconds,
+              and the module that first imported it
+    """
+    lines = []
+    for line in stderr.splitlines():
+        match = IMPORT_TIME_LINE.match(line)
+        if match:
+            depth = (len(match.group(3)) - 1) // 2
+            lines.append((match.group(4), int(match.group(2)), depth))
+
+    # modules are listed after the modules they import, with deeper indentation
+    times, importers = {}, {}
+    stack: List[Tuple[int, str]] = []
+    for module, cumulative, depth in reversed(lines):
+        while stack and stack[-1][0] >= depth:
+            stack.pop()
+        times[module] = cumulative
+        importers[module] = stack[-1][1] if stack else None
+        stack.append((depth, module))
+    return times, importers
+
+
+def blame(module: str, importers: Dict[str, Optional[str]], forbidden: List[str]) -> Optional[str]:
+    """
+    :returns: the closest importer of the module that isn't forbidden itself
+    """
+    importer = importers.get(module)
+    while importer is not None and importer.split(".")[0] in forbidden:
+        importer = importers.get(importer)
+    return importer
+
+
+def top_level_time(stderr: str) -> int:
+    # modules imported directly by the probe are not indented,
+    # their cumulative times add up to the whole startup
+    total = 0
+    for line in stderr.splitlines():
+        match = IMPORT_TIME_LINE.match(line)
+        if match and len(match.group(3)) == 1:
+            total += int(match.group(2))
+    return total
+
+
+def measure(module: str, function: str, runs: int):
+    """
+    :returns: best import time in ms, peak RSS in MB,
+              module import times and importers of that run
+    """
+    best = None
+    for _ in range(runs):
+        proc = subprocess.run([sys.executable, "-X", "importtime", "-c",
+                               PROBE.format(module=module, function=function)],
+                              stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                              universal_newlines=True)
+        if proc.returncode != 0:
+            raise RuntimeError(proc.stderr.strip().splitlines()[-1])
+
+        total_ms = top_level_time(proc.stderr) / 1000
+        if best is None or total_ms < best[0]:
+            best = (total_ms, int(proc.stdout.split()[-1]) / 1024,
+                    *parse_import_times(proc.stderr))
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('--setup_file', type=str, default="setup.py")
+    parser.add_argument('--runs', type=int, default=5,
+                        help="Import each entry point this many times, the best run is reported.")
+    parser.add_argument('--max_ms', type=float, default=1500.,
+                        help="Fail if an entry point takes longer to import.")
+    parser.add_argument('--forbidden', type=str, default=FORBIDDEN,
+                        help="Comma separated modules that no entry point\n"
+                             "may import at startup.")
+    parser.add_argument('--top', type=int, default=5,
+                        help="Show this many slowest imports of each entry point.")
+    args = parser.parse_args()
+
+    forbidden = args.forbidden.split(",")
+    failures = []
+    print(f"{'entry point':40} {'import ms':>10} {'RSS MB':>8}")
+    for name, module, function in read_entry_points(args.setup_file):
+        try:
+            total_ms, rss_mb, times, importers = measure(module, function, args.runs)
+        except RuntimeError as e:
+            print(f"{name:40} cannot be imported: {e}")
+            failures.append(name)
+            continue
+
+        print(f"{name:40} {total_ms:10.1f} {rss_mb:8.1f}")
+        slowest = sorted(((t, m) for m, t in times.items() if "." not in m), reverse=True)
+        for t, m in slowest[:args.top]:
+            print(f"    {m:36} {t / 1000:10.1f}")
+
+        for m in forbidden:
+            if m not in times:
+                continue
+            importer = blame(m, importers, forbidden)
+            if importer is not None and importer.split(".")[0] == PACKAGE:
+                print(f"    imports {m} at startup from {importer}")
+                failures.append(name)
+            else:
+                # dependencies, e.g. scbw, are not under our control
+                print(f"    imports {m} at startup through {importer}")
+        if total_ms > args.max_ms:
+            print(f"    takes more than {args.max_ms:.0f} ms to import")
+            failures.append(name)
+
+    if failures:
+        print(f"FAILED: {', '.join(sorted(set(failures)))}")
+        sys.exit(1)
+    print("OK")
+
+
+if __name__ == '__main__':
+    main()
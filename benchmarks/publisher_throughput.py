@@ -0,0 +1,146 @@
+"""
+Measure publishing throughput of ConfirmPublisher for different in-flight windows.
+
+The broker is replaced by a local stand-in that confirms messages
+after a simulated round-trip latency, optionally nacking a fraction of them.
+
+Run from the repository root:
+
+    python -m benchmarks.publisher_throughput
+"""
+import argparse
+import heapq
+import itertools
+import json
+import logging
+import random
+import time
+
+from pika.frame import Method
+from pika.spec import Basic
+
+from scbw_mq.rabbitmq_publisher import ConfirmPublisher
+
+
+class LocalIOLoop(object):
+    def __init__(self):
+        self._timers = []
+        self._counter = itertools.count()
+        self._running = False
+
+    def add_timeout(self, deadline, callback_method):
+        heapq.heappush(self._timers,
+                       (time.time() + deadline, next(self._counter), callback_method))
+
+    def start(self):
+        self._running = True
+        while self._running and self._timers:
+            when, _, callback = heapq.heappop(self._timers)
+            delay = when - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            callback()
+
+    def stop(self):
+        self._running = False
+
+
+class LocalBrokerChannel(object):
+    def __init__(self, connection, latency: float, nack_rate: float):
+        self.connection = connection
+        self.latency = latency
+        self.nack_rate = nack_rate
+        self._confirm_callback = None
+        self._delivery_tag = 0
+        self._flush_scheduled = False
+        self._unconfirmed = []
+        self.published = 0
+
+    def add_on_close_callback(self, callback):
+        pass
+
+    def confirm_delivery(self, callback):
+        self._confirm_callback = callback
+
+    def basic_publish(self, exchange, routing_key, body, properties=None):
+        self._delivery_tag += 1
+        self._unconfirmed.append(self._delivery_tag)
+        self.published += 1
+
+        # the broker confirms everything received within one round trip at once
+        if not self._flush_scheduled:
+            self._flush_scheduled = True
+            self.connection.ioloop.add_timeout(self.latency, self.flush)
+
+    def flush(self):
+        self._flush_scheduled = False
+        tags, self._unconfirmed = self._unconfirmed, []
+        acked = []
+        for tag in tags:
+            if random.random() < self.nack_rate:
+                self.confirm(acked)
+                acked = []
+                self._confirm_callback(Method(1, Basic.Nack(delivery_tag=tag)))
+            else:
+                acked.append(tag)
+        self.confirm(acked)
+
+    def confirm(self, tags):
+        if tags:
+            self._confirm_callback(Method(1, Basic.Ack(delivery_tag=tags[-1], multiple=True)))
+
+
+class LocalBrokerConnection(object):
+    def __init__(self, publisher, latency: float, nack_rate: float):
+        self.ioloop = LocalIOLoop()
+        self.channel_impl = LocalBrokerChannel(self, latency, nack_rate)
+        self.ioloop.add_timeout(0, lambda: publisher.on_connection_open(self))
+
+    def channel(self, on_open_callback):
+        self.ioloop.add_timeout(0, lambda: on_open_callback(self.channel_impl))
+
+    def close(self):
+        self.ioloop.stop()
+
+
+class LocalBrokerPublisher(ConfirmPublisher):
+    def __init__(self, latency: float, nack_rate: float, **kwargs):
+        super(LocalBrokerPublisher, self).__init__(None, **kwargs)
+        self.latency = latency
+        self.nack_rate = nack_rate
+
+    def connect(self):
+        return LocalBrokerConnection(self, self.latency, self.nack_rate)
+
+
+def messages(n: int):
+    for i in range(n):
+        # same shape as PlayMessage.serialize()
+        yield json.dumps(dict(bots=["BotA", "BotB"], map="sscai/(2)Benzene.scx",
+                              game_name="%06d" % i))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('--messages', type=int, default=20000)
+    parser.add_argument('--windows', type=int, nargs='+', default=[1, 16, 256, 1024])
+    parser.add_argument('--latency', type=float, default=0.0005,
+                        help="Simulated broker round-trip time in seconds.")
+    parser.add_argument('--nack_rate', type=float, default=0.001)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+
+    print(f"{'window':>8} {'msg/s':>12} {'retried':>8} {'seconds':>8}")
+    for window in args.windows:
+        publisher = LocalBrokerPublisher(args.latency, args.nack_rate,
+                                         window=window, batch_size=args.messages)
+        start = time.time()
+        confirmed = publisher.publish(messages(args.messages))
+        elapsed = time.time() - start
+        print(f"{window:>8} {confirmed / elapsed:>12.0f} {publisher.retried:>8} {elapsed:>8.2f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,118 @@
+"""
+Simulate a read_overwrite tournament played from the random order of games
+and from rounds of games that share no bot.
+
+Workers take games from the queue in order. A game whose bot is already
+playing is put to the delay queue and comes back to the end of the queue
+after --requeue_delay seconds, the same way consumers requeue it.
+Both orders play the same games with the same durations.
+
+The lower bound of the makespan is the larger of the total play time divided
+by the number of workers, and the total play time of the busiest bot.
+
+Run from the repository root:
+
+    python -m benchmarks.round_makespan
+"""
+import argparse
+import heapq
+import random
+from collections import deque
+from typing import Dict, List
+
+from scbw_mq.tournament.schedule import AllVsAllSchedule, RoundRobinSchedule, Schedule
+
+
+def game_durations(schedule: Schedule, mean: float, sigma: float, seed: int) -> Dict[str, float]:
+    rng = random.Random(seed)
+    return {game.game_name: rng.lognormvariate(0, sigma) * mean for game in schedule.games()}
+
+
+def simulate(schedule: Schedule, durations: Dict[str, float], workers: int,
+             requeue_delay: float):
+    """
+    :returns: makespan, number of requeued games, fraction of idle worker time
+    """
+    queue = deque(schedule.games())
+    busy_bots = set()
+    # (time, kind, payload), kind 0 ends a game, kind 1 brings back a delayed game
+    events: List = []
+    free_workers = workers
+    now = 0.
+    requeued = 0
+    busy_time = 0.
+    seq = 0
+
+    while queue or events:
+        # idle workers take games until they find a playable one
+        while free_workers and queue:
+            game = queue.popleft()
+            if busy_bots.intersection(game.bots):
+                requeued += 1
+                seq += 1
+                heapq.heappush(events, (now + requeue_delay, 1, seq, game))
+                continue
+
+            busy_bots.update(game.bots)
+            free_workers -= 1
+            duration = durations[game.game_name]
+            busy_time += duration
+            seq += 1
+            heapq.heappush(events, (now + duration, 0, seq, game))
+
+        if not events:
+            break
+        now, kind, _, game = heapq.heappop(events)
+        if kind == 0:
+            busy_bots.difference_update(game.bots)
+            free_workers += 1
+        else:
+            queue.append(game)
+
+    return now, requeued, 1 - busy_time / (now * workers)
+
+
+def lower_bound(schedule: Schedule, durations: Dict[str, float], workers: int) -> float:
+    per_bot: Dict[str, float] = {}
+    for game in schedule.games():
+        for bot in game.bots:
+            per_bot[bot] = per_bot.get(bot, 0.) + durations[game.game_name]
+    return max(sum(durations.values()) / workers, max(per_bot.values()))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('--bots', type=int, default=30)
+    parser.add_argument('--maps', type=int, default=3)
+    parser.add_argument('--repeat_games', type=int, default=1)
+    parser.add_argument('--workers', type=int, nargs='+', default=[4, 8, 15])
+    parser.add_argument('--requeue_delay', type=float, default=30.)
+    parser.add_argument('--mean_duration', type=float, default=600.,
+                        help="Median game duration in seconds.")
+    parser.add_argument('--sigma', type=float, default=0.5,
+                        help="Spread of the log-normal game durations.")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    bots = [f"bot{i}" for i in range(args.bots)]
+    maps = [f"map{i}" for i in range(args.maps)]
+    random_order = AllVsAllSchedule(bots, maps, args.repeat_games, args.seed)
+    durations = game_durations(random_order, args.mean_duration, args.sigma, args.seed)
+
+    print(f"{len(random_order)} games of {args.bots} bots, "
+          f"{sum(durations.values()) / 3600:.1f} hours of play")
+    print(f"{'workers':>7} {'order':>8} {'makespan h':>11} {'vs bound':>9} "
+          f"{'requeued':>9} {'idle':>6}")
+    for workers in args.workers:
+        bound = lower_bound(random_order, durations, workers)
+        rounds = RoundRobinSchedule(bots, maps, args.repeat_games, args.seed, workers)
+        for name, schedule in (("random", random_order), ("rounds", rounds)):
+            makespan, requeued, idle = simulate(schedule, durations, workers,
+                                                args.requeue_delay)
+            print(f"{workers:>7} {name:>8} {makespan / 3600:>11.2f} {makespan / bound:>9.3f} "
+                  f"{requeued:>9} {idle:>6.1%}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+"""
+Compute stats over several result dirs with `calc_stats_chunked`
+and check that every game of every dir is counted.
+
+Each of `--dirs` result dirs holds `--games` random games named
+GAME_000000, GAME_000001, ..., the same names in every dir, as tournaments
+played into separate result dirs have. All `dirs * games` games must be
+in the stats, also after a result file of the first dir changes
+and the stats of the dirs are updated.
+
+Run from the repository root:
+
+    python -m benchmarks.stats_chunked
+"""
+import argparse
+import json
+import os
+import tempfile
+import time
+
+import numpy as np
+
+from scbw_mq.tournament.benchmark.aggregator import StatsAggregator, calc_stats_chunked, \
+    chunk_size_for_memory
+
+RACES = ["T", "Z", "P"]
+
+
+def write_result_dir(result_dir: str, n_games: int, n_bots: int, n_maps: int,
+                     rng: np.random.RandomState) -> None:
+    for i in range(n_games):
+        game_name = f"GAME_{i:06d}"
+        winner, loser = rng.choice(n_bots, size=2, replace=False)
+        info = dict(game_name=game_name,
+                    bots=[f"bot{winner}", f"bot{loser}"],
+                    map=f"sscai/map{rng.randint(n_maps)}.scx",
+                    winner=f"bot{winner}",
+                    loser=f"bot{loser}",
+                    winner_race=RACES[winner % len(RACES)],
+                    loser_race=RACES[loser % len(RACES)],
+                    game_time=float(rng.uniform(60, 3600)))
+        os.makedirs(f"{result_dir}/{game_name}")
+        with open(f"{result_dir}/{game_name}/result.json", "w") as f:
+            json.dump(info, f)
+
+
+def counted_games(stats) -> int:
+    df_rr_winrate, ser_overall_winrate, df_gametimes, *_ = stats
+    # each game has a row for the winner and one for the loser
+    return len(df_gametimes) // 2
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('--dirs', type=int, default=3)
+    parser.add_argument('--games', type=int, default=2000)
+    parser.add_argument('--bots', type=int, default=20)
+    parser.add_argument('--maps', type=int, default=10)
+    parser.add_argument('--max_memory', type=int, default=1,
+                        help="Memory in MB for a chunk of results.")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    rng = np.random.RandomState(args.seed)
+    expected = args.dirs * args.games
+    with tempfile.TemporaryDirectory() as tmp:
+        result_dirs = [f"{tmp}/results{i}" for i in range(args.dirs)]
+        for result_dir in result_dirs:
+            write_result_dir(result_dir, args.games, args.bots, args.maps, rng)
+
+        start = time.perf_counter()
+        stats = calc_stats_chunked(result_dirs, None, args.max_memory)
+        elapsed = time.perf_counter() - start
+        print(f"{args.dirs} dirs of {args.games} games: {counted_games(stats)} games counted, "
+              f"expected {expected}, in {elapsed:.2f}s")
+
+        # a changed result makes the aggregator add all games anew
+        chunk_size = chunk_size_for_memory(args.max_memory)
+        aggregator = StatsAggregator()
+        for result_dir in result_dirs:
+            aggregator.add_result_dir(result_dir, chunk_size)
+        changed_file = f"{result_dirs[0]}/GAME_000000/result.json"
+        mtime = os.path.getmtime(changed_file) + 1
+        os.utime(changed_file, (mtime, mtime))
+        for result_dir in result_dirs:
+            aggregator.add_result_dir(result_dir, chunk_size)
+        print(f"after a result has changed: {counted_games(aggregator.stats())} games counted, "
+              f"expected {expected}")
+
+
+if __name__ == '__main__':
+    main()
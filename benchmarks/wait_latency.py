@@ -0,0 +1,110 @@
+"""
+Measure how long it takes to notice that a job has finished.
+
+A fake `docker` executable is put on PATH: `docker run` sleeps for a random
+duration and exits, `docker events` reports a dying game container after
+a random duration. The delay between the job end and the waiter waking up
+is compared to the previous fixed 3 second polling.
+
+Run from the repository root:
+
+    python -m benchmarks.wait_latency
+"""
+import argparse
+import os
+import random
+import statistics
+import stat
+import sys
+import tempfile
+import time
+from subprocess import Popen
+
+from scbw_mq.tournament.consumer import game_container_prefix
+from scbw_mq.waiter import ProcessWaiter, ContainerExitWatcher, PIDFD_SUPPORTED
+
+FAKE_DOCKER = """#!{python}
+import sys, time
+if sys.argv[1] == "run":
+    time.sleep(float(sys.argv[-1]))
+elif sys.argv[1] == "events":
+    with open({delay_file!r}) as f:
+        name, delay = f.read().split()
+    time.sleep(float(delay))
+    print(name, flush=True)
+    time.sleep(3600)
+"""
+
+POLL_INTERVAL = 3
+
+# game_name of scbw GameArgs
+GAME_NAME = "000001"
+
+
+def install_fake_docker(bin_dir: str, delay_file: str):
+    path = f"{bin_dir}/docker"
+    with open(path, "w") as f:
+        f.write(FAKE_DOCKER.format(python=sys.executable, delay_file=delay_file))
+    os.chmod(path, os.stat(path).st_mode | stat.S_IEXEC)
+    os.environ["PATH"] = bin_dir + os.pathsep + os.environ["PATH"]
+
+
+def poll_process(duration: float) -> float:
+    start = time.time()
+    p = Popen(["docker", "run", "replay", str(duration)])
+    while p.poll() is None:
+        time.sleep(POLL_INTERVAL)
+    return time.time() - start - duration
+
+
+def wait_process(duration: float) -> float:
+    start = time.time()
+    with ProcessWaiter(["docker", "run", "replay", str(duration)]) as waiter:
+        waiter.wait()
+    return time.time() - start - duration
+
+
+def poll_container(delay_file: str, duration: float) -> float:
+    # game containers are checked after each sleep
+    start = time.time()
+    while time.time() - start < duration:
+        time.sleep(POLL_INTERVAL)
+    return time.time() - start - duration
+
+
+def wait_container(delay_file: str, duration: float) -> float:
+    with open(delay_file, "w") as f:
+        f.write(f"{game_container_prefix(GAME_NAME)}0_bot {duration}")
+    with ContainerExitWatcher(game_container_prefix(GAME_NAME)) as watcher:
+        start = time.time()
+        while not watcher.wait(POLL_INTERVAL):
+            pass
+        return time.time() - start - duration
+
+
+def report(name: str, latencies):
+    print(f"{name:<28} mean {statistics.mean(latencies):6.3f}s "
+          f"max {max(latencies):6.3f}s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--max_duration', type=float, default=2.)
+    args = parser.parse_args()
+
+    durations = [random.uniform(0.1, args.max_duration) for _ in range(args.runs)]
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        delay_file = f"{tmp_dir}/delay"
+        install_fake_docker(tmp_dir, delay_file)
+
+        print(f"pidfd supported: {PIDFD_SUPPORTED}")
+        report("process, poll + sleep(3)", [poll_process(d) for d in durations])
+        report("process, ProcessWaiter", [wait_process(d) for d in durations])
+        report("container, sleep(3)", [poll_container(delay_file, d) for d in durations])
+        report("container, events watcher", [wait_container(delay_file, d) for d in durations])
+
+
+if __name__ == '__main__':
+    main()
@@ -6,6 +6,15 @@ LOG_FILE="${LOG_DIR}/replay_${REPLAY_FILE}.log"
 
 . ./play_common.sh
 
+if [ "${REPLAY_FILE}" == "--idle" ]; then
+    # Pre-started container of a pool: start the GUI once, and wait
+    # for replays that are parsed with docker exec and GUI_STARTED set.
+    start_gui
+    sleep 2
+    touch /tmp/gui_started
+    exec sleep infinity
+fi
+
 function RUN_PARSER() {
     win_java32 \
         -jar \
@@ -13,25 +22,56 @@ function RUN_PARSER() {
         -Djava.net.preferIPv4Stack=true \
         bin/parser-jar-with-dependencies.jar \
             --file "${REPLAY_FILE}" \
-    >>${LOG_FILE} 2>&1
+    >>"${LOG_FILE}" 2>&1
 }
 
 
-start_gui
-sleep 2
-run_with_timeout ${PARSER_TIMEOUT} RUN_PARSER
+# Parse REPLAY_FILE within the timeout, logging to LOG_FILE.
+function PARSE_REPLAY() {
+    run_with_timeout ${PARSER_TIMEOUT} RUN_PARSER
+
+    IS_TIMED_OUT=$?
+    if [ ${IS_TIMED_OUT} -eq 143 ]; then
+        LOG "Parsing timed out!" >> "$LOG_FILE"
+
+        # Log ps aux for more info
+        LOG "Running processes:" >> "$LOG_FILE"
+        ps aux >> "$LOG_FILE"
+
+        return 1
+    else
+        LOG "Parsing finished within timeout limit." >> "$LOG_FILE"
+        LOG "Exit code: $IS_TIMED_OUT" >> "$LOG_FILE"
+        return $IS_TIMED_OUT
+    fi
+}
 
-IS_TIMED_OUT=$?
-if [ ${IS_TIMED_OUT} -eq 143 ]; then
-    LOG "Parsing timed out!" >> "$LOG_FILE"
 
-    # Log ps aux for more info
-    LOG "Running processes:" >> "$LOG_FILE"
-    ps aux >> "$LOG_FILE"
+if [ -z "${GUI_STARTED}" ]; then
+    start_gui
+    sleep 2
+fi
 
-    exit 1
-else
-    LOG "Parsing finished within timeout limit." >> "$LOG_FILE"
-    LOG "Exit code: $IS_TIMED_OUT" >> "$LOG_FILE"
-    exit $IS_TIMED_OUT
+if [ "${REPLAY_FILE}" == "--batch" ]; then
+    # replay_entrypoint.sh --batch TIMEOUT REPLAY_FILE...
+    # Parse the replays one after another with the same GUI, each within the timeout,
+    # and report each on stdout as "PARSED <exit code> <replay file>".
+    shift 2
+    EXIT_CODE=0
+    for REPLAY_FILE in "$@"; do
+        LOG_FILE="${LOG_DIR}/replay_${REPLAY_FILE}.log"
+        PARSE_REPLAY
+        PARSE_EXIT_CODE=$?
+        if [ ${IS_TIMED_OUT} -eq 143 ]; then
+            # don't let a stuck parser slow down the next replays,
+            # and fail the batch so that a pooled container is replaced
+            pkill -f parser-jar-with-dependencies
+            EXIT_CODE=1
+        fi
+        echo "PARSED ${PARSE_EXIT_CODE} ${REPLAY_FILE}"
+    done
+    exit ${EXIT_CODE}
 fi
+
+PARSE_REPLAY
+exit $?
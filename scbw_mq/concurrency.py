@@ -0,0 +1,146 @@
+import logging
+import os
+import statistics
+import time
+from collections import deque
+from typing import Deque, Dict, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+def read_load() -> Optional[float]:
+    """
+    One minute load average per CPU, or None if it is not available.
+    """
+    try:
+        return os.getloadavg()[0] / (os.cpu_count() or 1)
+    except (AttributeError, OSError):
+        return None
+
+
+def read_free_memory(meminfo: str = "/proc/meminfo") -> Optional[float]:
+    """
+    Fraction of memory that is available for new processes, or None if unknown.
+    """
+    try:
+        with open(meminfo, 'r') as f:
+            info = dict(line.split(":", 1) for line in f)
+        total = int(info["MemTotal"].split()[0])
+        available = int(info["MemAvailable"].split()[0])
+        return available / total
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+class SlowdownTracker:
+    """
+    Tracks how much slower jobs run than they usually do.
+
+    Jobs report their duration with the amount of work they did
+    (e.g. in-game time of a game), so that short and long jobs compare.
+    The rate of a job, duration per unit of work, is compared with the median
+    rate of recent jobs with the same key (e.g. bots and map of a game).
+    The slowdown is the median of the last `window` ratios, ratios older
+    than `max_age` seconds are dropped, so it returns to 1 when no jobs finish.
+    """
+
+    def __init__(self, window: int = 5, baseline_window: int = 50, max_age: float = 600.):
+        self.max_age = max_age
+        self.baseline_window = baseline_window
+        self.rates: Dict[str, Deque[float]] = {}
+        self.ratios: Deque[Tuple[float, float]] = deque(maxlen=window)
+
+    def record(self, key: Optional[str], duration: float, work: Optional[float]) -> None:
+        if key is None or work is None or duration <= 0 or work <= 0:
+            return
+
+        rate = duration / work
+        rates = self.rates.setdefault(key, deque(maxlen=self.baseline_window))
+        if rates:
+            self.ratios.append((time.time(), rate / statistics.median(rates)))
+        rates.append(rate)
+
+    @property
+    def slowdown(self) -> float:
+        now = time.time()
+        recent = [ratio for at, ratio in self.ratios if now - at <= self.max_age]
+        return statistics.median(recent) if recent else 1.
+
+
+class AdaptiveConcurrency:
+    """
+    Decides how many jobs may run at the same time on this host.
+
+    The number of slots shrinks when the host is overloaded, runs out
+    of memory or jobs get slower than usual, and grows again
+    when there is enough headroom in all of these.
+    """
+
+    def __init__(self, min_slots: int, max_slots: int,
+                 max_load: float = 1.,
+                 min_free_memory: float = 0.1,
+                 max_slowdown: float = 1.5,
+                 interval: float = 10.):
+        if not 1 <= min_slots <= max_slots:
+            raise ValueError(f"Expected 1 <= min_slots <= max_slots, "
+                             f"got {min_slots} and {max_slots}")
+
+        self.min_slots = min_slots
+        self.max_slots = max_slots
+        self.max_load = max_load
+        self.min_free_memory = min_free_memory
+        self.max_slowdown = max_slowdown
+        self.interval = interval
+
+        self.slots = min_slots
+        self.slowdown = SlowdownTracker()
+
+    def overloaded(self, load: Optional[float], free_memory: Optional[float]) -> bool:
+        return (load is not None and load > self.max_load) \
+               or (free_memory is not None and free_memory < self.min_free_memory) \
+               or self.slowdown.slowdown > self.max_slowdown
+
+    def has_headroom(self, load: Optional[float], free_memory: Optional[float]) -> bool:
+        # keep a margin so that the number of slots doesn't oscillate
+        return (load is None or load < 0.8 * self.max_load) \
+               and (free_memory is None or free_memory > 1.5 * self.min_free_memory) \
+               and self.slowdown.slowdown < self.max_slowdown
+
+    def update(self, load: Optional[float] = None,
+               free_memory: Optional[float] = None) -> int:
+        """
+        Update the number of slots from current host measurements.
+
+        :returns: the new number of slots
+        """
+        if self.overloaded(load, free_memory):
+            slots = max(self.min_slots, self.slots - 1)
+        elif self.has_headroom(load, free_memory):
+            slots = min(self.max_slots, self.slots + 1)
+        else:
+            slots = self.slots
+
+        if slots != self.slots:
+            logger.info(f"Changing number of slots {self.slots} -> {slots} "
+                        f"(load {load}, free memory {free_memory}, "
+                        f"slowdown {self.slowdown.slowdown:.2f})")
+            self.slots = slots
+        return slots
+
+    def sample(self) -> int:
+        return self.update(read_load(), read_free_memory())
+
+
+def adaptive_concurrency(config) -> Optional[AdaptiveConcurrency]:
+    """
+    Create the controller from consumer config, if adaptive mode is enabled.
+    The number of processes is used as the upper bound of slots.
+    """
+    if not config.adaptive:
+        return None
+
+    return AdaptiveConcurrency(min_slots=min(config.min_processes, config.n_processes),
+                               max_slots=config.n_processes,
+                               max_load=config.max_load,
+                               min_free_memory=config.min_free_memory,
+                               max_slowdown=config.max_slowdown)
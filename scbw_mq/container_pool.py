@@ -0,0 +1,230 @@
+import logging
+import os
+import subprocess
+import threading
+import time
+from collections import deque
+from itertools import count
+from typing import Deque, List, Optional, Sequence
+
+from .utils import pid_alive
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_POOL_SIZE = 2
+DEFAULT_MAX_JOBS = 50
+
+# How long a fresh container may take until it is ready for jobs.
+READY_TIMEOUT = 60.
+READY_INTERVAL = 0.2
+
+# Containers are labelled with their pool and the pid of its worker, so that
+# containers of workers that died without closing their pool can be removed.
+POOL_LABEL = "scbw_mq.pool"
+OWNER_LABEL = "scbw_mq.pool.pid"
+
+
+class ContainerPoolException(Exception):
+    pass
+
+
+class PooledContainer:
+    """
+    Started container that runs jobs over `docker exec`.
+    """
+    name: str
+    jobs: int
+
+    def __init__(self, name: str):
+        self.name = name
+        self.jobs = 0
+
+    def __str__(self):
+        return self.name
+
+
+class ContainerPool:
+    """
+    Keeps `size` containers started and idle ahead of jobs, so that a job runs
+    in one of them with `docker exec` instead of paying for the startup
+    of a fresh container. A container is removed after `max_jobs` jobs,
+    or after a failed job, and replaced by a fresh one in the background.
+
+    Containers are started with `run_args` in the background, `docker run -d --rm`,
+    and are ready once `ready_cmd` succeeds in them. The docker command can be
+    replaced, e.g. by a fake one in benchmarks.
+
+    Containers left behind by killed workers of a pool of the same name
+    are removed when the pool starts.
+    """
+
+    def __init__(self, name_prefix: str, run_args: Sequence[str],
+                 size: int = DEFAULT_POOL_SIZE, max_jobs: int = DEFAULT_MAX_JOBS,
+                 ready_cmd: Optional[Sequence[str]] = None, docker: str = "docker"):
+        self.pool_name = name_prefix
+        self.name_prefix = f"{name_prefix}_{os.getpid()}"
+        self.run_args = list(run_args)
+        self.size = size
+        self.max_jobs = max_jobs
+        self.ready_cmd = list(ready_cmd) if ready_cmd else None
+        self.docker = docker
+
+        self._idle: Deque[PooledContainer] = deque()
+        self._starting = 0
+        self._busy = 0
+        self._closed = False
+        self._counter = count()
+        self._lock = threading.Condition()
+
+        self.started = 0
+        self.recycled = 0
+        self.failed = 0
+
+    def start(self) -> None:
+        """
+        Start filling the pool, without waiting for the containers.
+        """
+        self.remove_orphans()
+        with self._lock:
+            self._refill()
+
+    def remove_orphans(self) -> None:
+        """
+        Remove containers of pools of the same name whose worker has died.
+        """
+        proc = subprocess.run([self.docker, "ps", "-a",
+                               "--filter", f"label={POOL_LABEL}={self.pool_name}",
+                               "--format", f'{{{{.Names}}}} {{{{.Label "{OWNER_LABEL}"}}}}'],
+                              stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        if proc.returncode != 0:
+            return
+
+        orphans = []
+        for line in proc.stdout.decode("utf-8", "replace").splitlines():
+            name, _, pid = line.partition(" ")
+            if pid.isdigit() and not pid_alive(int(pid)):
+                orphans.append(name)
+        if orphans:
+            logger.warning(f"Removing {len(orphans)} containers of dead workers: {orphans}")
+            subprocess.run([self.docker, "rm", "-f"] + orphans,
+                           stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    def _refill(self) -> None:
+        # called with the lock held
+        while not self._closed and len(self._idle) + self._starting < self.size:
+            self._starting += 1
+            threading.Thread(target=self._start_container, daemon=True).start()
+
+    def _start_container(self) -> None:
+        name = f"{self.name_prefix}_{next(self._counter)}"
+        container = None
+        try:
+            container = self.start_container(name)
+        except Exception:
+            logger.exception(f"Cannot start pooled container {name}")
+
+        with self._lock:
+            self._starting -= 1
+            closed = self._closed
+            if container is None:
+                self.failed += 1
+            elif not closed:
+                self.started += 1
+                self._idle.append(container)
+            self._lock.notify_all()
+        if container is not None and closed:
+            self.remove(container)
+
+    def start_container(self, name: str) -> PooledContainer:
+        proc = subprocess.run([self.docker, "run", "-d", "--rm", "--name", name,
+                               "--label", f"{POOL_LABEL}={self.pool_name}",
+                               "--label", f"{OWNER_LABEL}={os.getpid()}"] + self.run_args,
+                              stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        if proc.returncode != 0:
+            raise ContainerPoolException(proc.stderr.decode("utf-8", "replace").strip())
+        container = PooledContainer(name)
+        if self.ready_cmd is not None:
+            deadline = time.time() + READY_TIMEOUT
+            while subprocess.run(self.exec_cmd(container, self.ready_cmd),
+                                 stdout=subprocess.DEVNULL,
+                                 stderr=subprocess.DEVNULL).returncode != 0:
+                if time.time() > deadline:
+                    self.remove(container)
+                    raise ContainerPoolException(f"Container {name} is not ready "
+                                                 f"after {READY_TIMEOUT:.0f}s")
+                time.sleep(READY_INTERVAL)
+
+        logger.debug(f"Container {name} is ready")
+        return container
+
+    def acquire(self, timeout: Optional[float] = None) -> Optional[PooledContainer]:
+        """
+        Take an idle container for a job, waiting for one if all are busy or starting.
+
+        :returns: the container, None if there was none within the timeout
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        with self._lock:
+            failed = self.failed
+            while not self._idle:
+                if self._closed:
+                    raise ContainerPoolException("Container pool is closed")
+                if self.failed > failed:
+                    # don't retry in a loop, e.g. when the image is missing
+                    raise ContainerPoolException("Cannot start a container, see the log")
+                if self._starting == 0:
+                    # the pool has no size, or its containers have failed before
+                    self._starting += 1
+                    threading.Thread(target=self._start_container, daemon=True).start()
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    return None
+                self._lock.wait(remaining)
+
+            container = self._idle.popleft()
+            self._busy += 1
+            self._refill()
+            return container
+
+    def release(self, container: PooledContainer, healthy: bool = True) -> None:
+        """
+        Return the container after a job, a container that failed the job is replaced.
+        """
+        container.jobs += 1
+        with self._lock:
+            self._busy -= 1
+            if not healthy or container.jobs >= self.max_jobs or self._closed:
+                self.recycled += 1
+                threading.Thread(target=self.remove, args=(container,), daemon=True).start()
+            else:
+                self._idle.append(container)
+            self._refill()
+            self._lock.notify_all()
+
+    def exec_cmd(self, container: PooledContainer, cmd: Sequence[str],
+                 env: Optional[dict] = None) -> List[str]:
+        env_args = [arg for key, value in (env or {}).items()
+                    for arg in ("-e", f"{key}={value}")]
+        return [self.docker, "exec"] + env_args + [container.name] + list(cmd)
+
+    def remove(self, container: PooledContainer) -> None:
+        subprocess.run([self.docker, "rm", "-f", container.name],
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    def close(self) -> None:
+        """
+        Remove idle containers, busy ones are removed once they are released.
+        """
+        with self._lock:
+            self._closed = True
+            idle, self._idle = list(self._idle), deque()
+            self._lock.notify_all()
+        for container in idle:
+            self.remove(container)
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
@@ -2,9 +2,10 @@ import argparse
 from os.path import dirname, abspath
 
 import coloredlogs
-from scbw.cli import SC_BOT_DIR, SCBW_BASE_DIR, SC_LOG_DIR, SC_MAP_DIR, SC_BWAPI_DATA_BWTA_DIR, SC_BWAPI_DATA_BWTA2_DIR
+from scbw.defaults import SC_BOT_DIR, SCBW_BASE_DIR, SC_LOG_DIR, SC_MAP_DIR, SC_BWAPI_DATA_BWTA_DIR, SC_BWAPI_DATA_BWTA2_DIR
 
 from .consumer import launch_consumer
+from ..container_pool import DEFAULT_MAX_JOBS
 from .producer import launch_producer
 
 SC_RESULT_DIR = f"{SCBW_BASE_DIR}/results"
@@ -50,6 +51,31 @@ consumer_parser.add_argument('--password', type=str, help="RabbitMQ password", d
 
 # Parallelization
 consumer_parser.add_argument('--n_processes', type=int, default=4)
+consumer_parser.add_argument('--asyncio', action="store_true",
+                             help="Run all n_processes replay slots as tasks\n"
+                                  "of a single process sharing one connection.")
+consumer_parser.add_argument('--adaptive', action="store_true",
+                             help="Adapt the number of running replays to host load,\n"
+                                  "between min_processes and n_processes.\n"
+                                  "Implies --asyncio.")
+consumer_parser.add_argument('--min_processes', type=int, default=1,
+                             help="Lowest number of replay slots in adaptive mode.")
+consumer_parser.add_argument('--max_load', type=float, default=1.,
+                             help="Shrink replay slots when load average per CPU\n"
+                                  "is above this value in adaptive mode.")
+consumer_parser.add_argument('--min_free_memory', type=float, default=0.1,
+                             help="Shrink replay slots when the fraction of available\n"
+                                  "memory is below this value in adaptive mode.")
+consumer_parser.add_argument('--max_slowdown', type=float, default=1.5,
+                             help="Shrink replay slots when replays run this many times\n"
+                                  "slower than usual in adaptive mode.")
+consumer_parser.add_argument('--recycle_after', type=int, default=0,
+                             help="Replace a worker with a fresh process after\n"
+                                  "it has handled this many replays, 0 means never.")
+consumer_parser.add_argument('--drain_timeout', type=int, default=0,
+                             help="On SIGTERM, wait this many seconds for running\n"
+                                  "replays to finish before killing workers,\n"
+                                  "0 means wait until they finish.")
 
 # Results
 consumer_parser.add_argument('--storage_dir', type=str, default=SC_STORAGE_DIR,
@@ -76,6 +102,22 @@ consumer_parser.add_argument('--bwapi_data_bwta2_dir', type=str, default=SC_BWAP
                              help=f"Directory where BWTA2 map caches are stored, "
                                   f"default:\n{SC_BWAPI_DATA_BWTA2_DIR}")
 
+# Pre-started containers
+consumer_parser.add_argument('--pool_size', type=int, default=0,
+                             help="Keep this many parser containers started and idle\n"
+                                  "per worker, and parse each replay in one of them\n"
+                                  "with docker exec instead of a fresh container.\n"
+                                  "0 starts a fresh container for every replay.")
+consumer_parser.add_argument('--pool_max_jobs', type=int, default=DEFAULT_MAX_JOBS,
+                             help="Replace a pooled container with a fresh one\n"
+                                  "after it has parsed this many replays.")
+consumer_parser.add_argument('--batch_size', type=int, default=1,
+                             help="Take up to this many replays from the queue and\n"
+                                  "parse them one after another in one container,\n"
+                                  "starting the GUI once. Each replay is acknowledged\n"
+                                  "as soon as it is parsed and has its own --timeout.\n"
+                                  "Not supported with --asyncio.")
+
 # Settings
 consumer_parser.add_argument('--opt', type=str, default="",
                              help="Specify custom docker run options")
@@ -1,17 +1,21 @@
+import asyncio
 import logging
-import time
 from argparse import Namespace
-from multiprocessing import Process
-from subprocess import Popen
-from typing import Callable
+from typing import Callable, Dict, List, Optional, Tuple
 
 from pika import ConnectionParameters
 from pika.credentials import PlainCredentials
+from pika.spec import Basic, BasicProperties
 from scbw.docker import APP_DIR, LOG_DIR, MAP_DIR, BWAPI_DATA_BWTA_DIR, BWAPI_DATA_BWTA2_DIR, xoscmounts
 
 from .message import ParseMessage
-from ..rabbitmq_consumer import AckConsumer
+from ..concurrency import adaptive_concurrency
+from ..container_pool import ContainerPool, ContainerPoolException, PooledContainer
+from ..rabbitmq_async_consumer import AsyncAckConsumer
+from ..rabbitmq_consumer import AckConsumer, ConsumerException
 from ..rabbitmq_consumer import consumer_error
+from ..supervisor import WorkerPool
+from ..waiter import ProcessOutputWaiter, ProcessWaiter, SERVICE_INTERVAL
 
 logger = logging.getLogger(__name__)
 
@@ -29,6 +33,14 @@ class ConsumerConfig(Namespace):
 
     # parallelization
     n_processes: int
+    asyncio: bool
+    adaptive: bool
+    min_processes: int
+    max_load: float
+    min_free_memory: float
+    max_slowdown: float
+    recycle_after: int
+    drain_timeout: int
 
     # results
     storage_dir: str
@@ -43,35 +55,132 @@ class ConsumerConfig(Namespace):
     docker_image: str
     opt: str
 
+    # pre-started containers
+    pool_size: int
+    pool_max_jobs: int
+
+    # replays parsed in one container
+    batch_size: int
+
 
 PARSER_DIR = f"{APP_DIR}/bin"
 STORAGE_DIR = f"{APP_DIR}/storage"
 
+PARSER_IMAGE = "starcraft:replay-parser"
+PARSER_ENTRYPOINT = "/app/replay_entrypoint.sh"
+
+# Pooled containers start the GUI once and wait for replays, see replay_entrypoint.sh
+IDLE_ARG = "--idle"
+READY_FILE = "/tmp/gui_started"
+
+# Batches of replays are parsed one after another by a single container,
+# which reports each replay on stdout, see replay_entrypoint.sh
+BATCH_ARG = "--batch"
+PARSED_PREFIX = "PARSED "
+
+
+def parser_run_args(config: ConsumerConfig) -> List[str]:
+    return ["--privileged",
+            "--volume", f"{xoscmounts(config.parser_dir)}:{PARSER_DIR}:ro",
+            "--volume", f"{xoscmounts(config.storage_dir)}:{STORAGE_DIR}:rw",
+            "--volume", f"{xoscmounts(config.log_dir)}:{LOG_DIR}:rw",
+            "--volume", f"{xoscmounts(config.map_dir)}:{MAP_DIR}:rw",
+            "--volume", f"{xoscmounts(config.bwapi_data_bwta_dir)}:{BWAPI_DATA_BWTA_DIR}:rw",
+            "--volume", f"{xoscmounts(config.bwapi_data_bwta2_dir)}:{BWAPI_DATA_BWTA2_DIR}:rw"]
+
+
+def parse_replay_cmd(replay_file: str, config: ConsumerConfig) -> List[str]:
+    return ["docker", "run",
+            "--name", f"PARSE_{replay_file}"] + parser_run_args(config) + \
+           [PARSER_IMAGE, PARSER_ENTRYPOINT,
+            replay_file,
+            str(config.timeout)]
 
-def parse_replay(replay_file: str, config: ConsumerConfig, wait_callback: Callable) -> int:
-    cmd = ["docker", "run",
-           "--privileged",
-           "--name", f"PARSE_{replay_file}",
-           "--volume", f"{xoscmounts(config.parser_dir)}:{PARSER_DIR}:ro",
-           "--volume", f"{xoscmounts(config.storage_dir)}:{STORAGE_DIR}:rw",
-           "--volume", f"{xoscmounts(config.log_dir)}:{LOG_DIR}:rw",
-           "--volume", f"{xoscmounts(config.map_dir)}:{MAP_DIR}:rw",
-           "--volume", f"{xoscmounts(config.bwapi_data_bwta_dir)}:{BWAPI_DATA_BWTA_DIR}:rw",
-           "--volume", f"{xoscmounts(config.bwapi_data_bwta2_dir)}:{BWAPI_DATA_BWTA2_DIR}:rw",
-
-           "starcraft:replay-parser", "/app/replay_entrypoint.sh",
-           replay_file,
-           str(config.timeout)]
-
-    p = Popen(cmd)
-    while True:
-        ret_code = p.poll()
+
+def create_parser_pool(config: ConsumerConfig) -> Optional[ContainerPool]:
+    if config.pool_size <= 0:
+        return None
+    pool = ContainerPool("PARSE_POOL",
+                         parser_run_args(config) + [PARSER_IMAGE, PARSER_ENTRYPOINT, IDLE_ARG],
+                         size=config.pool_size, max_jobs=config.pool_max_jobs,
+                         ready_cmd=["test", "-e", READY_FILE])
+    pool.start()
+    return pool
+
+
+def pooled_parse_cmd(pool: ContainerPool, container: PooledContainer,
+                     replay_file: str, config: ConsumerConfig) -> List[str]:
+    return pool.exec_cmd(container, [PARSER_ENTRYPOINT, replay_file, str(config.timeout)],
+                         env={"GUI_STARTED": "1"})
+
+
+def parse_batch_cmd(replay_files: List[str], config: ConsumerConfig,
+                    pool: Optional[ContainerPool] = None,
+                    container: Optional[PooledContainer] = None) -> List[str]:
+    args = [PARSER_ENTRYPOINT, BATCH_ARG, str(config.timeout)] + replay_files
+    if pool is not None:
+        return pool.exec_cmd(container, args, env={"GUI_STARTED": "1"})
+    return ["docker", "run",
+            "--name", f"PARSE_BATCH_{replay_files[0]}"] + parser_run_args(config) + \
+           [PARSER_IMAGE] + args
+
+
+def acquire_container(pool: ContainerPool, wait_callback: Callable) -> PooledContainer:
+    container = pool.acquire(timeout=SERVICE_INTERVAL)
+    while container is None:
         wait_callback()
-        if ret_code is not None:
-            if ret_code != 0:
-                raise ParseException(f"exit code is not 0 but {ret_code}")
-            break
-        time.sleep(3)
+        container = pool.acquire(timeout=SERVICE_INTERVAL)
+    return container
+
+
+def parse_replay(replay_file: str, config: ConsumerConfig, wait_callback: Callable,
+                 pool: Optional[ContainerPool] = None) -> int:
+    if pool is None:
+        # wakes up as soon as the container exits, servicing the connection meanwhile
+        with ProcessWaiter(parse_replay_cmd(replay_file, config)) as waiter:
+            waiter.wait(service=wait_callback)
+            ret_code = waiter.returncode
+
+    else:
+        container = acquire_container(pool, wait_callback)
+        ret_code = None
+        try:
+            with ProcessWaiter(pooled_parse_cmd(pool, container, replay_file, config)) as waiter:
+                waiter.wait(service=wait_callback)
+                ret_code = waiter.returncode
+        finally:
+            # the parser may leave the GUI in a bad state, such container is replaced
+            pool.release(container, healthy=ret_code == 0)
+
+    if ret_code != 0:
+        raise ParseException(f"exit code is not 0 but {ret_code}")
+
+
+def parse_batch(replay_files: List[str], config: ConsumerConfig, wait_callback: Callable,
+                on_parsed: Callable[[str, int], None],
+                pool: Optional[ContainerPool] = None) -> None:
+    """
+    Parse the replays in one container, each within the timeout.
+
+    :param on_parsed: called with the replay file and the exit code of its parser
+                      as soon as the replay is parsed
+    """
+    container = None if pool is None else acquire_container(pool, wait_callback)
+    ret_code = None
+    try:
+        with ProcessOutputWaiter(parse_batch_cmd(replay_files, config, pool, container)) as waiter:
+            for line in waiter.lines(service=wait_callback):
+                if line.startswith(PARSED_PREFIX):
+                    code, replay_file = line[len(PARSED_PREFIX):].split(" ", 1)
+                    on_parsed(replay_file, int(code))
+            ret_code = waiter.returncode
+    finally:
+        if container is not None:
+            # a replay has timed out, or the container has failed
+            pool.release(container, healthy=ret_code == 0)
+
+    if ret_code != 0:
+        raise ParseException(f"exit code of the batch is not 0 but {ret_code}")
 
 
 class ParseConsumer(AckConsumer):
@@ -90,22 +199,142 @@ class ParseConsumer(AckConsumer):
             heartbeat_interval=20,
         ))
         self.config = config
+        self.pool = create_parser_pool(config)
+        self.batch_size = config.batch_size
+
+    def handle_batch(self, batch: List[Tuple[Basic.Deliver, BasicProperties, bytes]]):
+        if len(batch) == 1:
+            super(ParseConsumer, self).handle_batch(batch)
+            return
+
+        # messages of each replay, a replay sent twice is parsed once
+        pending: Dict[str, List[Tuple[int, bytes]]] = {}
+        for method, properties, body in batch:
+            replay_file = ParseMessage.deserialize(self.decode_body(body)).map
+            pending.setdefault(replay_file, []).append((method.delivery_tag, body))
+
+        def on_parsed(replay_file: str, ret_code: int):
+            for delivery_tag, body in pending.pop(replay_file, ()):
+                if ret_code == 0:
+                    self.settle(delivery_tag, body)
+                else:
+                    self.settle(delivery_tag, body, ConsumerException(
+                        ParseException(f"exit code is not 0 but {ret_code}")))
+
+        error = ConsumerException(ParseException("batch ended before the replay was parsed"))
+        # noinspection PyBroadException
+        try:
+            parse_batch(list(pending), self.config, self.wait_callback, on_parsed, self.pool)
+        except (ParseException, ContainerPoolException) as e:
+            error = ConsumerException(e)
+        except Exception as e:
+            error = e
+
+        for messages in pending.values():
+            for delivery_tag, body in messages:
+                self.settle(delivery_tag, body, error)
 
-    @consumer_error(ParseException)
+    @consumer_error(ParseException, ContainerPoolException)
     def handle_message(self, request: str):
         play = ParseMessage.deserialize(request)
-        parse_replay(play.map, self.config, wait_callback=self.wait_callback)
+        parse_replay(play.map, self.config, wait_callback=self.wait_callback, pool=self.pool)
 
     def wait_callback(self):
         self._connection.process_data_events()
 
+    def close(self):
+        super(ParseConsumer, self).close()
+        if self.pool is not None:
+            self.pool.close()
+
+
+class AsyncParseConsumer(AsyncAckConsumer):
+    """
+    Parses up to `n_processes` replays at once in a single process.
+    """
+    QUEUE = 'parse'
+
+    def __init__(self, config: ConsumerConfig):
+        super(AsyncParseConsumer, self).__init__(ConnectionParameters(
+            host=config.host,
+            port=config.port,
+            credentials=PlainCredentials(config.user, config.password),
+
+            connection_attempts=3,
+            heartbeat_interval=20,
+        ), concurrency=config.n_processes, controller=adaptive_concurrency(config))
+        self.config = config
+        self.pool = create_parser_pool(config)
+
+    @consumer_error(ParseException, ContainerPoolException)
+    async def handle_message(self, request: str):
+        play = ParseMessage.deserialize(request)
+        if self.pool is None:
+            ret_code = await self.run(parse_replay_cmd(play.map, self.config))
+        else:
+            acquiring = self._loop.run_in_executor(None, self.pool.acquire)
+            try:
+                container = await asyncio.shield(acquiring)
+            except asyncio.CancelledError:
+                # the container may still be acquired after the task was cancelled
+                acquiring.add_done_callback(self.release_acquired)
+                raise
+            ret_code = None
+            try:
+                ret_code = await self.run(
+                    pooled_parse_cmd(self.pool, container, play.map, self.config))
+            finally:
+                self.pool.release(container, healthy=ret_code == 0)
+
+        if ret_code != 0:
+            raise ParseException(f"exit code is not 0 but {ret_code}")
+
+    def release_acquired(self, acquiring: asyncio.Future) -> None:
+        if not acquiring.cancelled() and acquiring.exception() is None:
+            self.pool.release(acquiring.result())
+
+    @staticmethod
+    async def run(cmd: List[str]) -> int:
+        p = await asyncio.create_subprocess_exec(*cmd)
+        try:
+            return await p.wait()
+        except asyncio.CancelledError:
+            p.kill()
+            raise
+
+    def close(self):
+        super(AsyncParseConsumer, self).close()
+        if self.pool is not None:
+            self.pool.close()
+
 
 def launch_consumer(args: ConsumerConfig):
-    def run() -> None:
-        logger.info("Initializing a new worker")
+    if args.batch_size > 1 and (args.asyncio or args.adaptive):
+        # async workers run replays side by side in slots instead
+        raise ParseException("Batches of replays are parsed only by workers without --asyncio")
+
+    def run(index: int) -> None:
+        logger.info(f"Initializing worker {index}")
 
         # setup services
         consumer = ParseConsumer(args)
+        consumer.max_messages = args.recycle_after or None
+        consumer.install_drain_handler()
+        try:
+            consumer.connect()
+            consumer.start_consuming()
+        except KeyboardInterrupt:
+            logger.warning("Shutting down worker")
+            consumer.stop_consuming()
+        finally:
+            consumer.close()
+
+    def run_async(index: int) -> None:
+        logger.info(f"Initializing worker {index} with {args.n_processes} parser slots")
+
+        consumer = AsyncParseConsumer(args)
+        consumer.max_messages = args.recycle_after or None
+        consumer.install_drain_handler()
         try:
             consumer.connect()
             consumer.start_consuming()
@@ -115,6 +344,9 @@ def launch_consumer(args: ConsumerConfig):
         finally:
             consumer.close()
 
-    for i in range(args.n_processes):
-        p = Process(target=run)
-        p.start()
+    # keep the workers alive, restarting them if they crash
+    if args.asyncio or args.adaptive:
+        pool = WorkerPool(run_async, 1, drain_timeout=args.drain_timeout or None)
+    else:
+        pool = WorkerPool(run, args.n_processes, drain_timeout=args.drain_timeout or None)
+    pool.run()
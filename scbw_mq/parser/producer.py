@@ -5,6 +5,9 @@ from typing import List
 import pika
 from pika import PlainCredentials
 from scbw.map import check_map_exists
+
+from .message import ParseMessage
+from ..rabbitmq_publisher import ConfirmPublisher
 from ..utils import read_lines
 
 logger = logging.getLogger(__name__)
@@ -27,26 +30,15 @@ def launch_producer(args: ProducerConfig):
     for replay_file in replays:
         check_map_exists(args.replay_dir + "/" + replay_file)
 
-    connection = pika.BlockingConnection(pika.ConnectionParameters(
-        host=args.host,
-        port=args.port,
-        connection_attempts=5,
-        retry_delay=3,
-        credentials=PlainCredentials(args.user, args.password)
-    ))
-
-    try:
-        channel = connection.channel()
-
-        logger.info(f"publishing {len(replays)} messages")
-        for replay in replays:
-            channel.basic_publish(
-                exchange='',
-                routing_key='parse',
-                body=replay,
-                properties=pika.BasicProperties(
-                    delivery_mode=2,  # make message persistent
-                ))
-
-    finally:
-        connection.close()
+    publisher = ConfirmPublisher(
+        pika.ConnectionParameters(
+            host=args.host,
+            port=args.port,
+            connection_attempts=5,
+            retry_delay=3,
+            credentials=PlainCredentials(args.user, args.password)
+        ),
+        routing_key='parse')
+
+    logger.info(f"publishing {len(replays)} messages")
+    publisher.publish(ParseMessage(replay).serialize() for replay in replays)
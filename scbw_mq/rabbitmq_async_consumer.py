@@ -0,0 +1,222 @@
+import asyncio
+import logging
+import signal
+import time
+from typing import Optional, Set
+
+from pika import ConnectionParameters
+from pika.adapters.asyncio_connection import AsyncioConnection
+from pika.channel import Channel
+from pika.spec import Basic, BasicProperties
+
+from .concurrency import AdaptiveConcurrency
+from .rabbitmq_consumer import ConsumerException
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncAckConsumer(object):
+    """
+    Consumer that runs up to `concurrency` messages at the same time
+    as asyncio tasks of a single process sharing one connection.
+
+    Heartbeats and other AMQP traffic are serviced by the event loop,
+    so handlers don't need to call back into the connection while they wait.
+    """
+    QUEUE = 'text'
+
+    # Stop consuming after handling this many messages, so that the worker
+    # process can be replaced by a fresh one. None means never.
+    max_messages: Optional[int] = None
+
+    def __init__(self, connection_params: ConnectionParameters, concurrency: int,
+                 controller: Optional[AdaptiveConcurrency] = None):
+        self._connection = None
+        self._channel: Optional[Channel] = None
+        self._consumer_tag = None
+        self._connection_params = connection_params
+        self._loop = asyncio.new_event_loop()
+        self._tasks: Set[asyncio.Task] = set()
+        self._closing = False
+        self._draining = False
+
+        self.handled_messages = 0
+        self.concurrency = concurrency
+        self.controller = controller
+        if controller is not None:
+            self.concurrency = controller.slots
+
+    def connect(self):
+        logger.info("Connecting")
+        self._connection = AsyncioConnection(self._connection_params,
+                                             on_open_callback=self.on_connection_open,
+                                             on_open_error_callback=self.on_connection_open_error,
+                                             on_close_callback=self.on_connection_closed,
+                                             custom_ioloop=self._loop)
+
+    def start_consuming(self):
+        asyncio.set_event_loop(self._loop)
+        self._loop.run_forever()
+
+    def cancel_consumer(self):
+        if self._channel is not None and self._consumer_tag is not None:
+            self._channel.basic_cancel(consumer_tag=self._consumer_tag)
+            self._consumer_tag = None
+
+    def stop_consuming(self):
+        self.cancel_consumer()
+
+        # Messages that were not acknowledged are requeued by the broker
+        # once the connection is closed.
+        for task in self._tasks:
+            task.cancel()
+        if self._tasks:
+            self._loop.run_until_complete(asyncio.gather(*self._tasks, return_exceptions=True))
+
+    def install_drain_handler(self):
+        """
+        On SIGTERM, let the running messages finish and stop consuming.
+        """
+        self._loop.add_signal_handler(signal.SIGTERM, self.drain)
+
+    def drain(self):
+        if self._draining:
+            return
+        logger.warning(f"Draining, waiting for {len(self._tasks)} running messages")
+        self._draining = True
+        self.cancel_consumer()
+        self.stop_when_idle()
+
+    def stop_when_idle(self):
+        if self._draining and not self._tasks:
+            self._loop.stop()
+
+    def on_connection_open(self, connection):
+        connection.channel(on_open_callback=self.on_channel_open)
+
+    def on_connection_open_error(self, connection, error_message=None):
+        logger.error(f"Could not connect to broker: {error_message}")
+        self._loop.stop()
+
+    def on_connection_closed(self, connection, reply_code, reply_text):
+        if not self._closing:
+            logger.error(f"Connection closed unexpectedly ({reply_code}): {reply_text}")
+        self._loop.stop()
+
+    def on_channel_open(self, channel: Channel):
+        self._channel = channel
+        # Prefetch is shared by the whole channel so that it can be changed
+        # while consuming, there is only one consumer on the channel anyway.
+        # It is no more than the running messages, so the rest wait in the queue
+        # where messages of higher priority can overtake them.
+        self._channel.basic_qos(callback=self.on_qos_ok, prefetch_count=self.concurrency,
+                                all_channels=True)
+
+    def on_qos_ok(self, method_frame):
+        logger.info(f"Consuming up to {self.concurrency} messages at once")
+        self._consumer_tag = self._channel.basic_consume(self.on_message, self.QUEUE)
+        if self.controller is not None:
+            self._loop.call_later(self.controller.interval, self.adjust_concurrency)
+
+    def adjust_concurrency(self):
+        if self._closing or self._channel is None or not self._channel.is_open:
+            return
+
+        slots = self.controller.sample()
+        if slots != self.concurrency:
+            # Lowering prefetch below the number of running jobs pauses
+            # deliveries until enough of them are acknowledged.
+            self.concurrency = slots
+            self._channel.basic_qos(prefetch_count=slots, all_channels=True)
+        self._loop.call_later(self.controller.interval, self.adjust_concurrency)
+
+    # noinspection PyUnusedLocal
+    def on_message(self, channel: Channel,
+                   method: Basic.Deliver,
+                   properties: BasicProperties,
+                   body: bytes):
+        if self._draining:
+            # delivered before the broker processed the cancel
+            self._channel.basic_reject(delivery_tag=method.delivery_tag, requeue=True)
+            return
+
+        task = self._loop.create_task(self.process_message(method.delivery_tag, properties,
+                                                           body))
+        self._tasks.add(task)
+        task.add_done_callback(self.on_task_done)
+
+    def on_task_done(self, task: asyncio.Task):
+        self._tasks.discard(task)
+        if task.cancelled():
+            return
+
+        self.handled_messages += 1
+        if self.max_messages is not None and self.handled_messages >= self.max_messages:
+            logger.info(f"Handled {self.handled_messages} messages, recycling worker")
+            self.drain()
+        self.stop_when_idle()
+
+    async def process_message(self, delivery_tag: int, properties: BasicProperties,
+                              body: bytes):
+        started = time.time()
+        # noinspection PyBroadException
+        try:
+            # Finally call the handler with payload from RMQ message
+            await self.handle_delivery(body, properties)
+
+        except asyncio.CancelledError:
+            raise
+        except ConsumerException:
+            logger.warning(f"Client sent invalid request raising a ControllerException!\n"
+                           f"The message is rejected and sent to dead queue'.",
+                           exc_info=True, extra={"data": {"message-body": body.decode("utf-8", "replace")}})
+            self._channel.basic_reject(delivery_tag=delivery_tag, requeue=False)
+        except Exception:
+            logger.error(f"Unhandled exception occurred in running server!\n"
+                         f"The message is rejected and sent to dead queue'.",
+                         exc_info=True, extra={"data": {"message-body": body.decode("utf-8", "replace")}})
+            self._channel.basic_reject(delivery_tag=delivery_tag, requeue=False)
+        else:
+            self._channel.basic_ack(delivery_tag=delivery_tag)
+            if self.controller is not None:
+                msg = self.decode_body(body)
+                self.controller.slowdown.record(self.job_key(msg), time.time() - started,
+                                                self.job_work(msg))
+
+    async def handle_delivery(self, body: bytes, properties: BasicProperties):
+        """
+        See AckConsumer.handle_delivery
+        """
+        await self.handle_message(self.decode_body(body))
+
+    async def handle_message(self, msg: str):
+        raise NotImplemented
+
+    def decode_body(self, body: bytes):
+        """
+        Convert message body to what handle_message expects, text by default.
+        """
+        return body.decode("utf-8")
+
+    def job_key(self, msg: str) -> Optional[str]:
+        """
+        Identify messages that describe the same kind of job,
+        to detect when jobs are getting slower than usual.
+        """
+        return None
+
+    def job_work(self, msg: str) -> Optional[float]:
+        """
+        Amount of work a handled message took, e.g. in-game time of a game,
+        so that jobs of different length compare. None if unknown.
+        """
+        return None
+
+    def close(self):
+        logger.info('Closing connection')
+        self._closing = True
+        if self._connection is not None and not self._connection.is_closed:
+            self._connection.close()
+            # let the event loop flush the close handshake
+            self._loop.run_forever()
+        self._loop.close()
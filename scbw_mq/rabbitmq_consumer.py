@@ -1,5 +1,7 @@
+import asyncio
 import logging
-from typing import Sequence, Callable, Any
+import signal
+from typing import Sequence, Callable, Any, List, Optional, Tuple
 
 import pika
 from pika import ConnectionParameters
@@ -13,6 +15,9 @@ logger = logging.getLogger(__name__)
 class ExampleConsumer(object):
     QUEUE = 'text'
 
+    # Messages the broker delivers before the handled ones are acknowledged.
+    prefetch_count = 1
+
     def __init__(self, connection_params: ConnectionParameters):
         self._connection = None
         self._channel = None
@@ -23,7 +28,7 @@ class ExampleConsumer(object):
         logger.info("Connecting")
         self._connection = pika.BlockingConnection(self._connection_params)
         self._channel = self._connection.channel()
-        self._channel.basic_qos(prefetch_count=1)
+        self._channel.basic_qos(prefetch_count=self.prefetch_count)
         self._consumer_tag = self._channel.basic_consume(self.on_message, self.QUEUE)
 
     def start_consuming(self):
@@ -53,34 +58,139 @@ class ExampleConsumer(object):
 
 
 class AckConsumer(ExampleConsumer):
+    # Stop consuming after handling this many messages, so that the worker
+    # process can be replaced by a fresh one. None means never.
+    max_messages: Optional[int] = None
+
+    # Messages handled together: the delivered one, and those taken from the queue
+    # with basic_get when it is handled. Each message is settled on its own.
+    batch_size = 1
+
+    handled_messages = 0
+    _handling = False
+    _draining = False
+
+    def install_drain_handler(self):
+        """
+        On SIGTERM, finish the message that is being handled and stop consuming.
+        If no message is being handled, stop right away, prefetched messages
+        are requeued by the broker once the connection is closed.
+        """
+        signal.signal(signal.SIGTERM, self.on_drain_signal)
+
+    # noinspection PyUnusedLocal
+    def on_drain_signal(self, signum, frame):
+        if self._handling:
+            logger.warning("Draining, will stop after the current message")
+            self._draining = True
+        else:
+            raise WorkerShutdown()
+
     # noinspection PyUnusedLocal
     def on_message(self, channel: BlockingChannel,
                    method: Basic.Deliver,
                    properties: BasicProperties,
                    body: bytes):
 
-        # noinspection PyBroadException
+        self._handling = True
+        batch = [(method, properties, body)]
         try:
-            # Finally call the handler with payload from RMQ message
-            self.handle_message(body.decode("utf-8"))
-
-        except ConsumerException as e:
+            if self.batch_size > 1:
+                batch += self.get_messages(self.batch_limit() - 1)
+            self.handle_batch(batch)
+        finally:
+            self._handling = False
+
+        self.handled_messages += len(batch)
+        if self._draining:
+            self.stop_consuming()
+        elif self.max_messages is not None and self.handled_messages >= self.max_messages:
+            logger.info(f"Handled {self.handled_messages} messages, recycling worker")
+            self.stop_consuming()
+
+    def peek_deliveries(self) -> List[Tuple[Basic.Deliver, bytes]]:
+        """
+        Messages prefetched beyond the one that is being handled, in the order
+        they will be handled. Deliveries are not dispatched during a handler,
+        the blocking channel keeps them until it returns.
+        """
+        # a private queue of the blocking channel of pika 0.11
+        events = getattr(self._channel, '_pending_events', ())
+        return [(event.method, event.body) for event in events
+                if isinstance(getattr(event, 'method', None), Basic.Deliver)]
+
+    def batch_limit(self) -> int:
+        if self.max_messages is None:
+            return self.batch_size
+        return max(1, min(self.batch_size, self.max_messages - self.handled_messages))
+
+    def get_messages(self, count: int) -> List[Tuple[Basic.GetOk, BasicProperties, bytes]]:
+        """
+        Take up to count more messages that are ready in the queue, without waiting.
+        """
+        messages = []
+        while len(messages) < count:
+            method, properties, body = self._channel.basic_get(self.QUEUE)
+            if method is None:
+                break
+            messages.append((method, properties, body))
+        return messages
+
+    def handle_batch(self, batch: List[Tuple[Basic.Deliver, BasicProperties, bytes]]):
+        """
+        Handle the messages and settle each of them, one after another by default.
+        """
+        for method, properties, body in batch:
+            # noinspection PyBroadException
+            try:
+                # Finally call the handler with payload from RMQ message
+                self.handle_delivery(body, properties)
+            except Exception as e:
+                self.settle(method.delivery_tag, body, e)
+            else:
+                self.settle(method.delivery_tag, body)
+
+    def settle(self, delivery_tag: int, body: bytes, error: Optional[Exception] = None):
+        """
+        Acknowledge the handled message, or reject it to the dead queue after an error.
+        """
+        if error is None:
+            self._channel.basic_ack(delivery_tag=delivery_tag)
+            return
+
+        if isinstance(error, ConsumerException):
             logger.warning(f"Client sent invalid request raising a ControllerException!\n"
                            f"The message is rejected and sent to dead queue'.",
-                           exc_info=True, extra={"data": {"message-body": body.decode("utf-8")}})
-            self._channel.basic_reject(delivery_tag=method.delivery_tag, requeue=False)
-        except Exception as e:
+                           exc_info=error, extra={"data": {"message-body": body.decode("utf-8", "replace")}})
+        else:
             logger.error(f"Unhandled exception occurred in running server!\n"
                          f"The message is rejected and sent to dead queue'.",
-                         exc_info=True, extra={"data": {"message-body": body.decode("utf-8")}})
-            self._channel.basic_reject(delivery_tag=method.delivery_tag, requeue=False)
-        else:
-            self._channel.basic_ack(delivery_tag=method.delivery_tag)
+                         exc_info=error, extra={"data": {"message-body": body.decode("utf-8", "replace")}})
+        self._channel.basic_reject(delivery_tag=delivery_tag, requeue=False)
 
+    def handle_delivery(self, body: bytes, properties: BasicProperties):
+        """
+        Handle the message with its properties, only the payload is passed on by default.
+        """
+        self.handle_message(self.decode_body(body))
 
     def handle_message(self, msg: str):
         raise NotImplemented
 
+    def decode_body(self, body: bytes):
+        """
+        Convert message body to what handle_message expects, text by default.
+        """
+        return body.decode("utf-8")
+
+
+class WorkerShutdown(KeyboardInterrupt):
+    """
+    Raised when the worker is asked to stop while it is idle,
+    so it is handled the same way as a keyboard interrupt.
+    """
+    pass
+
 
 class ConsumerException(Exception):
     pass
@@ -93,6 +203,15 @@ def consumer_error(*exceptions: Sequence[Exception]) -> Callable[..., Any]:
     """
 
     def _controller_error(fn) -> Callable[..., Any]:
+        if asyncio.iscoroutinefunction(fn):
+            async def wrapped_async(*args, **kwargs) -> Any:
+                try:
+                    return await fn(*args, **kwargs)
+                except exceptions as e:
+                    raise ConsumerException(e)
+
+            return wrapped_async
+
         def wrapped(*args, **kwargs) -> Callable[..., Any]:
             try:
                 return fn(*args, **kwargs)
@@ -0,0 +1,226 @@
+import logging
+import time
+from collections import OrderedDict, deque
+from typing import Callable, Iterable, Iterator, List, Optional, Set, Tuple
+
+import pika
+from pika import ConnectionParameters
+from pika.spec import Basic, BasicProperties
+
+logger = logging.getLogger(__name__)
+
+# Shared by all publishers, building new properties per message is wasteful.
+PERSISTENT_PROPERTIES = BasicProperties(
+    delivery_mode=2,  # make message persistent
+)
+
+DEFAULT_WINDOW = 256
+DEFAULT_BATCH_SIZE = 1000
+DEFAULT_MAX_RETRIES = 3
+
+
+class PublishException(Exception):
+    pass
+
+
+class ConfirmPublisher(object):
+    """
+    Publishes a stream of messages on a channel in confirm mode.
+
+    Up to `window` messages may be unconfirmed by the broker at any time,
+    so publishing is pipelined instead of waiting for each message.
+    Nacked messages are published again, at most `max_retries` times.
+    Throughput is reported after every `batch_size` confirmed messages,
+    along with the number of messages from the start of the stream
+    that are all confirmed to `on_progress`.
+    """
+
+    def __init__(self, connection_params: ConnectionParameters,
+                 exchange: str = '',
+                 routing_key: str = 'play',
+                 properties: BasicProperties = PERSISTENT_PROPERTIES,
+                 window: int = DEFAULT_WINDOW,
+                 batch_size: int = DEFAULT_BATCH_SIZE,
+                 max_retries: int = DEFAULT_MAX_RETRIES,
+                 on_progress: Optional[Callable[[int], None]] = None):
+        if window < 1:
+            raise ValueError(f"Publish window must be positive, got {window}")
+
+        self._connection_params = connection_params
+        self._connection = None
+        self._channel = None
+
+        self.exchange = exchange
+        self.routing_key = routing_key
+        self.properties = properties
+        self.window = window
+        self.batch_size = batch_size
+        self.max_retries = max_retries
+        self.on_progress = on_progress
+
+        self._messages: Iterator[str] = iter(())
+        self._exhausted = False
+        self._stopping = False
+        self._error: Optional[str] = None
+
+        # delivery tag -> (body, attempt, index in the stream)
+        self._pending: OrderedDict = OrderedDict()
+        self._retries: deque = deque()
+        self._delivery_tag = 0
+        self._taken = 0
+
+        # retried messages may be confirmed after later ones
+        self.confirmed_prefix = 0
+        self._confirmed_ahead: Set[int] = set()
+
+        self.confirmed = 0
+        self.retried = 0
+        self.failed: List[str] = []
+        self.batch_rates: List[float] = []
+        self._batch_confirmed = 0
+        self._batch_start = 0.
+
+    def connect(self):
+        logger.info("Connecting")
+        return pika.SelectConnection(self._connection_params,
+                                     on_open_callback=self.on_connection_open,
+                                     on_open_error_callback=self.on_connection_open_error,
+                                     on_close_callback=self.on_connection_closed,
+                                     stop_ioloop_on_close=True)
+
+    def publish(self, messages: Iterable[str]) -> int:
+        """
+        Publish all messages and block until the broker has confirmed them.
+
+        :returns: number of messages confirmed by the broker
+        :raises PublishException: if the connection failed or some messages
+            were nacked more than `max_retries` times
+        """
+        self._messages = iter(messages)
+        self._connection = self.connect()
+        self._connection.ioloop.start()
+
+        if self._error is not None:
+            raise PublishException(self._error)
+        if self.failed:
+            raise PublishException(f"{len(self.failed)} messages were rejected by the broker "
+                                   f"after {self.max_retries} retries")
+        return self.confirmed
+
+    def on_connection_open(self, connection):
+        connection.channel(on_open_callback=self.on_channel_open)
+
+    def on_connection_open_error(self, connection, error_message=None):
+        self._error = f"Could not connect to broker: {error_message}"
+        connection.ioloop.stop()
+
+    def on_connection_closed(self, connection, reply_code, reply_text):
+        if not self._stopping:
+            self._error = f"Connection closed unexpectedly ({reply_code}): {reply_text}"
+
+    def on_channel_open(self, channel):
+        self._channel = channel
+        self._channel.add_on_close_callback(self.on_channel_closed)
+        self._channel.confirm_delivery(self.on_delivery_confirmation)
+        self._batch_start = time.time()
+        self.publish_window()
+
+    def on_channel_closed(self, channel, reply_code, reply_text):
+        if not self._stopping:
+            self._error = f"Channel closed unexpectedly ({reply_code}): {reply_text}"
+            self._stopping = True
+            self._connection.close()
+
+    def next_message(self) -> Optional[Tuple[str, int, int]]:
+        if self._retries:
+            return self._retries.popleft()
+        if self._exhausted:
+            return None
+        try:
+            body = next(self._messages)
+        except StopIteration:
+            self._exhausted = True
+            return None
+        self._taken += 1
+        return body, 0, self._taken - 1
+
+    def publish_window(self):
+        while not self._stopping and len(self._pending) < self.window:
+            message = self.next_message()
+            if message is None:
+                break
+
+            body, attempt, index = message
+            self._channel.basic_publish(exchange=self.exchange,
+                                        routing_key=self.routing_key,
+                                        body=body,
+                                        properties=self.properties)
+            self._delivery_tag += 1
+            self._pending[self._delivery_tag] = (body, attempt, index)
+
+        if not self._pending and self._exhausted and not self._retries:
+            self.stop()
+
+    def on_delivery_confirmation(self, method_frame):
+        method = method_frame.method
+        nacked = isinstance(method, Basic.Nack)
+
+        if method.multiple:
+            tags = []
+            for tag in self._pending:
+                if tag > method.delivery_tag:
+                    break
+                tags.append(tag)
+        else:
+            tags = [method.delivery_tag]
+
+        for tag in tags:
+            body, attempt, index = self._pending.pop(tag)
+            if nacked:
+                self.on_nack(body, attempt, index)
+            else:
+                self.confirmed += 1
+                self._batch_confirmed += 1
+                self.confirm_index(index)
+
+        if self._batch_confirmed >= self.batch_size:
+            self.report_batch()
+
+        self.publish_window()
+
+    def confirm_index(self, index: int):
+        self._confirmed_ahead.add(index)
+        while self.confirmed_prefix in self._confirmed_ahead:
+            self._confirmed_ahead.remove(self.confirmed_prefix)
+            self.confirmed_prefix += 1
+
+    def on_nack(self, body: str, attempt: int, index: int):
+        if attempt < self.max_retries:
+            logger.debug(f"Message was nacked, retrying (attempt {attempt + 1}): {body}")
+            self.retried += 1
+            self._retries.append((body, attempt + 1, index))
+        else:
+            logger.error(f"Message was nacked {attempt + 1} times, giving up: {body}")
+            self.failed.append(body)
+
+    def report_batch(self):
+        now = time.time()
+        elapsed = max(now - self._batch_start, 1e-9)
+        rate = self._batch_confirmed / elapsed
+        self.batch_rates.append(rate)
+        logger.info(f"Confirmed {self._batch_confirmed} messages in {elapsed:.2f}s "
+                    f"({rate:.0f} msg/s), {self.confirmed} in total")
+        self._batch_confirmed = 0
+        self._batch_start = now
+        if self.on_progress is not None:
+            self.on_progress(self.confirmed_prefix)
+
+    def stop(self):
+        if self._stopping:
+            return
+        self._stopping = True
+        if self._batch_confirmed > 0:
+            self.report_batch()
+
+        logger.info('Closing connection')
+        self._connection.close()
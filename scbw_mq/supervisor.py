@@ -0,0 +1,144 @@
+import logging
+import os
+import signal
+import time
+from multiprocessing import Process
+from multiprocessing.connection import wait
+from typing import Callable, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class WorkerSlot:
+    def __init__(self, index: int):
+        self.index = index
+        self.process: Optional[Process] = None
+        self.started = 0.
+        self.failures = 0
+        self.restart_at = 0.
+
+
+class WorkerPool:
+    """
+    Keeps `n_workers` worker processes alive.
+
+    A worker that exits with zero exit code (e.g. it was recycled after
+    handling its share of messages) is replaced immediately, a crashed one
+    is replaced after exponential backoff. On SIGTERM or SIGINT the pool
+    stops respawning, asks the workers to drain and waits for them to exit.
+    """
+
+    def __init__(self, target: Callable[[int], None], n_workers: int,
+                 backoff_base: float = 1.,
+                 backoff_max: float = 60.,
+                 drain_timeout: Optional[float] = None):
+        self.target = target
+        self.slots = [WorkerSlot(i) for i in range(n_workers)]
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.drain_timeout = drain_timeout
+        self.draining = False
+
+    def run(self) -> None:
+        previous_handler = signal.signal(signal.SIGTERM, self.on_signal)
+        try:
+            for slot in self.slots:
+                self.start(slot)
+
+            while not self.draining:
+                try:
+                    self.supervise()
+                except KeyboardInterrupt:
+                    # the terminal delivers SIGINT to the workers too
+                    self.draining = True
+        finally:
+            signal.signal(signal.SIGTERM, previous_handler)
+
+        self.drain()
+
+    def on_signal(self, signum, frame):
+        logger.warning(f"Received signal {signum}, draining workers")
+        self.draining = True
+        for process in self.alive():
+            process.terminate()
+
+    def alive(self) -> List[Process]:
+        return [slot.process for slot in self.slots
+                if slot.process is not None and slot.process.is_alive()]
+
+    def start(self, slot: WorkerSlot) -> None:
+        slot.process = Process(target=run_worker, args=(self.target, slot.index),
+                               name=f"worker-{slot.index}")
+        slot.process.start()
+        slot.started = time.time()
+        logger.info(f"Started worker {slot.index} (pid {slot.process.pid})")
+
+    def supervise(self) -> None:
+        sentinels: Dict[int, WorkerSlot] = {slot.process.sentinel: slot
+                                            for slot in self.slots
+                                            if slot.process is not None}
+        now = time.time()
+        pending = [slot.restart_at - now for slot in self.slots if slot.process is None]
+        timeout = max(min(pending), 0) if pending else None
+
+        for sentinel in wait(list(sentinels), timeout):
+            self.on_exit(sentinels[sentinel])
+
+        now = time.time()
+        for slot in self.slots:
+            if slot.process is None and slot.restart_at <= now and not self.draining:
+                self.start(slot)
+
+    def on_exit(self, slot: WorkerSlot) -> None:
+        process = slot.process
+        process.join()
+        slot.process = None
+
+        if self.draining:
+            logger.info(f"Worker {slot.index} has exited with code {process.exitcode}")
+            return
+
+        if process.exitcode == 0:
+            logger.info(f"Worker {slot.index} has finished, replacing it")
+            slot.failures = 0
+            slot.restart_at = 0.
+            return
+
+        # A worker that has been running for a while is not crashing in a loop.
+        if time.time() - slot.started > self.backoff_max:
+            slot.failures = 0
+        slot.failures += 1
+        delay = min(self.backoff_max, self.backoff_base * 2 ** (slot.failures - 1))
+        slot.restart_at = time.time() + delay
+        logger.error(f"Worker {slot.index} exited with code {process.exitcode}, "
+                     f"restarting in {delay:.1f}s")
+
+    def drain(self) -> None:
+        processes = self.alive()
+        logger.info(f"Waiting for {len(processes)} workers to finish")
+        deadline = None if self.drain_timeout is None else time.time() + self.drain_timeout
+
+        while processes:
+            timeout = None if deadline is None else max(deadline - time.time(), 0)
+            try:
+                wait([p.sentinel for p in processes], timeout)
+            except KeyboardInterrupt:
+                deadline = time.time()
+
+            if deadline is not None and time.time() >= deadline:
+                for process in self.alive():
+                    logger.warning(f"Worker {process.name} did not finish in time, killing it")
+                    os.kill(process.pid, signal.SIGKILL)
+                deadline = None
+
+            processes = self.alive()
+
+        for slot in self.slots:
+            if slot.process is not None:
+                slot.process.join()
+
+
+def run_worker(target: Callable[[int], None], index: int) -> None:
+    # workers install their own handler for draining
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    target(index)
@@ -0,0 +1,221 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from os.path import dirname, exists, isdir, join, relpath
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from .message import PlayMessage
+
+logger = logging.getLogger(__name__)
+
+# Staging is mostly waiting for the (network) filesystem.
+DEFAULT_STAGING_THREADS = 2
+
+HASH_CHUNK_SIZE = 1 << 20
+
+# Directories of a bot that its games change, they are never replaced by the source.
+# The read dir is copied only to a node that doesn't have it yet.
+BOT_STATE_DIRS = ("read", "write")
+
+BOT = "bot"
+MAP = "map"
+
+
+class AssetException(Exception):
+    pass
+
+
+def copy_hashed(src: str, dst: str) -> str:
+    """
+    Copy the file and hash its contents in one pass.
+
+    :returns: sha256 of the file
+    """
+    digest = hashlib.sha256()
+    with open(src, "rb") as fin, open(dst, "wb") as fout:
+        for chunk in iter(lambda: fin.read(HASH_CHUNK_SIZE), b""):
+            digest.update(chunk)
+            fout.write(chunk)
+    return digest.hexdigest()
+
+
+class AssetCache:
+    """
+    Stages bots and maps of games into the bot and map dirs of this node
+    from a source dir, a local store or a shared mount with `bots` and `maps`
+    dirs laid out as the scbw base dir.
+
+    Files are kept in a content-addressed store of the node, named by their sha256.
+    An index remembers the digest of each source file by its size and modification time,
+    so a file is read from the source only when it is new or changed, and files
+    that many bots share, e.g. BWAPI.dll, are stored once.
+    Staged files keep the modification time of the source, unchanged files are
+    recognized by it and left as they are.
+
+    Assets of upcoming games are staged by background threads with `prefetch`,
+    `stage_game` waits until the assets of the game are staged. Games that are
+    not played must `discard` their assets, so that later games stage them again.
+    """
+
+    def __init__(self, cache_dir: str, source_dir: str, bot_dir: str, map_dir: str,
+                 n_threads: int = DEFAULT_STAGING_THREADS):
+        self.cache_dir = cache_dir
+        self.source_bot_dir = join(source_dir, "bots")
+        self.source_map_dir = join(source_dir, "maps")
+        self.bot_dir = bot_dir
+        self.map_dir = map_dir
+        os.makedirs(join(cache_dir, "objects"), exist_ok=True)
+        os.makedirs(join(cache_dir, "index"), exist_ok=True)
+
+        self._executor = ThreadPoolExecutor(max_workers=n_threads)
+        # staging of assets, until a game takes them
+        self._staging: Dict[Tuple[str, str], Future] = {}
+
+    @staticmethod
+    def game_assets(play: PlayMessage) -> List[Tuple[str, str]]:
+        return [(BOT, bot) for bot in sorted(set(play.bots))] + [(MAP, play.map)]
+
+    def prefetch(self, play: PlayMessage) -> List[Future]:
+        """
+        Start staging assets of the game in the background, unless they already are.
+        """
+        futures = []
+        for asset in self.game_assets(play):
+            staging = self._staging.get(asset)
+            # a failed staging is tried again, the source may be back
+            if staging is None or (staging.done() and staging.exception() is not None):
+                staging = self._staging[asset] = self._executor.submit(self.stage, *asset)
+            futures.append(staging)
+        return futures
+
+    def take(self, play: PlayMessage) -> List[Future]:
+        """
+        Staging of assets of the game that is about to be played.
+        """
+        futures = self.prefetch(play)
+        self.discard(play)
+        return futures
+
+    def discard(self, play: PlayMessage) -> None:
+        """
+        Forget staging of assets of the game, the next game checks the assets again,
+        they may have changed since.
+        """
+        for asset in self.game_assets(play):
+            self._staging.pop(asset, None)
+
+    def stage_game(self, play: PlayMessage) -> None:
+        for future in self.take(play):
+            future.result()
+
+    def stage(self, kind: str, name: str) -> None:
+        if kind == BOT:
+            self.stage_bot(name)
+        else:
+            self.stage_map(name)
+
+    def stage_bot(self, bot: str) -> None:
+        src, dst = join(self.source_bot_dir, bot), join(self.bot_dir, bot)
+        if not isdir(src):
+            if isdir(dst):
+                return
+            raise AssetException(f"Bot {bot} is neither in {self.source_bot_dir} "
+                                 f"nor in {self.bot_dir}")
+
+        skip = [state for state in BOT_STATE_DIRS if state == "write" or exists(join(dst, state))]
+        files = list(self.tree_files(src, skip))
+        self.stage_files(f"bots/{bot}", src, dst, files)
+        for state in BOT_STATE_DIRS:
+            os.makedirs(join(dst, state), exist_ok=True)
+
+    def stage_map(self, map_name: str) -> None:
+        src, dst = join(self.source_map_dir, map_name), join(self.map_dir, map_name)
+        if not exists(src):
+            if exists(dst):
+                return
+            raise AssetException(f"Map {map_name} is neither in {self.source_map_dir} "
+                                 f"nor in {self.map_dir}")
+        self.stage_files(f"maps/{map_name}", dirname(src), dirname(dst),
+                         [relpath(src, dirname(src))])
+
+    @staticmethod
+    def tree_files(root: str, skip: List[str]) -> Iterator[str]:
+        for path, dirs, files in os.walk(root):
+            if path == root:
+                dirs[:] = [d for d in dirs if d not in skip]
+            for file in files:
+                yield relpath(join(path, file), root)
+
+    def index_file(self, asset: str) -> str:
+        return join(self.cache_dir, "index", asset.replace("/", "_") + ".json")
+
+    def object_file(self, digest: str) -> str:
+        return join(self.cache_dir, "objects", digest[:2], digest)
+
+    def stage_files(self, asset: str, src_root: str, dst_root: str, files: List[str]) -> None:
+        index_file = self.index_file(asset)
+        index: Dict[str, list] = {}
+        if exists(index_file):
+            with open(index_file, "r") as f:
+                index = json.load(f)
+
+        changed = 0
+        for file in files:
+            src, dst = join(src_root, file), join(dst_root, file)
+            stat = os.stat(src)
+            if exists(dst):
+                dst_stat = os.stat(dst)
+                if dst_stat.st_size == stat.st_size \
+                        and int(dst_stat.st_mtime) == int(stat.st_mtime):
+                    continue
+
+            entry = index.get(file)
+            if entry is None or entry[:2] != [stat.st_size, stat.st_mtime_ns] \
+                    or not exists(self.object_file(entry[2])):
+                entry = [stat.st_size, stat.st_mtime_ns, self.store_object(src)]
+                index[file] = entry
+
+            self.place_object(entry[2], dst, stat)
+            changed += 1
+
+        if changed:
+            logger.info(f"Staged {changed} of {len(files)} files of {asset}")
+            tmp_file = f"{index_file}.{os.getpid()}.tmp"
+            with open(tmp_file, "w") as f:
+                json.dump(index, f)
+            os.replace(tmp_file, index_file)
+
+    def store_object(self, src: str) -> str:
+        """
+        :returns: digest of the stored file
+        """
+        tmp_file = join(self.cache_dir, "objects", f"{os.getpid()}.{threading.get_ident()}.tmp")
+        digest = copy_hashed(src, tmp_file)
+        object_file = self.object_file(digest)
+        os.makedirs(dirname(object_file), exist_ok=True)
+        # other workers of the node may store the same contents at the same time
+        os.replace(tmp_file, object_file)
+        return digest
+
+    def place_object(self, digest: str, dst: str, stat: os.stat_result) -> None:
+        # copied rather than linked, a bot that changes its files
+        # must not change the store
+        os.makedirs(dirname(dst), exist_ok=True)
+        tmp_file = f"{dst}.{os.getpid()}.tmp"
+        shutil.copyfile(self.object_file(digest), tmp_file)
+        os.utime(tmp_file, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+        os.replace(tmp_file, dst)
+
+    def close(self) -> None:
+        self._executor.shutdown(wait=False)
+
+
+def create_asset_cache(cache_dir: Optional[str], source_dir: Optional[str],
+                       bot_dir: str, map_dir: str) -> Optional[AssetCache]:
+    if source_dir is None:
+        return None
+    return AssetCache(cache_dir, source_dir, bot_dir, map_dir)
@@ -0,0 +1,380 @@
+import glob
+import logging
+import os
+import pickle
+from collections import Counter
+from itertools import islice
+from os.path import exists
+from typing import Dict, Iterable, List, Optional, Sequence, Set, Tuple
+
+import numpy as np
+import pandas as pd
+from pandas import DataFrame, Series
+
+from .defaults import DEFAULT_MAX_MEMORY
+from .elo_engine import INITIAL, rate_1vs1, rate_games
+from .stats import RESULT_COLUMNS, count_matrix, present_counts
+from .stats import read_result_files, result_row, stat_result_files
+
+logger = logging.getLogger(__name__)
+
+# Rough peak memory taken by one result while its chunk is processed:
+# the parsed json, the row and its share of the chunk DataFrame.
+BYTES_PER_RESULT = 4096
+
+GAME_TIME_COLUMNS = ['game_name', 'bot', 'race', 'game_time']
+
+
+def chunk_size_for_memory(max_memory: int) -> int:
+    """
+    :param max_memory: memory in MB that processing a chunk of results may take
+    """
+    return max(1, max_memory * 2 ** 20 // BYTES_PER_RESULT)
+
+
+class StatsAggregator:
+    """
+    Keeps the counters behind `calc_stats` and updates them one game at a time,
+    so that new results don't require processing all the previous ones again.
+
+    `stats()` returns the same tables as `calc_stats` would for all the added games,
+    in the order they were added.
+
+    Results can be added in chunks of bounded size, so memory depends on the number
+    of bots and maps, only game times are kept for each game in a compact form.
+
+    Games are identified by their result files, so that games of the same name
+    in different result dirs are different games. Result files are read again only
+    when they change, the stats are then computed anew, as the elo ratings depend
+    on the order of all games.
+    """
+    STATE_VERSION = 4
+
+    def __init__(self, ser_round_robin_elos: Optional[Series] = None):
+        self.version = self.STATE_VERSION
+        self.initial_elos: Optional[Dict[str, float]] = None
+        self.ratings: Dict[str, float] = {}
+        if ser_round_robin_elos is not None:
+            self.initial_elos = dict(ser_round_robin_elos.items())
+            self.ratings = dict(self.initial_elos)
+
+        # result files of added games, or names of games added without a file
+        self.games: Set[str] = set()
+        # modification times of read result files, also of those without a winner
+        self.mtimes: Dict[str, float] = {}
+        self.bots: Set[str] = set()
+        self.maps: Set[str] = set()
+
+        self.wins: Counter = Counter()  # (winner, loser)
+        self.map_wins: Counter = Counter()  # (map, bot)
+        self.map_losses: Counter = Counter()  # (map, bot)
+        self.race_wins: Counter = Counter()  # (winner_race, loser_race)
+        self.bot_race_wins: Counter = Counter()  # (winner, loser_race)
+        self.bot_race_losses: Counter = Counter()  # (loser, winner_race)
+
+        # first race each bot was seen with, as winner and as loser
+        self.winner_races: Dict[str, str] = {}
+        self.loser_races: Dict[str, str] = {}
+
+        # game times are reported per game, they are kept in chunks
+        # with categorical bots and races, added games wait in lists
+        self.winner_times: List[Tuple[str, str, str, float]] = []
+        self.loser_times: List[Tuple[str, str, str, float]] = []
+        self.winner_time_chunks: List[DataFrame] = []
+        self.loser_time_chunks: List[DataFrame] = []
+
+    def add(self, game_name: str, map: str, winner: str, winner_race: str,
+            loser: str, loser_race: str, game_time: float, key: Optional[str] = None) -> bool:
+        """
+        Add the result of a game, races are full names as in `process_results`.
+
+        :param key: identifies the game, e.g. its result file, the game name by default
+        :returns: False if the game has already been added
+        """
+        key = game_name if key is None else key
+        if key in self.games:
+            return False
+        self.games.add(key)
+        self.bots.update((winner, loser))
+        self.maps.add(map)
+
+        self.wins[winner, loser] += 1
+        self.map_wins[map, winner] += 1
+        self.map_losses[map, loser] += 1
+        self.race_wins[winner_race, loser_race] += 1
+        self.bot_race_wins[winner, loser_race] += 1
+        self.bot_race_losses[loser, winner_race] += 1
+
+        self.winner_races.setdefault(winner, winner_race)
+        self.loser_races.setdefault(loser, loser_race)
+        self.winner_times.append((game_name, winner, winner_race, game_time))
+        self.loser_times.append((game_name, loser, loser_race, game_time))
+
+        self.rate(winner, loser)
+        return True
+
+    def add_result(self, info: dict, key: Optional[str] = None) -> bool:
+        """
+        Add a game from its result.json, see `process_results`.
+        """
+        row = result_row(info)
+        if row is None:
+            return False
+        return self.add(*row, key=key)
+
+    def add_frame(self, df: DataFrame, keys: Optional[Sequence[str]] = None) -> int:
+        """
+        Add results of many games at once, in the format of `process_results`.
+
+        :param keys: identify the games, e.g. their result files, game names by default
+        :returns: number of added games
+        """
+        keys = df.index if keys is None else pd.Index(keys)
+        new = ~keys.duplicated() & ~np.asarray(keys.map(self.games.__contains__), dtype=bool)
+        df = df[new]
+        if df.empty:
+            return 0
+
+        self.games.update(keys[new])
+        self.bots.update(df['winner'])
+        self.bots.update(df['loser'])
+        self.maps.update(df['map'])
+
+        update_counter(self.wins, df, ['winner', 'loser'])
+        update_counter(self.map_wins, df, ['map', 'winner'])
+        update_counter(self.map_losses, df, ['map', 'loser'])
+        update_counter(self.race_wins, df, ['winner_race', 'loser_race'])
+        update_counter(self.bot_race_wins, df, ['winner', 'loser_race'])
+        update_counter(self.bot_race_losses, df, ['loser', 'winner_race'])
+
+        for bot, race in df.drop_duplicates('winner')[['winner', 'winner_race']].values:
+            self.winner_races.setdefault(bot, race)
+        for bot, race in df.drop_duplicates('loser')[['loser', 'loser_race']].values:
+            self.loser_races.setdefault(bot, race)
+
+        self.compact()
+        self.winner_time_chunks.append(time_chunk(df.index, df['winner'], df['winner_race'],
+                                                  df['game_time']))
+        self.loser_time_chunks.append(time_chunk(df.index, df['loser'], df['loser_race'],
+                                                 df['game_time']))
+
+        # same as calc_elo, for the games of the chunk
+        bots = pd.Index(pd.unique(np.concatenate((df['winner'].values, df['loser'].values))))
+        ratings = rate_games(bots.get_indexer(df['winner']), bots.get_indexer(df['loser']),
+                             np.array([self.ratings.get(bot, INITIAL) for bot in bots]))
+        self.ratings.update(zip(bots, ratings.tolist()))
+
+        return len(df)
+
+    def add_result_files(self, files: Iterable[str], chunk_size: int,
+                         mtimes: Optional[Dict[str, float]] = None) -> int:
+        """
+        Add games from result files, reading at most `chunk_size` files at once.
+
+        :param mtimes: modification times of the files, to remember which were read
+        :returns: number of added games
+        """
+        files = iter(files)
+        added = 0
+        # the order of games matters for elo, add them in the order of files
+        for chunk in iter(lambda: list(islice(files, chunk_size)), []):
+            rows = [(file, row) for file, row in zip(chunk, map(result_row, read_result_files(chunk)))
+                    if row is not None]
+            df = DataFrame([row for _, row in rows], columns=RESULT_COLUMNS).set_index("game_name")
+            added += self.add_frame(df, [file for file, _ in rows])
+            if mtimes is not None:
+                self.mtimes.update((file, mtimes[file]) for file in chunk)
+        return added
+
+    def add_result_dir(self, result_dir: str,
+                       chunk_size: int = chunk_size_for_memory(DEFAULT_MAX_MEMORY)) -> int:
+        """
+        Add games from the result dir that haven't been added yet.
+
+        :returns: number of added games
+        """
+        files = [os.path.abspath(file) for file in glob.glob(f"{result_dir}/*/result.json")]
+        mtimes = stat_result_files(files)
+
+        # read files are skipped without reading them, unless they have changed
+        changed = [file for file in files if file in self.games
+                   and self.mtimes.get(file) != mtimes[file]]
+        if changed:
+            logger.warning(f"{len(changed)} results have changed since they were added, "
+                           f"computing stats of all games anew")
+            # games of other result dirs are added again first, in the order they were read
+            in_dir = set(files)
+            other_files = [file for file in self.mtimes if file not in in_dir and exists(file)]
+            self.reset()
+            mtimes.update(stat_result_files(other_files))
+            files = other_files + files
+
+        files = [file for file in files if self.mtimes.get(file) != mtimes[file]]
+        return self.add_result_files(files, chunk_size, mtimes)
+
+    def reset(self) -> None:
+        """
+        Forget all games, keeping the initial elos.
+        """
+        initial_elos = self.initial_elos
+        self.__init__(None if initial_elos is None else Series(initial_elos))
+
+    def compact(self) -> None:
+        """
+        Move game times of games added one by one to a chunk.
+        """
+        if not self.winner_times:
+            return
+        for times, chunks in ((self.winner_times, self.winner_time_chunks),
+                              (self.loser_times, self.loser_time_chunks)):
+            game_names, bots, races, game_times = zip(*times)
+            chunks.append(time_chunk(game_names, bots, races, game_times))
+            times.clear()
+
+    def rate(self, winner: str, loser: str) -> None:
+        # same as calc_elo, for a single game
+        self.ratings[winner], self.ratings[loser] = rate_1vs1(self.ratings.get(winner, INITIAL),
+                                                              self.ratings.get(loser, INITIAL))
+
+    def wintimes(self) -> DataFrame:
+        bots = pd.Index(sorted(self.bots))
+        return DataFrame(counter_matrix(self.wins, bots, bots).astype(np.float64),
+                         index=bots, columns=bots)
+
+    def bot_races(self) -> Series:
+        # the first race of a bot among winners, then among losers
+        races = dict(self.winner_races)
+        for bot, race in self.loser_races.items():
+            races.setdefault(bot, race)
+        ser_bot_races = Series(races, name='race')
+        ser_bot_races.index.name = 'bot'
+        return ser_bot_races
+
+    def stats(self):
+        """
+        :returns: the same tables as `calc_stats`
+        """
+        df_wintimes = self.wintimes()
+
+        # Win rate
+        df_rr_winrate = (df_wintimes / (df_wintimes + df_wintimes.transpose()))
+        ser_overall_winrate = (
+            df_wintimes.sum(axis=1) /
+            (df_wintimes + df_wintimes.transpose()).sum(axis=1)
+        ).sort_values(ascending=False)
+
+        # Game times
+        self.compact()
+        df_gametimes = pd.concat(self.winner_time_chunks + self.loser_time_chunks
+                                 or [DataFrame(columns=GAME_TIME_COLUMNS)]) \
+            .astype({'bot': object, 'race': object}) \
+            .set_index('game_name')
+
+        # Map winning rates, missing wins or losses make the rate undefined as in calc_stats
+        maps, bots = pd.Index(sorted(self.maps)), pd.Index(sorted(self.bots))
+        map_wins = counter_matrix(self.map_wins, maps, bots).astype(np.float64)
+        map_losses = counter_matrix(self.map_losses, maps, bots).astype(np.float64)
+        map_wins[map_wins == 0] = np.nan
+        map_losses[map_losses == 0] = np.nan
+        ser_maps = Series((map_wins / (map_wins + map_losses)).ravel(),
+                          index=pd.MultiIndex.from_product([list(maps), list(bots)]))
+        ser_maps.name = 'win_rate'
+
+        # Race win times
+        ser_bot_races = self.bot_races()
+        df_race_wintimes = counter_table(self.race_wins, 'winner_race', 'loser_race')
+        races = set(ser_bot_races.unique())
+        for missing_race in sorted(races - set(df_race_wintimes.columns)):
+            df_race_wintimes[missing_race] = 0
+        for missing_race in sorted(races - set(df_race_wintimes.index)):
+            df_race_wintimes.loc[missing_race] = Series({race: 0 for race in races})
+
+        # Each bot winrates against each race
+        df_botrace_wintimes = counter_table(self.bot_race_wins, 'winner', 'loser_race').fillna(0)
+        df_botrace_losetimes = counter_table(self.bot_race_losses, 'loser', 'winner_race').fillna(0)
+        df_botrace_winrate = df_botrace_wintimes / (df_botrace_wintimes + df_botrace_losetimes)
+
+        ser_elos = Series(self.ratings, name="elo")
+
+        return df_rr_winrate, \
+               ser_overall_winrate, \
+               df_gametimes, \
+               df_race_wintimes, \
+               df_botrace_winrate, \
+               ser_maps, \
+               ser_bot_races, \
+               ser_elos
+
+    def save(self, path: str) -> None:
+        self.compact()
+        # write a new file and replace the old one, so that it is never left half written
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "wb") as f:
+            pickle.dump(self, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+
+    @staticmethod
+    def load(path: str, ser_round_robin_elos: Optional[Series] = None) -> 'StatsAggregator':
+        """
+        Load saved state, or start anew if there is none
+        or it was computed from different initial elos.
+        """
+        initial_elos = None if ser_round_robin_elos is None else dict(ser_round_robin_elos.items())
+        if exists(path):
+            with open(path, "rb") as f:
+                aggregator = pickle.load(f)
+            if getattr(aggregator, "version", 1) != StatsAggregator.STATE_VERSION:
+                logger.warning(f"Stats in {path} have an old format, not using them")
+            elif aggregator.initial_elos == initial_elos:
+                logger.info(f"Resuming stats of {len(aggregator.games)} games from {path}")
+                return aggregator
+            else:
+                logger.warning(f"Initial elos have changed, not using stats from {path}")
+
+        return StatsAggregator(ser_round_robin_elos)
+
+
+def counter_matrix(counter: Counter, rows: pd.Index, columns: pd.Index) -> np.ndarray:
+    """
+    Counts of (row, column) label pairs as a matrix over the given labels.
+    """
+    if not counter:
+        return np.zeros((len(rows), len(columns)), dtype=np.int64)
+    row_labels, column_labels = zip(*counter.keys())
+    return count_matrix(rows.get_indexer(row_labels), columns.get_indexer(column_labels),
+                        len(rows), len(columns),
+                        np.fromiter(counter.values(), dtype=np.int64, count=len(counter)))
+
+
+def counter_table(counter: Counter, index: str, columns: str) -> DataFrame:
+    # same shape as a pivot table of the counted games: sorted labels, NaN for no games
+    rows = pd.Index(sorted({row for row, _ in counter}), name=index)
+    columns = pd.Index(sorted({column for _, column in counter}), name=columns)
+    counts = counter_matrix(counter, rows, columns)
+    return DataFrame(present_counts(counts, np.arange(len(rows)), np.arange(len(columns))),
+                     index=rows, columns=columns)
+
+
+def update_counter(counter: Counter, df: DataFrame, columns: List[str]) -> None:
+    counter.update(df.groupby(columns, sort=False).size().to_dict())
+
+
+def time_chunk(game_names, bots, races, game_times) -> DataFrame:
+    return DataFrame({'game_name': list(game_names),
+                      'bot': pd.Categorical(list(bots)),
+                      'race': pd.Categorical(list(races)),
+                      'game_time': np.asarray(game_times, dtype=np.float64)},
+                     columns=GAME_TIME_COLUMNS)
+
+
+def calc_stats_chunked(result_dirs: List[str], ser_round_robin_elos: Optional[Series],
+                       max_memory: int = DEFAULT_MAX_MEMORY):
+    """
+    Same as `calc_stats` over the results of all the result dirs,
+    processed in chunks that take at most about `max_memory` MB.
+    """
+    aggregator = StatsAggregator(ser_round_robin_elos)
+    chunk_size = chunk_size_for_memory(max_memory)
+    for result_dir in result_dirs:
+        aggregator.add_result_dir(result_dir, chunk_size)
+    return aggregator.stats()
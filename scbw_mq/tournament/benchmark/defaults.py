@@ -0,0 +1,10 @@
+import os
+
+# Defaults of benchmark command line options. They live apart from the modules
+# that use them, so that building the parsers doesn't import pandas or matplotlib.
+
+# Memory in MB that processing a chunk of results may take.
+DEFAULT_MAX_MEMORY = 512
+
+# Plots of big tournaments take a few seconds each, so a handful of workers is enough.
+DEFAULT_PLOT_WORKERS = min(4, os.cpu_count() or 1)
@@ -0,0 +1,73 @@
+from typing import Dict, Tuple
+
+import numpy as np
+from pandas import DataFrame, Index, Series
+
+# Elo configuration of benchmarks
+K_FACTOR = 20
+BETA = 200
+INITIAL = 2000
+
+
+def expect(rating: float, other_rating: float, beta: float = BETA) -> float:
+    """
+    Expected score of the first rating against the other one,
+    computed the same way as `elo.Elo.expect` to give identical ratings.
+    """
+    return 1. / (1 + 10 ** ((other_rating - rating) / (2 * beta)))
+
+
+def rate_1vs1(winner_rating: float, loser_rating: float,
+              k_factor: float = K_FACTOR, beta: float = BETA) -> Tuple[float, float]:
+    return (winner_rating + k_factor * (1. - expect(winner_rating, loser_rating, beta)),
+            loser_rating + k_factor * (0. - expect(loser_rating, winner_rating, beta)))
+
+
+def rate_games(winners: np.ndarray, losers: np.ndarray, ratings: np.ndarray,
+               k_factor: float = K_FACTOR, beta: float = BETA) -> np.ndarray:
+    """
+    Update ratings by games played one after another.
+
+    :param winners: index of the winner of each game into ratings
+    :param losers: index of the loser of each game into ratings
+    :param ratings: initial rating of each bot
+    :returns: new ratings
+    """
+    # Each game depends on the previous ones, so the games are walked in a loop.
+    # Plain floats and ints are much faster to work with one by one than numpy scalars.
+    values = np.asarray(ratings, dtype=np.float64).tolist()
+    f_factor = 2 * beta
+    for winner, loser in zip(np.asarray(winners).tolist(), np.asarray(losers).tolist()):
+        winner_rating = values[winner]
+        loser_rating = values[loser]
+        values[winner] = winner_rating + k_factor * (
+            1. - 1. / (1 + 10 ** ((loser_rating - winner_rating) / f_factor)))
+        values[loser] = loser_rating + k_factor * (
+            0. - 1. / (1 + 10 ** ((winner_rating - loser_rating) / f_factor)))
+
+    return np.array(values, dtype=np.float64)
+
+
+def encode_bots(bots: Index, names: Series) -> np.ndarray:
+    codes = bots.get_indexer(names)
+    if (codes < 0).any():
+        missing = set(names[codes < 0])
+        raise KeyError(f"Bots {missing} have no initial rating")
+    return codes
+
+
+def calc_elo(ratings: Dict[str, float], df_game_results: DataFrame,
+             k_factor: float = K_FACTOR, beta: float = BETA) -> Series:
+    """
+    Rate bots by game results, in the order of the results.
+
+    :param ratings: initial rating of each bot that played
+    """
+    bots = Index(list(ratings))
+    winners = encode_bots(bots, df_game_results['winner'])
+    losers = encode_bots(bots, df_game_results['loser'])
+
+    values = rate_games(winners, losers, np.fromiter(ratings.values(), dtype=np.float64,
+                                                     count=len(ratings)),
+                        k_factor, beta)
+    return Series(values, index=bots, name="elo")
@@ -0,0 +1,317 @@
+import logging
+import shutil
+import sys
+import uuid
+from argparse import Namespace
+from datetime import timedelta
+from os.path import exists, basename, dirname
+from typing import Dict, List, Optional, Set
+
+import pandas as pd
+from pika import ConnectionParameters, PlainCredentials
+from scbw.player import check_bot_exists
+from tqdm import tqdm
+
+from .aggregator import StatsAggregator, chunk_size_for_memory
+from .factory import retrieve_benchmark
+from .plots import plot_overall_results, plot_bot_results
+from .sequential import Matchup, create_stop_rule
+from .storage import BenchmarkException, RerunningBenchmarkException, LocalBenchmarkStorage
+from .storage import SscaitBenchmarkStorage
+from ..consumer import DELAY_QUEUE, PlayConsumer
+from ..events import FAILED, FINISHED, ProgressTracker, ProgressWatcher, read_result
+from ..message import PlayMessage
+from ..producer import ProducerConfig
+from ..producer import check_empty_game_dir, launch_producer, play_properties, prepare_tournament
+from ..schedule import OneVsAllSchedule, random_seed
+from ...rabbitmq_publisher import ConfirmPublisher
+from ...rabbitmq_publisher import DEFAULT_WINDOW, DEFAULT_BATCH_SIZE, DEFAULT_MAX_RETRIES
+
+logger = logging.getLogger(__name__)
+logging.getLogger('requests').setLevel(logging.CRITICAL)
+logging.getLogger('pika').setLevel(logging.CRITICAL)
+
+# Stop waiting for games when no game has been played for this many seconds
+# and no game waits in the queues.
+IDLE_TIMEOUT = 600.
+
+
+class BenchmarkConfig(Namespace):
+    # rabbit connection
+    host: str
+    port: int
+    user: str
+    password: str
+
+    benchmark: str
+    base_dir: str
+    test_bot_dir: Optional[str]
+
+    results_only: bool
+    stats_memory: int
+    no_plots: bool
+    plot_workers: int
+
+    # games of higher priority overtake waiting games of other tournaments
+    priority: int
+
+    # order by durations of earlier games
+    durations_from: Optional[List[str]]
+    workers: int
+
+    # adaptive one-vs-all benchmark
+    adaptive: Optional[str]
+    margin: float
+    error: float
+    ci_width: float
+
+
+def create_connection_params(args: BenchmarkConfig) -> ConnectionParameters:
+    return ConnectionParameters(host=args.host, port=args.port,
+                                credentials=PlainCredentials(args.user, args.password))
+
+
+def stalled(watcher: ProgressWatcher, progress: ProgressTracker) -> bool:
+    """
+    Consumers reject some messages without an event, e.g. those they cannot decode,
+    their games would be waited for forever.
+    """
+    return progress.idle > IDLE_TIMEOUT \
+           and watcher.pending_messages((PlayConsumer.QUEUE, DELAY_QUEUE)) == 0
+
+
+def wait_until_benchmark_finished(watcher: ProgressWatcher, total_games: int,
+                                  tournament: str, game_names: Set[str]):
+    logger.info("Please wait until all games are finished.")
+    logger.info("Don't forget to launch tournament consumers.")
+    logger.info("This can take several hours, please be patient.")
+
+    progress = ProgressTracker(total_games, tournament, game_names)
+    bar = tqdm(total=total_games, unit="game")
+
+    for event in watcher.events():
+        if event is not None:
+            progress.update(event)
+            bar.update(progress.done - bar.n)
+        bar.set_postfix(progress.summary(), refresh=True)
+        if progress.finished:
+            break
+        if event is None and stalled(watcher, progress):
+            logger.warning(f"No game has been played for {IDLE_TIMEOUT:.0f}s and none "
+                           f"is waiting, {total_games - progress.done} games were lost.")
+            break
+
+    bar.close()
+    logger.info(f"{len(progress.completed)} games finished, {len(progress.failed)} failed, "
+                f"in {timedelta(seconds=int(progress.elapsed))}.")
+    watcher.close()
+
+
+def publish_games(args: BenchmarkConfig, games: List[PlayMessage]) -> None:
+    publisher = ConfirmPublisher(create_connection_params(args),
+                                 properties=play_properties(args.priority))
+    publisher.publish(game.serialize() for game in games)
+
+
+def play_adaptive_benchmark(args: BenchmarkConfig, producer_args: ProducerConfig,
+                            watcher: ProgressWatcher) -> None:
+    """
+    Play the test bot against each opponent in waves of one repetition over all maps,
+    until a sequential test decides the matchup or all repetitions are played.
+    The next wave of an opponent is published as soon as its previous wave is finished.
+    """
+    bots, maps = prepare_tournament(producer_args)
+    check_empty_game_dir(producer_args.game_dir)
+    test_bot = producer_args.test_bot
+    repeat_games = producer_args.repeat_games
+    schedule = OneVsAllSchedule(test_bot, bots, maps, repeat_games, random_seed())
+    stop_rule = create_stop_rule(args.adaptive, args.margin, args.error, args.ci_width)
+
+    # game names are those of the full one-vs-all schedule, given by the opponent's position
+    matchups = {index: Matchup(bot) for index, bot in enumerate(bots) if bot != test_bot}
+    game_matchups: Dict[str, int] = {}
+    game_names: Set[str] = set()
+
+    def next_wave(index: int) -> List[PlayMessage]:
+        matchup = matchups[index]
+        first = (matchup.waves * len(bots) + index) * len(maps)
+        games = [schedule.game(first + i) for i in range(len(maps))]
+        for game in games:
+            game.tournament = producer_args.tournament
+        matchup.start_wave([game.game_name for game in games])
+        game_matchups.update((game.game_name, index) for game in games)
+        game_names.update(game.game_name for game in games)
+        return games
+
+    max_games = len(matchups) * len(maps) * repeat_games
+    logger.info(f"Playing at most {max_games} games in waves of {len(maps)} games "
+                f"per opponent, stopping by {args.adaptive}")
+    publish_games(args, [game for index in matchups for game in next_wave(index)])
+
+    progress = ProgressTracker(max_games, producer_args.tournament, game_names)
+    bar = tqdm(total=max_games, unit="game")
+    for event in watcher.events():
+        if event is None:
+            if stalled(watcher, progress):
+                logger.warning(f"No game has been played for {IDLE_TIMEOUT:.0f}s and none "
+                               f"is waiting, {len(game_matchups)} games were lost.")
+                break
+            continue
+        if not progress.update(event):
+            continue
+
+        waves = []
+        if event.kind in (FINISHED, FAILED) and event.game_name in game_matchups:
+            index = game_matchups.pop(event.game_name)
+            matchup = matchups[index]
+            result = None
+            if event.kind == FINISHED:
+                result = read_result(producer_args.game_dir, event.game_name)
+            matchup.add_result(event.game_name, test_bot, result)
+            bar.update(1)
+
+            if matchup.wave_done():
+                matchup.decision = stop_rule.decide(matchup.wins, matchup.losses)
+                if matchup.decision is None and matchup.waves < repeat_games:
+                    waves = next_wave(index)
+                else:
+                    logger.info(f"Matchup {matchup}")
+
+        if waves:
+            publish_games(args, waves)
+        if not game_matchups:
+            break
+
+    bar.close()
+    watcher.close()
+    played = sum(matchup.played for matchup in matchups.values())
+    decided = sum(matchup.decision is not None for matchup in matchups.values())
+    logger.info(f"Played {played} of {max_games} games, "
+                f"{decided} of {len(matchups)} matchups were decided early.")
+
+
+def launch_benchmark(args: BenchmarkConfig):
+    # you can add custom benchmark storages here
+    benchmark_storages = (
+        LocalBenchmarkStorage(args.base_dir),
+        SscaitBenchmarkStorage(args.base_dir),)
+    benchmark = retrieve_benchmark(args.benchmark, benchmark_storages)
+
+    test_bot = None
+    test_bot_dir = None
+    if args.test_bot_dir is not None:
+        test_bot, test_bot_dir = basename(args.test_bot_dir), dirname(args.test_bot_dir)
+
+    if args.adaptive is not None and test_bot is None:
+        raise BenchmarkException("Adaptive benchmark needs a test bot, see --test_bot_dir")
+
+    if not args.results_only:
+        if not benchmark.has_results():
+            if test_bot is not None:
+                # test bot checks
+                check_bot_exists(test_bot, test_bot_dir)
+                if exists(f"{benchmark.bot_dir}/{test_bot}"):
+                    raise BenchmarkException(
+                        f"Bot '{test_bot}' is listed in benchmark bots in '{benchmark.bot_dir}'")
+
+                shutil.copytree(args.test_bot_dir, f"{benchmark.bot_dir}/{test_bot}")
+
+            producer_args = ProducerConfig(
+                host=args.host,
+                port=args.port,
+                user=args.user,
+                password=args.password,
+
+                bot_file=benchmark.bot_file,
+                map_file=benchmark.map_file,
+                test_bot=test_bot,
+                repeat_games=benchmark.repeat_games,
+
+                bot_dir=benchmark.bot_dir,
+                map_dir=benchmark.map_dir,
+                game_dir=benchmark.result_dir,
+
+                publish_window=DEFAULT_WINDOW,
+                publish_batch_size=DEFAULT_BATCH_SIZE,
+                publish_retries=DEFAULT_MAX_RETRIES,
+                wire_format="json",
+                games_per_message=1,
+                priority=args.priority,
+                tournament=uuid.uuid4().hex,
+
+                seed=None,
+                shards=1,
+                shard=0,
+                checkpoint_file=None,
+                round_workers=0,
+
+                durations_from=args.durations_from,
+                workers=args.workers
+            )
+
+            # subscribe before publishing, so that no game event is missed
+            watcher = ProgressWatcher(create_connection_params(args))
+
+            try:
+                if args.adaptive is not None:
+                    play_adaptive_benchmark(args, producer_args, watcher)
+                else:
+                    # create all producer messages
+                    logger.info("Publishing games to queue...")
+                    game_names = set()
+                    total_messages = launch_producer(producer_args, game_names)
+                    logger.info(f"Published {total_messages} games.")
+
+                    wait_until_benchmark_finished(watcher, total_messages,
+                                                  producer_args.tournament, game_names)
+            except KeyboardInterrupt:
+                logger.warning("Keyboard interrupt caught, cancellig benchmark wait")
+                logger.info("You can rerun plotting benchmark results with --results_only flag")
+                sys.exit(1)
+
+        else:
+            logger.warning(f"Results directory {benchmark.result_dir} is not empty.")
+            logger.warning(f"Please truncate it's contents to prevent overwriting results.")
+            logger.warning(f"Will not launch benchmarking, but can process results.")
+            logger.info("Would you like to continue to process results? [Y/n]")
+            ans = input()
+            if not (ans == "y" or ans == "Y" or ans == ""):
+                logger.warning("Aborting.")
+                sys.exit(1)
+
+    ser_elos = None
+    if exists(benchmark.elo_file):
+        ser_elos = pd.read_csv(benchmark.elo_file, names=["bot", "rating"],
+                               index_col="bot", squeeze=True)
+
+    # continue from the stats of previously processed results
+    aggregator = StatsAggregator.load(benchmark.stats_file, ser_elos)
+
+    logger.info("Processing results...")
+    n_added = aggregator.add_result_dir(benchmark.result_dir,
+                                        chunk_size_for_memory(args.stats_memory))
+    logger.info(f"Processed {n_added} new games.")
+    aggregator.save(benchmark.stats_file)
+
+    logger.info("Calculating stats")
+    df_rr_winrate, \
+    ser_overall_winrate, \
+    df_gametimes, \
+    df_race_wintimes, \
+    df_botrace_winrate, \
+    ser_maps, \
+    ser_bot_races, \
+    ser_elos = aggregator.stats()
+
+    if args.no_plots:
+        logger.info("Saving stats")
+    else:
+        logger.info("Creating plots and saving stats")
+    if test_bot is None:
+        plot_overall_results(ser_overall_winrate, df_race_wintimes, df_gametimes,
+                             ser_bot_races, ser_maps, ser_elos,
+                             not args.no_plots, args.plot_workers)
+    else:
+        plot_bot_results(test_bot, df_rr_winrate, ser_overall_winrate, df_botrace_winrate,
+                         ser_maps, ser_elos,
+                         not args.no_plots, args.plot_workers)
@@ -1,302 +1,249 @@
 import logging
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
 
-import matplotlib.pyplot as plt
 import pandas as pd
 from pandas import DataFrame, Series
 
+from .defaults import DEFAULT_PLOT_WORKERS
 from .stats import save_stats
 
 logger = logging.getLogger(__name__)
 
 base_dir = "."
 
-
-def plot_rr_overall_winrates(ser_overall_winrate: Series):
-    plt.figure()
-    bot_winrates = ser_overall_winrate.sort_values(ascending=False)
-    ax = bot_winrates.plot(
-        kind="bar",
-        figsize=(ser_overall_winrate.shape[0] / 4, 6),
-        title=f"Win rates of tournament bots",
-        ylim=(0, 1.1),
-        color="#8B96D0"
-    )
-    ax.set_xlabel("Bot name")
-    ax.set_ylabel("Win rate")
-    fig = ax.get_figure()
-    fig.tight_layout()
-
-    for p in ax.patches:
-        ax.annotate("%.2f" % p.get_height(),
+BAR_COLOR = "#8B96D0"
+HIGHLIGHT_COLOR = "#ff0000"
+
+
+class PlotJob:
+    """
+    One plot of a benchmark report.
+
+    Stats are prepared in the main process and saved as `{name}.csv`,
+    the figure is drawn by `draw(fig, data, **options)` into `{name}.pdf`,
+    possibly in another process.
+    """
+    name: str
+    stats: DataFrame
+    draw: Callable
+    data: object
+    figsize: Tuple[float, float]
+    options: dict
+
+    def __init__(self, name, stats, draw, data, figsize, **options):
+        self.name = name
+        self.stats = stats
+        self.draw = draw
+        self.data = data
+        self.figsize = figsize
+        self.options = options
+
+
+def annotate_bars(ax, labels: Iterable[str]):
+    for p, label in zip(ax.patches, labels):
+        ax.annotate(label,
                     (p.get_x() + p.get_width() / 2., 0.01),
                     ha='center', va='bottom', xytext=(0, 10), textcoords='offset points',
                     rotation=90)
-    fig.savefig(f"{base_dir}/rr_overall_winrates.pdf")
-    save_stats(rr_overall_winrates=DataFrame(bot_winrates))
 
 
-def plot_rr_elos(ser_elos: Series):
-    plt.figure()
-    ser_elos = ser_elos.sort_values(ascending=False)
-    ax = ser_elos.plot(
-        kind="bar",
-        figsize=(len(ser_elos) / 4, 5),
-        title=f"Elo ratings of tournament bots",
-        ylim=(0, ser_elos.max()),
-        color="#8B96D0"
-    )
-    ax.set_xlabel("Bot name")
-    ax.set_ylabel("Elo rating")
-    for p, patch_bot in zip(ax.patches, ser_elos.index.tolist()):
-        ax.annotate("%.2f" % p.get_height(),
-                    (p.get_x() + p.get_width() / 2., 0.01),
-                    ha='center', va='bottom', xytext=(0, 10), textcoords='offset points',
-                    rotation=90)
+def draw_bars(fig, data: Series, title: str, xlabel: str, ylabel: str, ylim,
+              label_format: str = "%.2f", labels: Optional[List[str]] = None,
+              highlight: Optional[str] = None, rot: Optional[int] = None):
+    ax = fig.add_subplot(1, 1, 1)
+    data.plot(kind="bar", ax=ax, title=title, ylim=ylim, color=BAR_COLOR, rot=rot)
+    ax.set_xlabel(xlabel)
+    ax.set_ylabel(ylabel)
+
+    heights = [label_format % p.get_height() for p in ax.patches]
+    if labels is not None:
+        heights = [f"{height} {label}" for height, label in zip(heights, labels)]
+    annotate_bars(ax, heights)
+
+    if highlight is not None:
+        ax.patches[data.index.get_loc(highlight)].set_facecolor(HIGHLIGHT_COLOR)
+
+
+def draw_boxes(fig, data: DataFrame, title: str, xlabel: str, ylabel: str):
+    ax = fig.add_subplot(1, 1, 1)
+    data.plot(kind="box", ax=ax, rot=90, grid=True)
+    ax.set_title(title)
+    ax.set_xlabel(xlabel)
+    ax.set_ylabel(ylabel)
+
+
+def init_plot_worker():
+    # workers never open windows, and must not pick an interactive backend
+    import matplotlib
+    matplotlib.use("Agg")
+
 
-    fig = ax.get_figure()
+def render_plot(job: PlotJob, out_dir: str) -> float:
+    """
+    Draw the plot on its own figure, without the global state of pyplot.
+
+    :returns: render time in seconds
+    """
+    from matplotlib.figure import Figure
+
+    start = time.perf_counter()
+    fig = Figure(figsize=job.figsize)
+    job.draw(fig, job.data, **job.options)
     fig.tight_layout()
-    fig.savefig(f"{base_dir}/rr_elos.pdf")
-    save_stats(rr_elos=DataFrame(ser_elos))
+    fig.savefig(f"{out_dir}/{job.name}.pdf")
+    return time.perf_counter() - start
+
+
+def render_plots(jobs: List[PlotJob], out_dir: str = base_dir,
+                 n_workers: int = DEFAULT_PLOT_WORKERS) -> Dict[str, float]:
+    """
+    :returns: render time of each plot
+    """
+    start = time.perf_counter()
+    if n_workers <= 1:
+        init_plot_worker()
+        times = {job.name: render_plot(job, out_dir) for job in jobs}
+    else:
+        with ProcessPoolExecutor(max_workers=n_workers, initializer=init_plot_worker) as pool:
+            futures = {job.name: pool.submit(render_plot, job, out_dir) for job in jobs}
+            times = {name: future.result() for name, future in futures.items()}
+
+    for name, render_time in times.items():
+        logger.info(f"Rendered {out_dir}/{name}.pdf in {render_time:.2f}s")
+    logger.info(f"Rendered {len(jobs)} plots in {time.perf_counter() - start:.2f}s "
+                f"with {n_workers} workers")
+    return times
+
+
+def export_results(jobs: List[PlotJob], plots: bool = True,
+                   n_workers: int = DEFAULT_PLOT_WORKERS):
+    """
+    Save stats of all plots as csv files and, unless plots are disabled, render the plots.
+    Matplotlib is not imported at all without plots.
+    """
+    for job in jobs:
+        save_stats(**{job.name: job.stats})
+    if plots:
+        render_plots(jobs, base_dir, n_workers)
+
+
+def rr_overall_winrates_job(ser_overall_winrate: Series) -> PlotJob:
+    bot_winrates = ser_overall_winrate.sort_values(ascending=False)
+    return PlotJob("rr_overall_winrates", DataFrame(bot_winrates), draw_bars, bot_winrates,
+                   (ser_overall_winrate.shape[0] / 4, 6),
+                   title=f"Win rates of tournament bots",
+                   xlabel="Bot name", ylabel="Win rate", ylim=(0, 1.1))
+
+
+def rr_elos_job(ser_elos: Series) -> PlotJob:
+    ser_elos = ser_elos.sort_values(ascending=False)
+    return PlotJob("rr_elos", DataFrame(ser_elos), draw_bars, ser_elos,
+                   (len(ser_elos) / 4, 5),
+                   title=f"Elo ratings of tournament bots",
+                   xlabel="Bot name", ylabel="Elo rating", ylim=(0, ser_elos.max()))
 
 
-def plot_rr_race_winrates(df_race_wintimes):
+def rr_race_winrates_job(df_race_wintimes: DataFrame) -> PlotJob:
     race_winrates = df_race_wintimes.sum(axis=1) / \
                     (df_race_wintimes + df_race_wintimes.transpose()).sum(axis=1)
+    return PlotJob("rr_race_winrates", DataFrame(race_winrates), draw_bars,
+                   race_winrates.sort_values(ascending=False), (5, 3),
+                   title=f"Win rates of tournament races",
+                   xlabel="", ylabel="Win rate", ylim=(0, 1.1))
 
-    plt.figure()
-    ax = race_winrates.sort_values(ascending=False).plot(
-        kind="bar",
-        figsize=(5, 3),
-        title=f"Win rates of tournament races",
-        ylim=(0, 1.1),
-        color="#8B96D0"
-    )
-    ax.set_ylabel("Win rate")
-    ax.set_xlabel("")
-    for p in ax.patches:
-        ax.annotate("%.2f" % p.get_height(),
-                    (p.get_x() + p.get_width() / 2., 0.01),
-                    ha='center', va='bottom', xytext=(0, 10), textcoords='offset points',
-                    rotation=90)
-    fig = ax.get_figure()
-    fig.tight_layout()
-    fig.savefig(f"{base_dir}/rr_race_winrates.pdf")
-    save_stats(rr_race_winrates=DataFrame(race_winrates))
 
-
-def plot_rr_race_counts(ser_races: Series):
+def rr_race_counts_job(ser_races: Series) -> PlotJob:
     race_counts = ser_races.groupby(ser_races).count().sort_values(ascending=False)
-    plt.figure()
-    ax = race_counts.plot(
-        kind="bar",
-        figsize=(5, 3),
-        title=f"Number of tournament bots that use given race",
-        ylim=(0, race_counts.max()),
-        color="#8B96D0"
-    )
-    ax.set_xlabel("")
-    ax.set_ylabel("")
-
-    for p in ax.patches:
-        ax.annotate("%d" % p.get_height(),
-                    (p.get_x() + p.get_width() / 2., 0.01),
-                    ha='center', va='bottom', xytext=(0, 10), textcoords='offset points',
-                    rotation=90)
-    fig = ax.get_figure()
-    fig.tight_layout()
-    fig.savefig(f"{base_dir}/rr_race_counts.pdf")
-    save_stats(rr_race_counts=DataFrame(race_counts))
+    return PlotJob("rr_race_counts", DataFrame(race_counts), draw_bars, race_counts, (5, 3),
+                   title=f"Number of tournament bots that use given race",
+                   xlabel="", ylabel="", ylim=(0, race_counts.max()), label_format="%d")
 
 
-def plot_rr_game_times(df_gametimes: DataFrame):
-    plt.figure()
-    df2 = pd.DataFrame({col: vals['game_time'] for col, vals in df_gametimes.groupby(["bot"])})
+def rr_game_times_job(df_gametimes: DataFrame) -> PlotJob:
+    df2 = pd.DataFrame({col: vals['game_time'] for col, vals in df_gametimes.groupby("bot")})
     meds = df2.median()
     meds.sort_values(ascending=False, inplace=True)
     df2 = df2[meds.index]
-    ax = df2.plot(
-        kind="box",
-        figsize=(df2.shape[1] / 4, 7),
-        rot=90,
-        grid=True
-    )
-    ax.set_title("Real-life time durations of play sorted by median times")
-    ax.set_xlabel("Bot name")
-    ax.set_ylabel("Time [sec]")
-    fig = ax.get_figure()
-    fig.tight_layout()
-    fig.savefig(f"{base_dir}/rr_times.pdf")
-    save_stats(rr_times=df2)
+    return PlotJob("rr_times", df2, draw_boxes, df2, (df2.shape[1] / 4, 7),
+                   title="Real-life time durations of play sorted by median times",
+                   xlabel="Bot name", ylabel="Time [sec]")
 
 
-def plot_rr_maps_winrates(ser_maps: Series):
+def rr_maps_winrates_job(ser_maps: Series) -> PlotJob:
     maps = ser_maps.index.get_level_values(level=0)
     best_bot_on_map = DataFrame(ser_maps).groupby(maps).apply(
-        lambda x: pd.Series([x['win_rate'].argmax()[1], x['win_rate'].max()],
+        lambda x: pd.Series([x['win_rate'].idxmax()[1], x['win_rate'].max()],
                             index=["bot", "score"]))
-    ax = best_bot_on_map.plot(
-        kind="bar",
-        figsize=(12, 6),
-        rot=90,
-        legend=None,
-        ylim=(0, 1.1),
-        color="#8B96D0"
-    )
-    ax.set_title("Best-scoring bots on each tournament map scenario")
-    ax.set_xlabel("Map name")
-    ax.set_ylabel("Win rate")
-    for p, bot in zip(ax.patches, best_bot_on_map['bot'].tolist()):
-        ax.annotate("%.2f %s" % (p.get_height(), bot),
-                    (p.get_x() + p.get_width() / 2., 0.01),
-                    ha='center', va='bottom', xytext=(0, 10), textcoords='offset points',
-                    rotation=90)
-    fig = ax.get_figure()
-    fig.tight_layout()
-    fig.savefig(f"{base_dir}/rr_maps.pdf")
-    save_stats(rr_maps=best_bot_on_map)
+    return PlotJob("rr_maps", best_bot_on_map, draw_bars,
+                   best_bot_on_map['score'].astype(float), (12, 6),
+                   title="Best-scoring bots on each tournament map scenario",
+                   xlabel="Map name", ylabel="Win rate", ylim=(0, 1.1), rot=90,
+                   labels=best_bot_on_map['bot'].tolist())
 
 
-def plot_bot_overall_winrates(bot: str, ser_overall_winrate: Series):
-    plt.figure()
+def bot_overall_winrates_job(bot: str, ser_overall_winrate: Series) -> PlotJob:
     bot_winrates = ser_overall_winrate.sort_values(ascending=False)
-    ax = bot_winrates.plot(
-        kind="bar",
-        figsize=(ser_overall_winrate.shape[0] / 4, 6),
-        title=f"Updated win rates after playing '{bot}' with tournament bots",
-        ylim=(0, 1.1),
-        color="#8B96D0"
-    )
-    ax.set_xlabel("Bot name")
-    ax.set_ylabel("Win rate")
-    fig = ax.get_figure()
-    fig.tight_layout()
+    return PlotJob("bot_overall_winrates", DataFrame(bot_winrates), draw_bars, bot_winrates,
+                   (ser_overall_winrate.shape[0] / 4, 6),
+                   title=f"Updated win rates after playing '{bot}' with tournament bots",
+                   xlabel="Bot name", ylabel="Win rate", ylim=(0, 1.1), highlight=bot)
 
-    for p in ax.patches:
-        ax.annotate("%.2f" % p.get_height(),
-                    (p.get_x() + p.get_width() / 2., 0.01),
-                    ha='center', va='bottom', xytext=(0, 10), textcoords='offset points',
-                    rotation=90)
 
-    pos = bot_winrates.index.get_loc(bot)
-    ax.patches[pos].set_facecolor('#ff0000')
-
-    fig.savefig(f"{base_dir}/bot_overall_winrates.pdf")
-    save_stats(bot_overall_winrates=DataFrame(bot_winrates))
-
-
-def plot_bot_rr_winrates(bot: str, df_rr_winrate: DataFrame):
-    plt.figure()
-    bots = set(df_rr_winrate.columns)
-    other_winrates = df_rr_winrate.loc[bot, bots - {bot}].sort_values(ascending=False)
-    ax = other_winrates.plot(
-        kind="bar",
-        figsize=(df_rr_winrate.shape[0] / 4, 5),
-        title=f"Win rate of bot '{bot}' against each opponent",
-        ylim=(0, 1.1),
-        color="#8B96D0"
-    )
-    ax.set_xlabel("Bot name")
-    ax.set_ylabel("Win rate")
-    for p in ax.patches:
-        ax.annotate("%.2f" % p.get_height(),
-                    (p.get_x() + p.get_width() / 2., 0.01),
-                    ha='center', va='bottom', xytext=(0, 10), textcoords='offset points',
-                    rotation=90)
-
-    fig = ax.get_figure()
-    fig.tight_layout()
-    fig.savefig(f"{base_dir}/bot_rr_winrates.pdf")
-    save_stats(bot_rr_winrates=DataFrame(other_winrates))
+def bot_rr_winrates_job(bot: str, df_rr_winrate: DataFrame) -> PlotJob:
+    others = [other for other in df_rr_winrate.columns if other != bot]
+    other_winrates = df_rr_winrate.loc[bot, others].sort_values(ascending=False)
+    return PlotJob("bot_rr_winrates", DataFrame(other_winrates), draw_bars, other_winrates,
+                   (df_rr_winrate.shape[0] / 4, 5),
+                   title=f"Win rate of bot '{bot}' against each opponent",
+                   xlabel="Bot name", ylabel="Win rate", ylim=(0, 1.1))
 
 
-def plot_bot_elos(bot: str, ser_elos: Series):
-    plt.figure()
+def bot_elos_job(bot: str, ser_elos: Series) -> PlotJob:
     ser_elos = ser_elos.sort_values(ascending=False)
-    ax = ser_elos.plot(
-        kind="bar",
-        figsize=(len(ser_elos) / 4, 5),
-        title=f"Updated elo ratings after playing '{bot}' with tournament bots",
-        ylim=(0, ser_elos.max()),
-        color="#8B96D0"
-    )
-    ax.set_xlabel("Bot name")
-    ax.set_ylabel("Elo rating")
-    for p, patch_bot in zip(ax.patches, ser_elos.index.tolist()):
-        ax.annotate("%.2f" % p.get_height(),
-                    (p.get_x() + p.get_width() / 2., 0.01),
-                    ha='center', va='bottom', xytext=(0, 10), textcoords='offset points',
-                    rotation=90)
+    return PlotJob("bot_elos", DataFrame(ser_elos), draw_bars, ser_elos,
+                   (len(ser_elos) / 4, 5),
+                   title=f"Updated elo ratings after playing '{bot}' with tournament bots",
+                   xlabel="Bot name", ylabel="Elo rating", ylim=(0, ser_elos.max()),
+                   highlight=bot)
 
-    pos = ser_elos.index.get_loc(bot)
-    ax.patches[pos].set_facecolor('#ff0000')
-
-    fig = ax.get_figure()
-    fig.tight_layout()
-    fig.savefig(f"{base_dir}/bot_elos.pdf")
-    save_stats(bot_elos=DataFrame(ser_elos))
 
-
-def plot_bot_race_winrates(bot: str, df_botrace_winrate: DataFrame):
-    plt.figure()
+def bot_race_winrates_job(bot: str, df_botrace_winrate: DataFrame) -> PlotJob:
     bot_races = df_botrace_winrate.loc[bot].sort_values(ascending=False)
-    ax = bot_races.plot(
-        kind="bar",
-        figsize=(5, 3),
-        title=f"Win rate of bot '{bot}' given a race",
-        ylim=(0, 1.1),
-        color="#8B96D0"
-    )
-    ax.set_ylabel("Win rate")
-    ax.set_xlabel("")
-    fig = ax.get_figure()
-    fig.tight_layout()
-
-    for p in ax.patches:
-        ax.annotate("%.2f" % p.get_height(),
-                    (p.get_x() + p.get_width() / 2., 0.01),
-                    ha='center', va='bottom', xytext=(0, 10), textcoords='offset points',
-                    rotation=90)
-    fig.savefig(f"{base_dir}/bot_races.pdf")
-    save_stats(bot_races=DataFrame(bot_races))
+    return PlotJob("bot_races", DataFrame(bot_races), draw_bars, bot_races, (5, 3),
+                   title=f"Win rate of bot '{bot}' given a race",
+                   xlabel="", ylabel="Win rate", ylim=(0, 1.1))
 
 
-def plot_bot_maps_winrates(bot, ser_maps):
-    plt.figure()
+def bot_maps_winrates_job(bot: str, ser_maps: Series) -> PlotJob:
     map_results = ser_maps.unstack(level=0).transpose()
     bot_maps = map_results.loc[:, bot]
-    ax = bot_maps.plot(
-        kind="bar",
-        figsize=(7, 6),
-        ylim=(0, 1.1),
-        title=f"Win rate of bot '{bot}' given a map",
-        color="#8B96D0")
-    ax.set_xlabel("Map name")
-    ax.set_ylabel("Win rate")
-    fig = ax.get_figure()
-    fig.tight_layout()
-    for p in ax.patches:
-        ax.annotate("%.2f" % p.get_height(),
-                    (p.get_x() + p.get_width() / 2., 0.01),
-                    ha='center', va='bottom', xytext=(0, 10), textcoords='offset points',
-                    rotation=90)
-    fig.savefig(f"{base_dir}/bot_maps.pdf")
-    save_stats(bot_maps=DataFrame(bot_maps))
+    return PlotJob("bot_maps", DataFrame(bot_maps), draw_bars, bot_maps, (7, 6),
+                   title=f"Win rate of bot '{bot}' given a map",
+                   xlabel="Map name", ylabel="Win rate", ylim=(0, 1.1))
 
 
 def plot_overall_results(ser_overall_winrate, df_race_wintimes, df_gametimes,
-                         ser_bot_races, ser_maps, ser_elos):
-    plot_rr_overall_winrates(ser_overall_winrate)
-    plot_rr_elos(ser_elos)
-    plot_rr_race_winrates(df_race_wintimes)
-    plot_rr_race_counts(ser_bot_races)
-    plot_rr_game_times(df_gametimes)
-    plot_rr_maps_winrates(ser_maps)
+                         ser_bot_races, ser_maps, ser_elos,
+                         plots: bool = True, n_workers: int = DEFAULT_PLOT_WORKERS):
+    export_results([
+        rr_overall_winrates_job(ser_overall_winrate),
+        rr_elos_job(ser_elos),
+        rr_race_winrates_job(df_race_wintimes),
+        rr_race_counts_job(ser_bot_races),
+        rr_game_times_job(df_gametimes),
+        rr_maps_winrates_job(ser_maps),
+    ], plots, n_workers)
 
 
 def plot_bot_results(bot: str, df_rr_winrate, ser_overall_winrate, df_botrace_winrate,
-                     ser_maps, ser_elos):
-    plot_bot_overall_winrates(bot, ser_overall_winrate)
-    plot_bot_elos(bot, ser_elos)
-    plot_bot_rr_winrates(bot, df_rr_winrate)
-    plot_bot_race_winrates(bot, df_botrace_winrate)
-    plot_bot_maps_winrates(bot, ser_maps)
+                     ser_maps, ser_elos,
+                     plots: bool = True, n_workers: int = DEFAULT_PLOT_WORKERS):
+    export_results([
+        bot_overall_winrates_job(bot, ser_overall_winrate),
+        bot_elos_job(bot, ser_elos),
+        bot_rr_winrates_job(bot, df_rr_winrate),
+        bot_race_winrates_job(bot, df_botrace_winrate),
+        bot_maps_winrates_job(bot, ser_maps),
+    ], plots, n_workers)
@@ -0,0 +1,127 @@
+import logging
+import math
+from typing import List, Optional, Set
+
+logger = logging.getLogger(__name__)
+
+STRONGER = "stronger"
+WEAKER = "weaker"
+EVEN = "even"
+
+STOP_RULES = ("sprt", "wilson")
+
+DEFAULT_MARGIN = 0.1
+DEFAULT_ERROR = 0.05
+DEFAULT_CI_WIDTH = 0.3
+
+
+class SprtTest:
+    """
+    Sequential probability ratio test of the win rate of the test bot against one opponent,
+    between win rates of 0.5 - margin and 0.5 + margin.
+
+    Games are played until the evidence crosses one of the bounds, which keeps
+    the rates of wrong decisions below alpha and beta.
+    """
+
+    def __init__(self, margin: float = DEFAULT_MARGIN,
+                 alpha: float = DEFAULT_ERROR, beta: float = DEFAULT_ERROR):
+        p0, p1 = 0.5 - margin, 0.5 + margin
+        self.win_llr = math.log(p1 / p0)
+        self.loss_llr = math.log((1 - p1) / (1 - p0))
+        self.upper = math.log((1 - beta) / alpha)
+        self.lower = math.log(beta / (1 - alpha))
+
+    def decide(self, wins: int, losses: int) -> Optional[str]:
+        llr = wins * self.win_llr + losses * self.loss_llr
+        if llr >= self.upper:
+            return STRONGER
+        if llr <= self.lower:
+            return WEAKER
+        return None
+
+
+def wilson_interval(wins: int, n: int, z: float = 1.96):
+    p = wins / n
+    denominator = 1 + z ** 2 / n
+    center = (p + z ** 2 / (2 * n)) / denominator
+    half_width = z * math.sqrt(p * (1 - p) / n + z ** 2 / (4 * n ** 2)) / denominator
+    return center - half_width, center + half_width
+
+
+class WilsonTest:
+    """
+    Plays games until the 95% Wilson interval of the win rate excludes 0.5,
+    or is narrower than the given width.
+    """
+
+    def __init__(self, width: float = DEFAULT_CI_WIDTH):
+        self.width = width
+
+    def decide(self, wins: int, losses: int) -> Optional[str]:
+        n = wins + losses
+        if n == 0:
+            return None
+        low, high = wilson_interval(wins, n)
+        if low > 0.5:
+            return STRONGER
+        if high < 0.5:
+            return WEAKER
+        if high - low <= self.width:
+            return EVEN
+        return None
+
+
+class Matchup:
+    """
+    Games of the test bot against one opponent, played in waves of one repetition
+    over all maps until the test decides or all repetitions are played.
+    """
+    opponent: str
+    wins: int
+    losses: int
+    played: int
+    waves: int
+    pending: Set[str]
+    decision: Optional[str]
+
+    def __init__(self, opponent: str):
+        self.opponent = opponent
+        self.wins = 0
+        self.losses = 0
+        self.played = 0
+        self.waves = 0
+        self.pending = set()
+        self.decision = None
+
+    def start_wave(self, game_names: List[str]) -> None:
+        self.waves += 1
+        self.pending.update(game_names)
+
+    def add_result(self, game_name: str, test_bot: str, result: Optional[dict]) -> None:
+        """
+        :param result: contents of the result.json of the game, None if it has failed
+        """
+        self.pending.discard(game_name)
+        self.played += 1
+        if result is None or result.get('winner') is None:
+            return
+        if result['winner'] == test_bot:
+            self.wins += 1
+        else:
+            self.losses += 1
+
+    def wave_done(self) -> bool:
+        return not self.pending
+
+    def __str__(self):
+        return f"{self.opponent}: {self.wins} wins, {self.losses} losses " \
+               f"in {self.waves} waves, {self.decision or 'undecided'}"
+
+
+def create_stop_rule(rule: str, margin: float, error: float, ci_width: float):
+    if rule == "sprt":
+        return SprtTest(margin, error, error)
+    if rule == "wilson":
+        return WilsonTest(ci_width)
+    raise ValueError(f"Unknown stop rule {rule}, expected one of {STOP_RULES}")
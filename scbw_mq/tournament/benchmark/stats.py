@@ -2,76 +2,119 @@ import csv
 import glob
 import json
 import logging
-from typing import Dict, Optional
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional
 
-import elo
 import numpy as np
 import pandas as pd
 from pandas import DataFrame, Series
 from tqdm import tqdm
 
+from .elo_engine import calc_elo, INITIAL
+
 logger = logging.getLogger(__name__)
 
-elo.WIN = 1.
-elo.DRAW = 0.5
-elo.LOSS = 0.
-elo.K_FACTOR = 20
-elo.INITIAL = 2000
-elo.BETA = 200
-
-
-def process_results(result_dir: str) -> DataFrame:
-    rows = {"game_name": [],
-            "map": [],
-            "winner": [],
-            "winner_race": [],
-            "loser": [],
-            "loser_race": [],
-            "game_time": []}
-
-    race = dict(
-        T="Terran",
-        Z="Zerg",
-        P="Protoss",
-        R="Random"
-    )
-
-    for file in tqdm(glob.glob(f"{result_dir}/*/result.json"), unit="game"):
-        with open(file, "r") as f:
-            info = json.load(f)
-
-        rows["game_name"].append(info["game_name"])
-        rows["map"].append(info["map"].replace("sscai/", ""))
-        rows["winner"].append(info['winner'])
-        rows["winner_race"].append(race[info['winner_race']])
-        rows["loser"].append(info['loser'])
-        rows["loser_race"].append(race[info['loser_race']])
-        rows["game_time"].append(info["game_time"])
-
-    return DataFrame(rows).set_index("game_name")
+RACES = dict(
+    T="Terran",
+    Z="Zerg",
+    P="Protoss",
+    R="Random"
+)
 
 
-def calc_stats(df: DataFrame, ser_round_robin_elos: Optional[Series]):
-    # helper col
-    df['one'] = 1
+# Reading results is mostly waiting for the (network) filesystem.
+DEFAULT_READ_WORKERS = 16
+
+RESULT_COLUMNS = ["game_name", "map", "winner", "winner_race", "loser", "loser_race", "game_time"]
+
+
+def read_result_file(file: str) -> dict:
+    with open(file, "r") as f:
+        return json.load(f)
+
+
+def stat_result_files(files: List[str], n_workers: int = DEFAULT_READ_WORKERS) -> Dict[str, float]:
+    """
+    Modification times of result files, stat'ed in parallel.
+    """
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        return dict(zip(files, executor.map(os.path.getmtime, files)))
+
+
+def read_result_files(files: List[str], n_workers: int = DEFAULT_READ_WORKERS) -> List[dict]:
+    """
+    Read result files in parallel, in the order of the files.
+    """
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        return list(tqdm(executor.map(read_result_file, files), total=len(files), unit="game"))
+
+
+def result_row(info: dict) -> Optional[tuple]:
+    if info['winner'] is None:
+        logger.warning(f"Game {info['game_name']} has no winner, skipping it")
+        return None
+
+    return (info["game_name"],
+            info["map"].replace("sscai/", ""),
+            info['winner'],
+            RACES[info['winner_race']],
+            info['loser'],
+            RACES[info['loser_race']],
+            info["game_time"])
+
 
-    bots = set(df['winner']).union(set(df['loser']))
+def process_results(result_dir: str, n_workers: int = DEFAULT_READ_WORKERS) -> DataFrame:
+    """
+    Read results of all games in the result dir.
+    """
+    files = glob.glob(f"{result_dir}/*/result.json")
+    rows = [row for row in map(result_row, read_result_files(files, n_workers))
+            if row is not None]
+    return DataFrame(rows, columns=RESULT_COLUMNS).set_index("game_name")
 
-    #  Win times
-    df_wintimes = pd.pivot_table(df, index='winner', columns='loser', values='one', aggfunc=np.sum) \
-        .fillna(0).sort_index()
-    for missing_bot in bots - set(df_wintimes.columns):
-        df_wintimes[missing_bot] = 0
-    for missing_bot in bots - set(df_wintimes.index):
-        df_wintimes = df_wintimes.append(Series({bot: 0 for bot in bots}, name=missing_bot))
-    df_wintimes = df_wintimes.sort_index(axis=0).sort_index(axis=1)
+
+def count_matrix(row_codes: np.ndarray, column_codes: np.ndarray,
+                 n_rows: int, n_columns: int,
+                 weights: Optional[np.ndarray] = None) -> np.ndarray:
+    """
+    Number of occurrences of each (row, column) pair of integer codes,
+    or the sum of their weights.
+    """
+    counts = np.bincount(row_codes * n_columns + column_codes, weights=weights,
+                         minlength=n_rows * n_columns)
+    return counts.astype(np.int64, copy=False).reshape(n_rows, n_columns)
+
+
+def present_counts(counts: np.ndarray, rows: np.ndarray, columns: np.ndarray) -> np.ndarray:
+    # counts of the labels that occur, as in a pivot table: NaN for no games
+    counts = counts[np.ix_(rows, columns)]
+    if (counts == 0).any():
+        counts = np.where(counts == 0, np.nan, counts)
+    return counts
+
+
+def calc_stats(df: DataFrame, ser_round_robin_elos: Optional[Series]):
+    # Bots, races and maps are coded as integers, all the tables are counted from the codes.
+    n_games = len(df)
+    bot_codes, bots = pd.factorize(np.concatenate((df['winner'].values, df['loser'].values)),
+                                   sort=True)
+    winners, losers = bot_codes[:n_games], bot_codes[n_games:]
+    race_codes, all_races = pd.factorize(
+        np.concatenate((df['winner_race'].values, df['loser_race'].values)), sort=True)
+    winner_races, loser_races = race_codes[:n_games], race_codes[n_games:]
+    map_codes, maps = pd.factorize(df['map'].values, sort=True)
+    n_bots, n_races, n_maps = len(bots), len(all_races), len(maps)
+
+    #  Win times
+    wintimes = count_matrix(winners, losers, n_bots, n_bots).astype(np.float64)
+    played = wintimes + wintimes.T
 
     # Win rate
-    df_rr_winrate = (df_wintimes / (df_wintimes + df_wintimes.transpose()))
-    ser_overall_winrate = (
-        df_wintimes.sum(axis=1) /
-        (df_wintimes + df_wintimes.transpose()).sum(axis=1)
-    ).sort_values(ascending=False)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        df_rr_winrate = DataFrame(wintimes / played, index=bots, columns=bots)
+        ser_overall_winrate = Series(wintimes.sum(axis=1) / played.sum(axis=1), index=bots) \
+            .sort_values(ascending=False)
 
     # Game times
     df_winner = df[['winner', 'winner_race', 'game_time']]
@@ -80,32 +123,44 @@ def calc_stats(df: DataFrame, ser_round_robin_elos: Optional[Series]):
     df_loser.columns = ['bot', 'race', 'game_time']
     df_gametimes: DataFrame = pd.concat((df_winner, df_loser))
 
-    # Map winning rates
-    map_index = pd.MultiIndex.from_product([list(set(df['map'])), list(bots)])
-    df_map_winners = df.groupby(by=["map", "winner"])['one'].sum().reindex(map_index)
-    df_map_losers = df.groupby(by=["map", "loser"])['one'].sum().reindex(map_index)
-    ser_maps = df_map_winners / (df_map_winners + df_map_losers)
+    # Map winning rates, undefined if the bot has not both won and lost on the map
+    map_wins = count_matrix(map_codes, winners, n_maps, n_bots).astype(np.float64)
+    map_losses = count_matrix(map_codes, losers, n_maps, n_bots).astype(np.float64)
+    map_wins[map_wins == 0] = np.nan
+    map_losses[map_losses == 0] = np.nan
+    map_index = pd.MultiIndex.from_product([list(maps), list(bots)])
+    ser_maps = Series((map_wins / (map_wins + map_losses)).ravel(), index=map_index)
     ser_maps.name = 'win_rate'
 
+    # Race of each bot in the first game it appears in, winners first
+    _, first_games = np.unique(bot_codes, return_index=True)
+    first_games.sort()
+    ser_bot_races = Series(all_races[race_codes[first_games]],
+                           index=pd.Index(bots[bot_codes[first_games]], name='bot'), name='race')
+
     # Race win times
-    ser_bot_races = df_gametimes.set_index("bot").groupby("bot")['race'].head(1)
-    df_race_wintimes = pd.pivot_table(df, index='winner_race', columns='loser_race',
-                                      values='one', aggfunc=np.sum)
+    race_rows, race_columns = np.unique(winner_races), np.unique(loser_races)
+    df_race_wintimes = DataFrame(
+        present_counts(count_matrix(winner_races, loser_races, n_races, n_races),
+                       race_rows, race_columns),
+        index=pd.Index(all_races[race_rows], name='winner_race'),
+        columns=pd.Index(all_races[race_columns], name='loser_race'))
     # ... this is probably not needed
     races = set(ser_bot_races.unique())
-    for missing_race in races - set(df_race_wintimes.columns):
+    for missing_race in sorted(races - set(df_race_wintimes.columns)):
         df_race_wintimes[missing_race] = 0
-    for missing_race in races - set(df_race_wintimes.index):
-        df_race_wintimes = df_race_wintimes.append(
-            Series({race: 0 for race in races}, name=missing_race))
+    for missing_race in sorted(races - set(df_race_wintimes.index)):
+        df_race_wintimes.loc[missing_race] = Series({race: 0 for race in races})
 
     # Each bot winrates against each race
-    df_botrace_wintimes = pd.pivot_table(
-        df, index='winner', columns='loser_race', values='one', aggfunc=np.sum) \
-        .fillna(0).sort_index()
-    df_botrace_losetimes = pd.pivot_table(
-        df, index='loser', columns='winner_race', values='one', aggfunc=np.sum) \
-        .fillna(0).sort_index()
+    winning_bots, lost_to_races = np.unique(winners), np.unique(loser_races)
+    df_botrace_wintimes = DataFrame(
+        count_matrix(winners, loser_races, n_bots, n_races)[np.ix_(winning_bots, lost_to_races)],
+        index=bots[winning_bots], columns=all_races[lost_to_races])
+    losing_bots, won_by_races = np.unique(losers), np.unique(winner_races)
+    df_botrace_losetimes = DataFrame(
+        count_matrix(losers, winner_races, n_bots, n_races)[np.ix_(losing_bots, won_by_races)],
+        index=bots[losing_bots], columns=all_races[won_by_races])
     df_botrace_winrate = df_botrace_wintimes / (df_botrace_wintimes + df_botrace_losetimes)
 
     # Calculate elos
@@ -131,25 +186,10 @@ def save_stats(**df):
 
 def calc_round_robin_elo(df_results: DataFrame) -> Series:
     bots = set(df_results['winner']).union((set(df_results['loser'])))
-    initial_ratings = {bot: elo.Rating() for bot in bots}
+    initial_ratings = {bot: INITIAL for bot in bots}
     return calc_elo(initial_ratings, df_results)
 
 
 def calc_player_elo(ser_round_robin_elo: Series, df_bot_results: DataFrame) -> Series:
-    ratings = {bot: elo.Rating(value=score) for bot, score in ser_round_robin_elo.items()}
+    ratings = {bot: score for bot, score in ser_round_robin_elo.items()}
     return calc_elo(ratings, df_bot_results)
-
-
-def calc_elo(ratings: Dict[str, elo.Rating], df_game_results: DataFrame):
-    elo_calc = elo.Elo(rating_class=elo.Rating)
-    for i in np.arange(len(df_game_results)):
-        winner = df_game_results.iloc[i]['winner']
-        loser = df_game_results.iloc[i]['loser']
-
-        winner_elo, loser_elo = elo_calc.rate_1vs1(ratings[winner],
-                                                   ratings[loser], drawn=False)
-
-        ratings[winner] = winner_elo
-        ratings[loser] = loser_elo
-
-    return Series({bot: rating.value for bot, rating in ratings.items()}, name="elo")
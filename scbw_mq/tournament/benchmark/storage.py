@@ -30,6 +30,7 @@ class Benchmark:
     bot_dir: str
     map_dir: str
     result_dir: str
+    stats_file: str
 
     def check_structure(self):
         if not exists(f"{self.bot_file}"):
@@ -72,6 +73,8 @@ class BenchmarkStorage:
         benchmark.bot_dir = f"{local_benchmark_dir}/bots"
         benchmark.map_dir = f"{local_benchmark_dir}/maps"
         benchmark.result_dir = f"{local_benchmark_dir}/results"
+        # kept with the results, so that it is removed with them
+        benchmark.stats_file = f"{benchmark.result_dir}/stats.pickle"
         benchmark.repeat_games = repeat_games
 
         return benchmark
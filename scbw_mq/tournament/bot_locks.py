@@ -0,0 +1,61 @@
+import fcntl
+import os
+from typing import Iterable, List, Optional
+
+
+class BotLease:
+    """
+    Exclusive right to play with given bots, until released.
+    """
+
+    def __init__(self, bots: List[str], fds: List[int]):
+        self.bots = bots
+        self._fds = fds
+
+    def release(self) -> None:
+        for fd in self._fds:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+            os.close(fd)
+        self._fds = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.release()
+
+
+class BotLocks:
+    """
+    Host-wide locks of bots, shared by all workers that use the same lock dir.
+
+    Each bot has a lock file that is held with flock(2) while the bot plays.
+    The kernel releases the locks when the worker process dies,
+    so a crashed worker cannot leave bots locked forever.
+    """
+
+    def __init__(self, lock_dir: str):
+        self.lock_dir = lock_dir
+        os.makedirs(lock_dir, exist_ok=True)
+
+    def lock_file(self, bot: str) -> str:
+        return f"{self.lock_dir}/{bot}.lock"
+
+    def try_acquire(self, bots: Iterable[str]) -> Optional[BotLease]:
+        """
+        Lock all bots at once, or none of them if any of them is already locked.
+        """
+        # sorted, so that workers locking overlapping sets of bots don't starve each other
+        bots = sorted(set(bots))
+        fds = []
+        for bot in bots:
+            fd = os.open(self.lock_file(bot), os.O_RDWR | os.O_CREAT, 0o666)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                os.close(fd)
+                BotLease(bots, fds).release()
+                return None
+            fds.append(fd)
+
+        return BotLease(bots, fds)
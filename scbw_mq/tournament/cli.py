@@ -3,18 +3,24 @@ import logging
 from os.path import abspath, dirname
 
 import coloredlogs
-from scbw.cli import SC_BOT_DIR, SC_GAME_DIR, SC_MAP_DIR, SC_BWAPI_DATA_BWTA_DIR, \
+from scbw.defaults import SC_BOT_DIR, SC_GAME_DIR, SC_MAP_DIR, SC_BWAPI_DATA_BWTA_DIR, \
     SC_BWAPI_DATA_BWTA2_DIR, SC_IMAGE, SCBW_BASE_DIR
 from scbw.game_type import GameType
 
 from .benchmark import launch_benchmark
+from .benchmark.defaults import DEFAULT_MAX_MEMORY, DEFAULT_PLOT_WORKERS
+from .benchmark.sequential import STOP_RULES, DEFAULT_MARGIN, DEFAULT_ERROR, DEFAULT_CI_WIDTH
 from .consumer import launch_consumer
-from .producer import launch_producer
+from .message import WIRE_FORMATS
+from .producer import MAX_PRIORITY, launch_producer
+from ..rabbitmq_publisher import DEFAULT_WINDOW, DEFAULT_BATCH_SIZE, DEFAULT_MAX_RETRIES
 
 logger = logging.getLogger(__name__)
 
 SC_RESULT_DIR = f"{SCBW_BASE_DIR}/results"
 SC_BENCHMARKS_DIR = f"{SCBW_BASE_DIR}/benchmarks"
+SC_LOCK_DIR = f"{SCBW_BASE_DIR}/locks"
+SC_ASSET_CACHE_DIR = f"{SCBW_BASE_DIR}/asset_cache"
 
 RABBITMQ_HOST = "localhost"
 RABBITMQ_PORT = 5672
@@ -35,10 +41,37 @@ consumer_parser.add_argument('--password', type=str, help="RabbitMQ password",
 
 # Parallelization
 consumer_parser.add_argument('--n_processes', type=int, default=4)
+consumer_parser.add_argument('--asyncio', action="store_true",
+                             help="Run all n_processes game slots as tasks\n"
+                                  "of a single process sharing one connection.")
+consumer_parser.add_argument('--adaptive', action="store_true",
+                             help="Adapt the number of running games to host load,\n"
+                                  "between min_processes and n_processes.\n"
+                                  "Implies --asyncio.")
+consumer_parser.add_argument('--min_processes', type=int, default=1,
+                             help="Lowest number of game slots in adaptive mode.")
+consumer_parser.add_argument('--max_load', type=float, default=1.,
+                             help="Shrink game slots when load average per CPU\n"
+                                  "is above this value in adaptive mode.")
+consumer_parser.add_argument('--min_free_memory', type=float, default=0.1,
+                             help="Shrink game slots when the fraction of available\n"
+                                  "memory is below this value in adaptive mode.")
+consumer_parser.add_argument('--max_slowdown', type=float, default=1.5,
+                             help="Shrink game slots when games run this many times\n"
+                                  "slower per in-game second than recent games\n"
+                                  "of the same kind in adaptive mode.")
+consumer_parser.add_argument('--recycle_after', type=int, default=0,
+                             help="Replace a worker with a fresh process after\n"
+                                  "it has handled this many games, 0 means never.")
+consumer_parser.add_argument('--drain_timeout', type=int, default=0,
+                             help="On SIGTERM, wait this many seconds for running\n"
+                                  "games to finish before killing workers,\n"
+                                  "0 means wait until they finish.")
 
 # Results
 consumer_parser.add_argument('--result_dir', type=str, default=SC_RESULT_DIR,
-                             help=f"Directory where results are stored, default:\n{SC_RESULT_DIR}")
+                             help="Not used anymore, results and the ledger\n"
+                                  "of played games are stored in --game_dir.")
 
 # Game settings
 consumer_parser.add_argument("--game_type", type=str, metavar="GAME_TYPE",
@@ -57,10 +90,30 @@ consumer_parser.add_argument("--timeout", type=int, default=600,
 consumer_parser.add_argument('--bot_dir', type=str, default=SC_BOT_DIR,
                              help=f"Directory where bots are stored, default:\n{SC_BOT_DIR}")
 consumer_parser.add_argument('--game_dir', type=str, default=SC_GAME_DIR,
-                             help=f"Directory where logs are stored, default:\n{SC_GAME_DIR}")
+                             help=f"Directory where logs, results and the ledger\n"
+                                  f"of played games are stored. Workers of several hosts\n"
+                                  f"can share it only on a filesystem with working\n"
+                                  f"fcntl locks, default:\n{SC_GAME_DIR}")
 consumer_parser.add_argument('--map_dir', type=str, default=SC_MAP_DIR,
                              help=f"Directory where maps are stored, default:\n{SC_MAP_DIR}")
 
+# Staging of bots and maps
+consumer_parser.add_argument('--asset_source', type=str, default=None,
+                             help="Directory with 'bots' and 'maps' dirs, e.g. the scbw\n"
+                                  "base dir of the producer host on a shared mount.\n"
+                                  "Bots and maps of each game are staged from it\n"
+                                  "to --bot_dir and --map_dir before the game.\n"
+                                  "Without it, they must already be there.")
+consumer_parser.add_argument('--asset_cache', type=str, default=SC_ASSET_CACHE_DIR,
+                             help=f"Content-addressed store of staged files of this node,\n"
+                                  f"default:\n{SC_ASSET_CACHE_DIR}")
+consumer_parser.add_argument('--prefetch_games', type=int, default=1,
+                             help="Number of games each worker receives ahead\n"
+                                  "of the one it plays, to stage their assets\n"
+                                  "in the meantime. Prefetched games are not\n"
+                                  "overtaken by games of higher priority.\n"
+                                  "Used with --asset_source.")
+
 #  BWAPI data volumes
 consumer_parser.add_argument('--bwapi_data_bwta_dir', type=str, default=SC_BWAPI_DATA_BWTA_DIR,
                              help=f"Directory where BWTA map caches are stored, "
@@ -75,6 +128,14 @@ consumer_parser.add_argument('--read_overwrite', action="store_true",
                                   "of 'write' directory to the read directory\n"
                                   "of the bot.\n"
                                   "Needs to be explicitly turned on.")
+consumer_parser.add_argument('--lock_dir', type=str, default=SC_LOCK_DIR,
+                             help=f"Directory of bot locks shared by all consumers\n"
+                                  f"on this host, used with --read_overwrite,\n"
+                                  f"default:\n{SC_LOCK_DIR}")
+consumer_parser.add_argument('--requeue_delay', type=float, default=30.,
+                             help="When bots of a game are already playing,\n"
+                                  "the game waits this many seconds in the\n"
+                                  "delay queue before it is consumed again.")
 consumer_parser.add_argument('--random_names', action="store_true",
                              help="Randomize player names.")
 consumer_parser.add_argument('--docker_image', type=str, default=SC_IMAGE,
@@ -125,6 +186,64 @@ producer_parser.add_argument('--map_dir', type=str, default=SC_MAP_DIR,
 producer_parser.add_argument('--game_dir', type=str, default=SC_RESULT_DIR,
                              help=f"Directory where results are stored, default:\n{SC_RESULT_DIR}")
 
+# Publishing
+producer_parser.add_argument('--publish_window', type=int, default=DEFAULT_WINDOW,
+                             help="Maximum number of messages that are not yet\n"
+                                  "confirmed by the broker.")
+producer_parser.add_argument('--publish_batch_size', type=int, default=DEFAULT_BATCH_SIZE,
+                             help="Report publishing throughput after this many\n"
+                                  "confirmed messages.")
+producer_parser.add_argument('--publish_retries', type=int, default=DEFAULT_MAX_RETRIES,
+                             help="How many times to republish a message\n"
+                                  "that was rejected by the broker.")
+
+producer_parser.add_argument('--wire_format', type=str, default="json", choices=WIRE_FORMATS,
+                             help="Encoding of game messages. Binary messages are\n"
+                                  "more compact, but need up-to-date consumers.")
+producer_parser.add_argument('--games_per_message', type=int, default=1,
+                             help="Send this many games in one message.\n"
+                                  "Consumers play games of a message one by one.")
+producer_parser.add_argument('--priority', type=int, default=0, choices=range(MAX_PRIORITY + 1),
+                             metavar=f"{{0..{MAX_PRIORITY}}}",
+                             help="Priority of the games, consumers play games\n"
+                                  "of higher priority first. Use it for quick checks\n"
+                                  "that shouldn't wait behind a long tournament.")
+
+producer_parser.add_argument('--tournament', type=str, default=None,
+                             help="Id of the tournament carried in its games and their\n"
+                                  "events, so that progress watchers count only games\n"
+                                  "of this tournament. Derived from --seed if not set.")
+
+# Schedule
+producer_parser.add_argument('--seed', type=int, default=None,
+                             help="Seed of the order of games. The same seed gives\n"
+                                  "the same schedule, it is random if not set.")
+producer_parser.add_argument('--shards', type=int, default=1,
+                             help="Split the schedule into this many disjoint shards,\n"
+                                  "each published by its own producer.\n"
+                                  "All shards need the same --seed.")
+producer_parser.add_argument('--shard', type=int, default=0,
+                             help="Which shard to publish, from 0 to shards - 1.")
+producer_parser.add_argument('--checkpoint_file', type=str, default=None,
+                             help="Save the position of confirmed games here.\n"
+                                  "A restarted producer continues from it,\n"
+                                  "without publishing any game twice.")
+producer_parser.add_argument('--round_workers', type=int, default=0,
+                             help="Publish the tournament in rounds of games that\n"
+                                  "share no bot, so that this many games taken in order\n"
+                                  "can be played at once. Use it with consumers\n"
+                                  "that have --read_overwrite, set to the number\n"
+                                  "of games all consumers play at once.\n"
+                                  "0 publishes games in random order.")
+producer_parser.add_argument('--durations_from', type=str, nargs='+', default=None,
+                             help="Result dirs of earlier tournaments. Their game times\n"
+                                  "predict how long each game takes, and games are\n"
+                                  "published longest first, so that no long game\n"
+                                  "is left for the end of the tournament.")
+producer_parser.add_argument('--workers', type=int, default=1,
+                             help="Number of games all consumers play at once,\n"
+                                  "to predict the makespan with --durations_from.")
+
 producer_parser.add_argument('--log_level', type=str, default="INFO",
                              choices=['DEBUG', 'INFO', 'WARN', 'ERROR'],
                              help="Logging level.")
@@ -155,6 +274,39 @@ benchmark_parser.add_argument('--test_bot_dir', type=str, default=None)
 benchmark_parser.add_argument('--results_only', action='store_true',
                               help="Only process results, do not launch\n"
                                     "message production and waiting")
+benchmark_parser.add_argument('--stats_memory', type=int, default=DEFAULT_MAX_MEMORY,
+                              help="Memory in MB that reading a chunk of results\n"
+                                   "may take while calculating stats.")
+benchmark_parser.add_argument('--no_plots', '--no-plots', action='store_true',
+                              help="Only export stats as csv files, without\n"
+                                   "rendering plots or loading matplotlib.")
+benchmark_parser.add_argument('--plot_workers', type=int, default=DEFAULT_PLOT_WORKERS,
+                              help="Number of processes that render plots,\n"
+                                   "1 renders them in the benchmark process.")
+benchmark_parser.add_argument('--priority', type=int, default=0, choices=range(MAX_PRIORITY + 1),
+                              metavar=f"{{0..{MAX_PRIORITY}}}",
+                              help="Priority of the benchmark games, e.g. 5 for\n"
+                                   "a quick check of a bot while a tournament is played.")
+benchmark_parser.add_argument('--durations_from', type=str, nargs='+', default=None,
+                              help="Result dirs of earlier tournaments, publish games\n"
+                                   "longest first by their game times there.\n"
+                                   "Predicted and actual makespan are both logged.")
+benchmark_parser.add_argument('--workers', type=int, default=1,
+                              help="Number of games all consumers play at once,\n"
+                                   "to predict the makespan with --durations_from.")
+benchmark_parser.add_argument('--adaptive', type=str, default=None, choices=STOP_RULES,
+                              help="Play the test bot against each opponent in waves\n"
+                                   "over all maps, and stop once the matchup is decided:\n"
+                                   "sprt - sequential probability ratio test,\n"
+                                   "wilson - Wilson confidence interval of the win rate.\n"
+                                   "At most all repetitions of the benchmark are played.")
+benchmark_parser.add_argument('--margin', type=float, default=DEFAULT_MARGIN,
+                              help="SPRT tests win rates of 0.5 - margin against 0.5 + margin.")
+benchmark_parser.add_argument('--error', type=float, default=DEFAULT_ERROR,
+                              help="SPRT rate of wrong decisions.")
+benchmark_parser.add_argument('--ci_width', type=float, default=DEFAULT_CI_WIDTH,
+                              help="Wilson rule calls the matchup even once the\n"
+                                   "confidence interval is this narrow.")
 
 benchmark_parser.add_argument('--log_level', type=str, default="INFO",
                               choices=['DEBUG', 'INFO', 'WARN', 'ERROR'],
@@ -1,22 +1,49 @@
+import asyncio
+import importlib
 import logging
-import os
 from argparse import Namespace
+from concurrent.futures import ThreadPoolExecutor
 from copy import copy
-from multiprocessing import Process
-from os.path import exists
+from functools import lru_cache
+from typing import TYPE_CHECKING, Callable, Optional, Set
 
-from pika import ConnectionParameters
+from pika import BasicProperties, ConnectionParameters
 from pika.credentials import PlainCredentials
 from scbw.error import DockerException, GameException
-from scbw.game import run_game, GameArgs
 
-from .message import PlayMessage
+from .assets import AssetException, create_asset_cache
+from .bot_locks import BotLocks
+from .events import EventEmitter, declare_exchanges, declare_exchanges_async, read_result
+from .ledger import GameLedger, DEFAULT_STALE_AFTER, FINISHED
+from .message import PlayMessage, deserialize_games
 from .producer import publish_msg
+from ..concurrency import adaptive_concurrency
+from ..rabbitmq_async_consumer import AsyncAckConsumer
 from ..rabbitmq_consumer import AckConsumer
 from ..rabbitmq_consumer import consumer_error
+from ..supervisor import WorkerPool
+from ..waiter import ContainerExitWatcher
+
+if TYPE_CHECKING:
+    # scbw.game brings its realtime plots, and with them matplotlib and pandas,
+    # it is imported only once games are about to be played
+    from scbw.game import GameArgs
 
 logger = logging.getLogger(__name__)
 
+# Longest time between checks of running game containers.
+WAIT_TIMEOUT = 3
+
+# Where failed games of a batch are sent, see docker/definitions.json
+DEAD_LETTER_EXCHANGE = 'play.dead'
+
+# Games whose bots are busy wait here until they expire back to the play queue.
+DELAY_QUEUE = 'play.delay'
+DELAY_QUEUE_ARGUMENTS = {
+    "x-dead-letter-exchange": "",
+    "x-dead-letter-routing-key": "play",
+}
+
 
 class ConsumerConfig(Namespace):
     # rabbit connection
@@ -27,6 +54,14 @@ class ConsumerConfig(Namespace):
 
     # parallelization
     n_processes: int
+    asyncio: bool
+    adaptive: bool
+    min_processes: int
+    max_load: float
+    min_free_memory: float
+    max_slowdown: float
+    recycle_after: int
+    drain_timeout: int
 
     # results
     result_dir: str
@@ -41,10 +76,102 @@ class ConsumerConfig(Namespace):
     bwapi_data_bwta_dir: str
     bwapi_data_bwta2_dir: str
     read_overwrite: bool
+    lock_dir: str
+    requeue_delay: float
     random_names: bool
     docker_image: str
     opt: str
 
+    # staging of bots and maps
+    asset_source: Optional[str]
+    asset_cache: str
+    prefetch_games: int
+
+
+def create_game_args(config: ConsumerConfig) -> 'GameArgs':
+    from scbw.game import GameArgs
+
+    game_args = GameArgs()
+    game_args.game_type = config.game_type
+    game_args.game_speed = config.game_speed
+    game_args.timeout = config.timeout
+    game_args.bot_dir = config.bot_dir
+    game_args.game_dir = config.game_dir
+    game_args.map_dir = config.map_dir
+    game_args.bwapi_data_bwta_dir = config.bwapi_data_bwta_dir
+    game_args.bwapi_data_bwta2_dir = config.bwapi_data_bwta2_dir
+    game_args.read_overwrite = config.read_overwrite
+    game_args.docker_image = config.docker_image
+    game_args.random_names = config.random_names
+
+    game_args.opt = config.opt
+
+    game_args.human = False
+    game_args.headless = True
+    game_args.vnc_host = "localhost"
+    game_args.vnc_base_port = 5900
+    game_args.allow_input = False
+    game_args.auto_launch = False
+    game_args.plot_realtime = False
+    game_args.hide_names = False
+    game_args.capture_movement = False
+    game_args.show_all = False
+
+    return game_args
+
+
+def create_connection_params(config: ConsumerConfig) -> ConnectionParameters:
+    return ConnectionParameters(
+        host=config.host,
+        port=config.port,
+        credentials=PlainCredentials(config.user, config.password),
+
+        connection_attempts=3,
+        heartbeat_interval=60,
+    )
+
+
+def prepare_game(play: PlayMessage, base_args: 'GameArgs') -> 'GameArgs':
+    game_args = copy(base_args)
+    game_args.bots = play.bots
+    game_args.map = play.map
+    game_args.game_name = play.game_name
+    game_args.tournament = play.tournament
+    return game_args
+
+
+@lru_cache(maxsize=None)
+def delay_properties(delay: float, priority: Optional[int] = None) -> BasicProperties:
+    # all messages of the delay queue expire after the same time,
+    # so per-message expiration at the head of the queue keeps them in order;
+    # the priority is kept when they expire back to the play queue
+    return BasicProperties(delivery_mode=2, expiration=str(int(delay * 1000)),
+                           priority=priority or None)
+
+
+def create_ledger(config: ConsumerConfig) -> GameLedger:
+    # a game that runs much longer than its timeout has been abandoned
+    stale_after = 2 * config.timeout if config.timeout else DEFAULT_STALE_AFTER
+    return GameLedger(config.game_dir, stale_after)
+
+
+def game_container_prefix(game_name: str) -> str:
+    # scbw names the containers of a game GAME_{game_name}_{n}_{bot};
+    # the trailing underscore keeps game 100000 from matching 1000001
+    return f"GAME_{game_name}_"
+
+
+def play_game(game_args: 'GameArgs', service: Optional[Callable[[], None]] = None) -> None:
+    """
+    Run the game, waking up as soon as any of its containers exits
+    instead of sleeping a fixed amount of time between checks.
+    """
+    from scbw.game import run_game
+
+    with ContainerExitWatcher(game_container_prefix(game_args.game_name)) as watcher:
+        # The timeout keeps the lingering container check of run_game going.
+        run_game(game_args, wait_callback=lambda: watcher.wait(WAIT_TIMEOUT, service))
+
 
 class PlayConsumer(AckConsumer):
     EXCHANGE = 'play'
@@ -53,109 +180,303 @@ class PlayConsumer(AckConsumer):
     ROUTING_KEY = 'play'
 
     def __init__(self, config: ConsumerConfig):
-        super(PlayConsumer, self).__init__(ConnectionParameters(
-            host=config.host,
-            port=config.port,
-            credentials=PlainCredentials(config.user, config.password),
-
-            connection_attempts=3,
-            heartbeat_interval=60,
-        ))
-
-        self.result_dir = config.result_dir
-
-        self.game_args = GameArgs()
-        self.game_args.game_type = config.game_type
-        self.game_args.game_speed = config.game_speed
-        self.game_args.timeout = config.timeout
-        self.game_args.bot_dir = config.bot_dir
-        self.game_args.game_dir = config.game_dir
-        self.game_args.map_dir = config.map_dir
-        self.game_args.bwapi_data_bwta_dir = config.bwapi_data_bwta_dir
-        self.game_args.bwapi_data_bwta2_dir = config.bwapi_data_bwta2_dir
-        self.game_args.read_overwrite = config.read_overwrite
-        self.game_args.docker_image = config.docker_image
-        self.game_args.random_names = config.random_names
-
-        self.game_args.opt = config.opt
-
-        self.game_args.human = False
-        self.game_args.headless = True
-        self.game_args.vnc_host = "localhost"
-        self.game_args.vnc_base_port = 5900
-        self.game_args.allow_input = False
-        self.game_args.auto_launch = False
-        self.game_args.plot_realtime = False
-        self.game_args.hide_names = False
-        self.game_args.capture_movement = False
-        self.game_args.show_all = False
-
-    @consumer_error(GameException, DockerException)
-    def handle_message(self, json_request: str):
+        super(PlayConsumer, self).__init__(create_connection_params(config))
+
+        self.game_args = create_game_args(config)
+        self.ledger = create_ledger(config)
+        self.events = EventEmitter()
+        self.bot_locks = BotLocks(config.lock_dir)
+        self.requeue_delay = config.requeue_delay
+
+        self.assets = create_asset_cache(config.asset_cache, config.asset_source,
+                                         config.bot_dir, config.map_dir)
+        if self.assets is not None:
+            # the next games are delivered while a game is played, to stage their assets
+            self.prefetch_count = 1 + config.prefetch_games
+        self._prefetched: Set[int] = set()
+
+    def connect(self):
+        super(PlayConsumer, self).connect()
+        declare_exchanges(self._channel)
+        self.events.channel = self._channel
+        if self.game_args.read_overwrite:
+            self._channel.queue_declare(queue=DELAY_QUEUE, durable=True,
+                                        arguments=DELAY_QUEUE_ARGUMENTS)
+
+    def decode_body(self, body: bytes) -> bytes:
+        # messages may be binary, see message.py
+        return body
+
+    def handle_delivery(self, body: bytes, properties: BasicProperties):
+        self.handle_message(self.decode_body(body), properties.priority)
+
+    def handle_message(self, request: bytes, priority: Optional[int] = None):
         self._connection.process_data_events()
-        play = PlayMessage.deserialize(json_request)
+        games = deserialize_games(request)
+        if len(games) == 1:
+            self.handle_game(games[0], priority)
+            return
 
-        result_file = f"{self.result_dir}/{play.game_name}.json"
-        if exists(result_file):
+        # Games of a batch are tracked one by one, so that a failed game,
+        # whatever the error, doesn't make the whole batch fail.
+        for play in games:
+            # noinspection PyBroadException
+            try:
+                self.handle_game(play, priority)
+            except Exception:
+                logger.warning(f"Game {play.game_name} of a batch has failed, "
+                               f"sending it to dead queue.", exc_info=True)
+                publish_msg(self._channel, play.serialize(),
+                            exchange=DEAD_LETTER_EXCHANGE, routing_key=self.ROUTING_KEY)
+
+    @consumer_error(GameException, DockerException, AssetException)
+    def handle_game(self, play: PlayMessage, priority: Optional[int] = None):
+        if self.ledger.state(play.game_name) == FINISHED:
             logger.warning(f"Game {play.game_name} has already been played!")
+            # a watcher that started after the game has to count it too
+            self.events.finished(play.game_name, tournament=play.tournament)
+            if self.assets is not None:
+                # its assets may have been prefetched
+                self.assets.discard(play)
             return
-
-        game_args = copy(self.game_args)
-        game_args.bots = play.bots
-        game_args.map = play.map
-        game_args.game_name = play.game_name
+        try:
+            game_args = prepare_game(play, self.game_args)
+            if self.assets is not None:
+                self.assets.stage_game(play)
+        except Exception:
+            # the game is rejected before it has started, watchers must not wait for it
+            self.events.failed(play.game_name, play.tournament)
+            raise
 
         # When read_overwrite is enabled, bots save what they've learned in the game,
-        # thus there cannot be the same bots playing at the same time.
-        # If such a game request happens, it will be appended to the end of the RMQ queue
+        # thus there cannot be the same bots playing at the same time on this host.
+        # If such a game request happens, it will wait in the delay queue for a while.
         if self.game_args.read_overwrite:
-            if self.bots_playing(game_args.bots):
-                logger.info(f"Cannot play {game_args.bots} now, requeuing {json_request}")
-                self.requeue_game(json_request)
+            lease = self.bot_locks.try_acquire(game_args.bots)
+            if lease is None:
+                logger.info(f"Cannot play {game_args.bots} now, deferring {play}")
+                self.requeue_game(play.serialize(), priority)
                 return
 
-            try:
-                self.reserve_bots(game_args.bots)
-                run_game(game_args, wait_callback=self.wait_callback)
-            finally:
-                self.free_bots(game_args.bots)
+            with lease:
+                self.play_once(game_args)
 
         else:
-            run_game(game_args, wait_callback=self.wait_callback)
+            self.play_once(game_args)
 
         self._connection.process_data_events()
 
-    def wait_callback(self):
-        # This calls process_data_events under the hood
-        self._connection.sleep(3)
+    def play_once(self, game_args: 'GameArgs') -> None:
+        # the ledger rejects duplicates of games that other workers play or have played
+        if not self.ledger.try_start(game_args.game_name):
+            logger.warning(f"Game {game_args.game_name} is being played or has been played!")
+            if self.ledger.state(game_args.game_name) == FINISHED:
+                self.events.finished(game_args.game_name, tournament=game_args.tournament)
+            return
+
+        self.events.started(game_args.game_name, game_args.tournament)
+        try:
+            play_game(game_args, service=self.service)
+        except Exception:
+            self.ledger.fail(game_args.game_name)
+            self.events.failed(game_args.game_name, game_args.tournament)
+            raise
+        self.ledger.finish(game_args.game_name)
+        self.events.finished(game_args.game_name,
+                             read_result(game_args.game_dir, game_args.game_name),
+                             game_args.tournament)
+
+    def service(self) -> None:
+        """
+        Keep the connection alive while a game is played,
+        and stage assets of the games that are delivered next.
+        """
+        self._connection.process_data_events()
+        if self.assets is None:
+            return
 
-    def reserve_bots(self, bots) -> None:
-        for bot in bots:
-            fname = f"playing_{bot}"
-            with open(fname, 'a'):
-                os.utime(fname, times=None)
+        delivered = set()
+        for method, body in self.peek_deliveries():
+            delivered.add(method.delivery_tag)
+            if method.delivery_tag not in self._prefetched:
+                for play in deserialize_games(body):
+                    self.assets.prefetch(play)
+        self._prefetched = delivered
+
+    def requeue_game(self, json_request: str, priority: Optional[int] = None) -> None:
+        publish_msg(self._channel, json_request, routing_key=DELAY_QUEUE,
+                    properties=delay_properties(self.requeue_delay, priority))
+
+    def close(self):
+        super(PlayConsumer, self).close()
+        self.ledger.close()
+        if self.assets is not None:
+            self.assets.close()
+
+
+class AsyncPlayConsumer(AsyncAckConsumer):
+    """
+    Plays up to `n_processes` games at once in a single process.
+    """
+    QUEUE = 'play'
+
+    def __init__(self, config: ConsumerConfig):
+        super(AsyncPlayConsumer, self).__init__(create_connection_params(config),
+                                                concurrency=config.n_processes,
+                                                controller=adaptive_concurrency(config))
+
+        self.game_args = create_game_args(config)
+        self.ledger = create_ledger(config)
+        self.events = EventEmitter()
+        self.bot_locks = BotLocks(config.lock_dir)
+        self.requeue_delay = config.requeue_delay
+        self.assets = create_asset_cache(config.asset_cache, config.asset_source,
+                                         config.bot_dir, config.map_dir)
+
+        # run_game blocks until the game containers exit, give each slot a thread
+        self._executor = ThreadPoolExecutor(max_workers=config.n_processes)
+
+    def on_channel_open(self, channel):
+        self.events.channel = channel
+        declare_exchanges_async(channel, lambda: self.on_exchanges_declared(channel))
+
+    def on_exchanges_declared(self, channel):
+        if not self.game_args.read_overwrite:
+            super(AsyncPlayConsumer, self).on_channel_open(channel)
+            return
 
-    def free_bots(self, bots) -> None:
-        for bot in bots:
-            fname = f"playing_{bot}"
+        on_declare_ok = lambda frame: super(AsyncPlayConsumer, self).on_channel_open(channel)
+        channel.queue_declare(on_declare_ok, queue=DELAY_QUEUE, durable=True,
+                              arguments=DELAY_QUEUE_ARGUMENTS)
+
+    def decode_body(self, body: bytes) -> bytes:
+        # messages may be binary, see message.py
+        return body
+
+    async def handle_delivery(self, body: bytes, properties: BasicProperties):
+        await self.handle_message(self.decode_body(body), properties.priority)
+
+    async def handle_message(self, request: bytes, priority: Optional[int] = None):
+        games = deserialize_games(request)
+        if len(games) == 1:
+            await self.handle_game(games[0], priority)
+            return
+
+        # See PlayConsumer.handle_message
+        for play in games:
+            # noinspection PyBroadException
             try:
-                os.remove(fname)
-            except OSError:
-                pass
+                await self.handle_game(play, priority)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.warning(f"Game {play.game_name} of a batch has failed, "
+                               f"sending it to dead queue.", exc_info=True)
+                publish_msg(self._channel, play.serialize(),
+                            exchange=DEAD_LETTER_EXCHANGE, routing_key=self.QUEUE)
+
+    @consumer_error(GameException, DockerException, AssetException)
+    async def handle_game(self, play: PlayMessage, priority: Optional[int] = None):
+        # See PlayConsumer.handle_game for the events of games that are not played
+        if self.ledger.state(play.game_name) == FINISHED:
+            logger.warning(f"Game {play.game_name} has already been played!")
+            self.events.finished(play.game_name, tournament=play.tournament)
+            return
+        try:
+            game_args = prepare_game(play, self.game_args)
+            # every delivered game is played right away, while the others keep playing
+            if self.assets is not None:
+                for staging in self.assets.take(play):
+                    await asyncio.wrap_future(staging)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            self.events.failed(play.game_name, play.tournament)
+            raise
+
+        # See PlayConsumer.handle_game, locks are taken by each game,
+        # so they also keep apart games of the same process.
+        if self.game_args.read_overwrite:
+            lease = self.bot_locks.try_acquire(game_args.bots)
+            if lease is None:
+                logger.info(f"Cannot play {game_args.bots} now, deferring {play}")
+                publish_msg(self._channel, play.serialize(), routing_key=DELAY_QUEUE,
+                            properties=delay_properties(self.requeue_delay, priority))
+                return
 
-    def bots_playing(self, bots) -> bool:
-        return any(os.path.exists(f"playing_{bot}") for bot in bots)
+            with lease:
+                await self.play_once(game_args)
 
-    def requeue_game(self, json_request: str) -> None:
-        publish_msg(self._channel, json_request)
+        else:
+            await self.play_once(game_args)
+
+    async def play_once(self, game_args: 'GameArgs') -> None:
+        # See PlayConsumer.play_once
+        if not self.ledger.try_start(game_args.game_name):
+            logger.warning(f"Game {game_args.game_name} is being played or has been played!")
+            if self.ledger.state(game_args.game_name) == FINISHED:
+                self.events.finished(game_args.game_name, tournament=game_args.tournament)
+            return
+
+        self.events.started(game_args.game_name, game_args.tournament)
+        try:
+            await self._loop.run_in_executor(self._executor, play_game, game_args)
+        except Exception:
+            self.ledger.fail(game_args.game_name)
+            self.events.failed(game_args.game_name, game_args.tournament)
+            raise
+        self.ledger.finish(game_args.game_name)
+        self.events.finished(game_args.game_name,
+                             read_result(game_args.game_dir, game_args.game_name),
+                             game_args.tournament)
+
+    def job_key(self, request: bytes) -> Optional[str]:
+        games = deserialize_games(request)
+        if len(games) != 1:
+            return None
+        return f"{sorted(games[0].bots)}_{games[0].map}"
+
+    def job_work(self, request: bytes) -> Optional[float]:
+        games = deserialize_games(request)
+        if len(games) != 1:
+            return None
+        result = read_result(self.game_args.game_dir, games[0].game_name)
+        return None if result is None else result.get("game_time")
+
+    def close(self):
+        super(AsyncPlayConsumer, self).close()
+        self._executor.shutdown(wait=False)
+        if self.assets is not None:
+            self.assets.close()
+        self.ledger.close()
 
 
 def launch_consumer(args: ConsumerConfig):
-    def run() -> None:
-        logger.info("Initializing a new worker")
+    # load the game stack once, so that forked workers share it
+    importlib.import_module("scbw.game")
+
+    def run(index: int) -> None:
+        logger.info(f"Initializing worker {index}")
 
         # setup services
         consumer = PlayConsumer(args)
+        consumer.max_messages = args.recycle_after or None
+        consumer.install_drain_handler()
+        try:
+            consumer.connect()
+            consumer.start_consuming()
+        except KeyboardInterrupt:
+            logger.warning("Shutting down worker")
+            consumer.stop_consuming()
+        finally:
+            consumer.close()
+
+    def run_async(index: int) -> None:
+        logger.info(f"Initializing worker {index} with {args.n_processes} game slots")
+
+        consumer = AsyncPlayConsumer(args)
+        consumer.max_messages = args.recycle_after or None
+        consumer.install_drain_handler()
         try:
             consumer.connect()
             consumer.start_consuming()
@@ -165,6 +486,9 @@ def launch_consumer(args: ConsumerConfig):
         finally:
             consumer.close()
 
-    for i in range(args.n_processes):
-        p = Process(target=run)
-        p.start()
+    # keep the workers alive, restarting them if they crash
+    if args.asyncio or args.adaptive:
+        pool = WorkerPool(run_async, 1, drain_timeout=args.drain_timeout or None)
+    else:
+        pool = WorkerPool(run, args.n_processes, drain_timeout=args.drain_timeout or None)
+    pool.run()
@@ -12,6 +12,7 @@ from .cli import (
     RABBITMQ_PASSWORD,
     RABBITMQ_QUEUE
 )
+from .message import is_binary, deserialize_games
 from ..rabbitmq_consumer import AckConsumer
 
 logger = logging.getLogger(__name__)
@@ -45,8 +46,15 @@ class Dumper(AckConsumer):
             heartbeat_interval=60,
         ))
 
-    def handle_message(self, msg: str):
-        print(msg)
+    def decode_body(self, body: bytes) -> bytes:
+        return body
+
+    def handle_message(self, msg: bytes):
+        if is_binary(msg):
+            for game in deserialize_games(msg):
+                print(game.serialize())
+        else:
+            print(msg.decode("utf-8"))
 
 
 def launch_dumper(args: DumpConfig):
@@ -0,0 +1,112 @@
+import glob
+import heapq
+import json
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from os.path import basename
+from typing import Dict, Iterable, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Reading results is mostly waiting for the (network) filesystem.
+DEFAULT_READ_WORKERS = 16
+
+
+def pair_key(bots: Iterable[str]) -> Tuple[str, ...]:
+    return tuple(sorted(bots))
+
+
+def map_key(map_name: str) -> str:
+    # the same map may be given with different directories, e.g. sscai/
+    return basename(map_name)
+
+
+class DurationModel:
+    """
+    Predicts how long a game takes from the game times of earlier games.
+
+    A game takes the mean time of the games of the same bots on the same map,
+    or on any map if they haven't played the map yet. Bots that haven't played
+    each other are not predicted at all.
+    """
+
+    def __init__(self):
+        self.pair_map_times: Dict[Tuple, List[float]] = {}
+        self.pair_times: Dict[Tuple, List[float]] = {}
+        self.total_time = 0.
+        self.n_games = 0
+
+    def __len__(self) -> int:
+        return self.n_games
+
+    @property
+    def mean(self) -> Optional[float]:
+        return self.total_time / self.n_games if self.n_games else None
+
+    def add(self, bots: Iterable[str], map_name: str, game_time: float) -> None:
+        pair = pair_key(bots)
+        for key, times in (((pair, map_key(map_name)), self.pair_map_times),
+                           (pair, self.pair_times)):
+            total = times.setdefault(key, [0., 0])
+            total[0] += game_time
+            total[1] += 1
+        self.total_time += game_time
+        self.n_games += 1
+
+    def add_result(self, info: dict) -> bool:
+        """
+        Add a game from its result.json.
+
+        :returns: if the result has a game time
+        """
+        bots = info.get('bots') or [info.get('winner'), info.get('loser')]
+        if info.get('game_time') is None or info.get('map') is None or None in bots:
+            return False
+        self.add(bots, info['map'], float(info['game_time']))
+        return True
+
+    def predict(self, bots: Iterable[str], map_name: str) -> Optional[float]:
+        pair = pair_key(bots)
+        total = self.pair_map_times.get((pair, map_key(map_name)))
+        if total is None:
+            total = self.pair_times.get(pair)
+        if total is None:
+            return None
+        return total[0] / total[1]
+
+
+def read_result_info(file: str) -> Optional[dict]:
+    try:
+        with open(file, "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        # the game may still be writing its result
+        logger.warning(f"Cannot read {file}, skipping it")
+        return None
+
+
+def read_durations(result_dirs: List[str],
+                   n_workers: int = DEFAULT_READ_WORKERS) -> DurationModel:
+    """
+    Read game times of all games in the result dirs of earlier tournaments.
+    """
+    files = [file for result_dir in result_dirs
+             for file in glob.glob(f"{result_dir}/*/result.json")]
+    model = DurationModel()
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        for info in executor.map(read_result_info, files):
+            if info is not None:
+                model.add_result(info)
+    logger.info(f"Read game times of {len(model)} of {len(files)} earlier games")
+    return model
+
+
+def predict_makespan(durations: Iterable[float], workers: int) -> float:
+    """
+    Time until all games are played, if each of the workers takes the next game
+    of the queue as soon as it is free.
+    """
+    free_at = [0.] * max(1, workers)
+    for duration in durations:
+        heapq.heapreplace(free_at, free_at[0] + duration)
+    return max(free_at)
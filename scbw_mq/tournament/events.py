@@ -0,0 +1,369 @@
+import json
+import logging
+import os
+import socket
+import time
+import uuid
+from datetime import timedelta
+from typing import Callable, Dict, List, Optional, Sequence, Set
+
+import pika
+from pika import BasicProperties, ConnectionParameters
+from pika.exceptions import AMQPConnectionError, AMQPChannelError, ChannelClosed
+
+logger = logging.getLogger(__name__)
+
+# Consumers announce what happens to games here, see docker/definitions.json
+EVENTS_EXCHANGE = 'play.events'
+EVENTS_EXCHANGE_TYPE = 'fanout'
+
+# Results of finished games, for subscribers that analyze games as they come.
+RESULTS_EXCHANGE = 'play.results'
+RESULTS_EXCHANGE_TYPE = 'fanout'
+
+EXCHANGES = ((EVENTS_EXCHANGE, EVENTS_EXCHANGE_TYPE),
+             (RESULTS_EXCHANGE, RESULTS_EXCHANGE_TYPE))
+
+STARTED = "started"
+FINISHED = "finished"
+FAILED = "failed"
+
+# Events are only informative, they don't need to survive a broker restart.
+EVENT_PROPERTIES = BasicProperties(delivery_mode=1, content_type="application/json")
+# Results are kept in durable queues of subscribers.
+RESULT_PROPERTIES = BasicProperties(delivery_mode=2, content_type="application/json")
+
+# The event queue of a watcher keeps events while its connection is lost,
+# the broker removes the queue once it has been unused for this long.
+WATCH_QUEUE_EXPIRES = 24 * 3600 * 1000
+
+
+def worker_id() -> str:
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+class GameEvent:
+    kind: str
+    game_name: str
+    worker: str
+    time: float
+    duration: Optional[float]
+    # tournament of the game, see PlayMessage
+    tournament: Optional[str]
+
+    def __init__(self, kind, game_name, worker, time, duration=None, tournament=None):
+        self.kind = kind
+        self.game_name = game_name
+        self.worker = worker
+        self.time = time
+        self.duration = duration
+        self.tournament = tournament
+
+    def serialize(self) -> str:
+        return json.dumps(self.__dict__)
+
+    @staticmethod
+    def deserialize(json_msg):
+        msg = json.loads(json_msg)
+        return GameEvent(msg['kind'],
+                         msg['game_name'],
+                         msg['worker'],
+                         msg['time'],
+                         msg.get('duration'),
+                         msg.get('tournament'))
+
+    def __str__(self):
+        return self.serialize()
+
+
+class GameResultEvent:
+    game_name: str
+    bots: List[str]
+    map: str
+    winner: Optional[str]
+    loser: Optional[str]
+    winner_race: Optional[str]
+    loser_race: Optional[str]
+    game_time: float
+    duration: Optional[float]
+    worker: str
+    tournament: Optional[str]
+
+    def __init__(self, game_name, bots, map, winner, loser, winner_race, loser_race,
+                 game_time, duration, worker, tournament=None):
+        self.game_name = game_name
+        self.bots = bots
+        self.map = map
+        self.winner = winner
+        self.loser = loser
+        self.winner_race = winner_race
+        self.loser_race = loser_race
+        self.game_time = game_time
+        self.duration = duration
+        self.worker = worker
+        self.tournament = tournament
+
+    @staticmethod
+    def from_result(game_name: str, info: dict, duration: Optional[float], worker: str,
+                    tournament: Optional[str] = None):
+        """
+        :param info: contents of the result.json of the game, see scbw.game.run_game
+        """
+        return GameResultEvent(game_name,
+                               info['bots'],
+                               info['map'],
+                               info['winner'],
+                               info['loser'],
+                               info['winner_race'],
+                               info['loser_race'],
+                               info['game_time'],
+                               duration,
+                               worker,
+                               tournament)
+
+    def serialize(self) -> str:
+        return json.dumps(self.__dict__)
+
+    @staticmethod
+    def deserialize(json_msg):
+        msg = json.loads(json_msg)
+        return GameResultEvent(**msg)
+
+    def __str__(self):
+        return self.serialize()
+
+
+def read_result(game_dir: str, game_name: str) -> Optional[dict]:
+    # scbw records results of 1v1 games only
+    result_file = f"{game_dir}/GAME_{game_name}/result.json"
+    if not os.path.exists(result_file):
+        return None
+    with open(result_file, "r") as f:
+        return json.load(f)
+
+
+def declare_exchanges(channel) -> None:
+    for exchange, exchange_type in EXCHANGES:
+        channel.exchange_declare(exchange=exchange, exchange_type=exchange_type, durable=True)
+
+
+def declare_exchanges_async(channel, callback: Callable[[], None], exchanges=EXCHANGES) -> None:
+    if not exchanges:
+        callback()
+        return
+
+    (exchange, exchange_type), *rest = exchanges
+    channel.exchange_declare(lambda frame: declare_exchanges_async(channel, callback, rest),
+                             exchange=exchange, exchange_type=exchange_type, durable=True)
+
+
+class EventEmitter:
+    """
+    Publishes events about the games played by one worker.
+    """
+
+    def __init__(self):
+        self.worker = worker_id()
+        self.channel = None
+        self._started: Dict[str, float] = {}
+
+    def emit(self, kind: str, game_name: str, tournament: Optional[str] = None) -> Optional[float]:
+        """
+        :returns: duration of the game, if it has ended
+        """
+        now = time.time()
+        duration = None
+        if kind == STARTED:
+            self._started[game_name] = now
+        elif game_name in self._started:
+            duration = now - self._started.pop(game_name)
+
+        event = GameEvent(kind, game_name, self.worker, now, duration, tournament)
+        self.publish(EVENTS_EXCHANGE, event, EVENT_PROPERTIES)
+        return duration
+
+    def publish(self, exchange: str, event, properties: BasicProperties) -> None:
+        if self.channel is None or not self.channel.is_open:
+            return
+        try:
+            self.channel.basic_publish(exchange=exchange, routing_key='',
+                                       body=event.serialize(), properties=properties)
+        except Exception:
+            # losing an event only makes progress reports less accurate,
+            # results can still be read from the game directory
+            logger.warning(f"Cannot publish event {event}", exc_info=True)
+
+    def started(self, game_name: str, tournament: Optional[str] = None) -> None:
+        self.emit(STARTED, game_name, tournament)
+
+    def finished(self, game_name: str, result: Optional[dict] = None,
+                 tournament: Optional[str] = None) -> None:
+        duration = self.emit(FINISHED, game_name, tournament)
+        if result is not None:
+            event = GameResultEvent.from_result(game_name, result, duration, self.worker,
+                                                tournament)
+            self.publish(RESULTS_EXCHANGE, event, RESULT_PROPERTIES)
+
+    def failed(self, game_name: str, tournament: Optional[str] = None) -> None:
+        self.emit(FAILED, game_name, tournament)
+
+
+class ProgressTracker:
+    """
+    Counts games of a tournament from the events of consumers.
+
+    Consumers publish events of all tournaments to the same exchange,
+    events of other tournaments or of games that weren't published
+    by this one are ignored.
+    """
+
+    def __init__(self, total: int, tournament: Optional[str] = None,
+                 game_names: Optional[Set[str]] = None):
+        self.total = total
+        self.tournament = tournament
+        self.game_names = game_names
+        self.start_time = time.time()
+        self.in_flight: Dict[str, float] = {}
+        self.completed: Set[str] = set()
+        self.failed: Set[str] = set()
+        self.total_duration = 0.
+        self.max_in_flight = 0
+        self.last_update = self.start_time
+
+    def accepts(self, event: GameEvent) -> bool:
+        return (self.tournament is None or event.tournament == self.tournament) \
+               and (self.game_names is None or event.game_name in self.game_names)
+
+    def update(self, event: GameEvent) -> bool:
+        """
+        :returns: whether the event belongs to the tournament
+        """
+        if not self.accepts(event):
+            return False
+
+        self.last_update = time.time()
+        if event.kind == STARTED:
+            self.in_flight[event.game_name] = event.time
+            self.max_in_flight = max(self.max_in_flight, len(self.in_flight))
+            return True
+
+        started = self.in_flight.pop(event.game_name, None)
+        if event.kind == FINISHED and event.game_name not in self.completed:
+            self.completed.add(event.game_name)
+            self.failed.discard(event.game_name)
+            if event.duration is not None:
+                self.total_duration += event.duration
+            elif started is not None:
+                self.total_duration += event.time - started
+        elif event.kind == FAILED and event.game_name not in self.completed:
+            self.failed.add(event.game_name)
+        return True
+
+    @property
+    def done(self) -> int:
+        return len(self.completed) + len(self.failed)
+
+    @property
+    def finished(self) -> bool:
+        return self.done >= self.total
+
+    @property
+    def elapsed(self) -> float:
+        return time.time() - self.start_time
+
+    @property
+    def idle(self) -> float:
+        """
+        Seconds since the last event, while no game is being played.
+        """
+        if self.in_flight:
+            return 0.
+        return time.time() - self.last_update
+
+    @property
+    def games_per_hour(self) -> float:
+        elapsed = self.elapsed
+        return 3600 * len(self.completed) / elapsed if elapsed > 0 else 0.
+
+    @property
+    def eta(self) -> Optional[float]:
+        """
+        Seconds until all games are played, estimated from the durations
+        of finished games and the number of games played at once.
+        """
+        if not self.completed:
+            return None
+        mean_duration = self.total_duration / len(self.completed)
+        slots = max(self.max_in_flight, 1)
+        return (self.total - self.done) * mean_duration / slots
+
+    def summary(self) -> Dict[str, str]:
+        eta = self.eta
+        return {
+            "in_flight": str(len(self.in_flight)),
+            "failed": str(len(self.failed)),
+            "games/h": f"{self.games_per_hour:.1f}",
+            "eta": "?" if eta is None else str(timedelta(seconds=int(eta))),
+        }
+
+
+class ProgressWatcher:
+    """
+    Subscribes to game events, it should be created before the games are published
+    so that no event is missed.
+
+    The connection is not serviced until events are read, e.g. while games are published,
+    so it may be closed by the broker for missed heartbeats, it is then opened again.
+    """
+
+    def __init__(self, connection_params: ConnectionParameters):
+        self._connection_params = connection_params
+        self._queue = f"{EVENTS_EXCHANGE}.watch.{uuid.uuid4().hex}"
+        self.connect()
+
+    def connect(self):
+        self._connection = pika.BlockingConnection(self._connection_params)
+        self._channel = self._connection.channel()
+        declare_exchanges(self._channel)
+        self._channel.queue_declare(queue=self._queue,
+                                    arguments={"x-expires": WATCH_QUEUE_EXPIRES})
+        self._channel.queue_bind(queue=self._queue, exchange=EVENTS_EXCHANGE)
+
+    def events(self, timeout: float = 1.):
+        """
+        Yields received events, or None when nothing has come within timeout.
+        """
+        while True:
+            try:
+                for method, properties, body in self._channel.consume(
+                        self._queue, no_ack=True, inactivity_timeout=timeout):
+                    if method is None:
+                        yield None
+                        continue
+                    try:
+                        yield GameEvent.deserialize(body.decode("utf-8"))
+                    except (ValueError, KeyError):
+                        logger.warning(f"Ignoring malformed event {body}")
+            except (AMQPConnectionError, AMQPChannelError):
+                logger.warning("Connection for game events was lost, reconnecting", exc_info=True)
+                self.connect()
+
+    def pending_messages(self, queues: Sequence[str]) -> int:
+        """
+        Messages waiting in the queues, those that consumers have taken are not counted.
+        A queue that doesn't exist is empty.
+        """
+        pending = 0
+        for queue in queues:
+            channel = self._connection.channel()
+            try:
+                pending += channel.queue_declare(queue=queue, passive=True).method.message_count
+            except ChannelClosed:
+                continue
+            channel.close()
+        return pending
+
+    def close(self):
+        if self._connection.is_open:
+            self._channel.queue_delete(queue=self._queue)
+            self._connection.close()
@@ -0,0 +1,167 @@
+import logging
+import os
+import socket
+import sqlite3
+import time
+from typing import Optional, Set
+
+from ..utils import pid_alive
+
+logger = logging.getLogger(__name__)
+
+# The ledger lives next to the games it describes, so that clearing
+# the game directory for a new tournament clears the ledger too.
+LEDGER_FILE = "ledger.sqlite"
+
+STARTED = "started"
+FINISHED = "finished"
+FAILED = "failed"
+
+# How long a started game may run before others can take it over,
+# if its worker cannot be checked.
+DEFAULT_STALE_AFTER = 3600.
+
+
+class GameLedger:
+    """
+    Records which games were started, finished or failed, keyed by game name,
+    so that duplicate game requests are not played again.
+
+    Shared by all consumers that write to the same game directory.
+    Finished games are also kept in memory, as they never change state.
+
+    The database is created only when the first game is started, so that idle
+    consumers don't make the game directory look used to the producer.
+
+    The ledger file is checked for having been cleared with a new tournament
+    only before a game is started, and before a game is skipped as finished,
+    so handling a message doesn't stat the (shared) storage otherwise.
+
+    SQLite serializes workers with fcntl locks, which many NFS setups don't honour.
+    The game directory must be on local storage, or on a shared filesystem whose
+    locks are known to work, otherwise workers of different hosts may play
+    the same game twice.
+    """
+
+    def __init__(self, game_dir: str, stale_after: float = DEFAULT_STALE_AFTER):
+        self.game_dir = game_dir
+        self.path = f"{game_dir}/{LEDGER_FILE}"
+        self.stale_after = stale_after
+        self.host = socket.gethostname()
+        self.pid = os.getpid()
+        self._finished: Set[str] = set()
+        self._db: Optional[sqlite3.Connection] = None
+        self._inode: Optional[int] = None
+
+    @property
+    def db(self) -> sqlite3.Connection:
+        if self._db is None:
+            self.open()
+        return self._db
+
+    def open(self) -> None:
+        os.makedirs(self.game_dir, exist_ok=True)
+        self._db = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+        self._inode = os.stat(self.path).st_ino
+        self._db.execute("CREATE TABLE IF NOT EXISTS games ("
+                         "game_name TEXT PRIMARY KEY, "
+                         "state TEXT NOT NULL, "
+                         "host TEXT NOT NULL, "
+                         "pid INTEGER NOT NULL, "
+                         "updated REAL NOT NULL)")
+        self._finished.update(name for name, in self._db.execute(
+            "SELECT game_name FROM games WHERE state = ?", (FINISHED,)))
+
+    def refresh(self) -> bool:
+        """
+        Forget what is known if the ledger has been removed,
+        i.e. the game directory was cleared for a new tournament.
+
+        :returns: True if the ledger was forgotten
+        """
+        if self._db is None:
+            return False
+        try:
+            inode = os.stat(self.path).st_ino
+        except FileNotFoundError:
+            inode = None
+        if inode == self._inode:
+            return False
+
+        logger.info(f"Ledger {self.path} has been removed, starting a new one")
+        self.close()
+        self._finished.clear()
+        return True
+
+    def state(self, game_name: str) -> Optional[str]:
+        """
+        State of the game as far as this worker knows, the ledger is not opened for it.
+        """
+        if self._db is None:
+            return None
+        if game_name in self._finished:
+            state = FINISHED
+        else:
+            row = self._db.execute("SELECT state FROM games WHERE game_name = ?",
+                                   (game_name,)).fetchone()
+            state = None if row is None else row[0]
+
+        # the game may be of a new tournament that reuses its name
+        if state == FINISHED and self.refresh():
+            return None
+        return state
+
+    def try_start(self, game_name: str) -> bool:
+        """
+        Mark the game as started, unless it has already finished
+        or is being played by a live worker.
+        """
+        self.refresh()
+        if game_name in self._finished:
+            return False
+
+        # take the write lock before reading, so that two workers cannot both start the game
+        self.db.execute("BEGIN IMMEDIATE")
+        try:
+            row = self._db.execute("SELECT state, host, pid, updated FROM games "
+                                   "WHERE game_name = ?", (game_name,)).fetchone()
+            if row is not None and not self.can_take_over(*row):
+                if row[0] == FINISHED:
+                    self._finished.add(game_name)
+                self._db.execute("COMMIT")
+                return False
+
+            self._db.execute("INSERT OR REPLACE INTO games VALUES (?, ?, ?, ?, ?)",
+                             (game_name, STARTED, self.host, self.pid, time.time()))
+            self._db.execute("COMMIT")
+            return True
+        except BaseException:
+            self._db.execute("ROLLBACK")
+            raise
+
+    def can_take_over(self, state: str, host: str, pid: int, updated: float) -> bool:
+        if state == FINISHED:
+            return False
+        if state == FAILED:
+            return True
+
+        if host == self.host and not pid_alive(pid):
+            logger.warning(f"Worker {pid} has died while playing, taking over its game")
+            return True
+        return time.time() - updated > self.stale_after
+
+    def finish(self, game_name: str) -> None:
+        self._set_state(game_name, FINISHED)
+        self._finished.add(game_name)
+
+    def fail(self, game_name: str) -> None:
+        self._set_state(game_name, FAILED)
+
+    def _set_state(self, game_name: str, state: str) -> None:
+        self.db.execute("UPDATE games SET state = ?, updated = ? WHERE game_name = ?",
+                         (state, time.time(), game_name))
+
+    def close(self) -> None:
+        if self._db is not None:
+            self._db.close()
+            self._db = None
@@ -1,26 +1,171 @@
 import json
-from typing import List
+import struct
+from typing import List, Optional, Union
+
+# Binary messages start with a byte that can never start a JSON document,
+# so that consumers can still read JSON messages from older producers.
+WIRE_MAGIC = 0xB7
+# version 2 adds the tournament of each game
+WIRE_VERSION = 2
+
+KIND_GAME = 0
+KIND_BATCH = 1
+
+WIRE_FORMATS = ("json", "binary")
+
+_HEADER = struct.Struct("<BBB")
+_COUNT = struct.Struct("<H")
+_GAME_V1 = struct.Struct("<HHB")
+_GAME = struct.Struct("<HHHB")
+# string index of a game without tournament
+NO_STRING = 0xFFFF
 
 
 class PlayMessage:
     bots: List[str]
     map: str
     game_name: str
+    # id of the tournament the game belongs to, carried to game events
+    tournament: Optional[str]
 
-    def __init__(self, bots, map, game_name):
+    def __init__(self, bots, map, game_name, tournament=None):
         self.bots = bots
         self.map = map
         self.game_name = game_name
+        self.tournament = tournament
 
     def serialize(self) -> str:
         return json.dumps(self.__dict__)
 
+    def encode(self) -> bytes:
+        return encode_games([self], KIND_GAME)
+
     @staticmethod
     def deserialize(json_msg):
+        if is_binary(json_msg):
+            games = decode_games(json_msg)
+            if len(games) != 1:
+                raise ValueError(f"Expected a single game, got {len(games)}")
+            return games[0]
+
         msg = json.loads(json_msg)
         return PlayMessage(msg['bots'],
                            msg['map'],
-                           msg['game_name'])
+                           msg['game_name'],
+                           msg.get('tournament'))
+
+    def __str__(self):
+        return self.serialize()
+
+
+class PlayBatchMessage:
+    """
+    Several games sent in one message, to save per-message broker overhead.
+    """
+    games: List[PlayMessage]
+
+    def __init__(self, games):
+        self.games = games
+
+    def serialize(self) -> str:
+        return json.dumps({"games": [game.__dict__ for game in self.games]})
+
+    def encode(self) -> bytes:
+        return encode_games(self.games, KIND_BATCH)
+
+    @staticmethod
+    def deserialize(msg):
+        return PlayBatchMessage(deserialize_games(msg))
 
     def __str__(self):
         return self.serialize()
+
+
+def is_binary(msg: Union[str, bytes]) -> bool:
+    return isinstance(msg, bytes) and len(msg) > 0 and msg[0] == WIRE_MAGIC
+
+
+def deserialize_games(msg: Union[str, bytes]) -> List[PlayMessage]:
+    """
+    Read games from a message in any supported format,
+    i.e. a single game or a batch, in JSON or binary.
+    """
+    if is_binary(msg):
+        return decode_games(msg)
+
+    info = json.loads(msg)
+    if "games" in info:
+        return [PlayMessage(game['bots'], game['map'], game['game_name'], game.get('tournament'))
+                for game in info["games"]]
+    return [PlayMessage(info['bots'], info['map'], info['game_name'], info.get('tournament'))]
+
+
+def serialize_games(games: List[PlayMessage], wire_format: str = "json") -> Union[str, bytes]:
+    if wire_format not in WIRE_FORMATS:
+        raise ValueError(f"Unknown wire format '{wire_format}'")
+
+    message = games[0] if len(games) == 1 else PlayBatchMessage(games)
+    if wire_format == "binary":
+        return message.encode()
+    return message.serialize()
+
+
+def encode_games(games: List[PlayMessage], kind: int) -> bytes:
+    # Bots and maps repeat a lot within a batch, so all strings
+    # are stored once in a table and games refer to them by index.
+    strings = {}
+    for game in games:
+        for string in (game.game_name, game.map, *game.bots):
+            strings.setdefault(string, len(strings))
+        if game.tournament is not None:
+            strings.setdefault(game.tournament, len(strings))
+
+    parts = [_HEADER.pack(WIRE_MAGIC, WIRE_VERSION, kind),
+             _COUNT.pack(len(strings))]
+    for string in strings:
+        data = string.encode("utf-8")
+        parts.append(_COUNT.pack(len(data)))
+        parts.append(data)
+
+    parts.append(_COUNT.pack(len(games)))
+    for game in games:
+        tournament = NO_STRING if game.tournament is None else strings[game.tournament]
+        parts.append(_GAME.pack(strings[game.game_name], strings[game.map], tournament,
+                                len(game.bots)))
+        parts.append(struct.pack(f"<{len(game.bots)}H", *(strings[bot] for bot in game.bots)))
+
+    return b"".join(parts)
+
+
+def decode_games(msg: bytes) -> List[PlayMessage]:
+    magic, version, kind = _HEADER.unpack_from(msg, 0)
+    if version not in (1, WIRE_VERSION):
+        raise ValueError(f"Unsupported message version {version}")
+    offset = _HEADER.size
+
+    n_strings, = _COUNT.unpack_from(msg, offset)
+    offset += _COUNT.size
+    strings = []
+    for _ in range(n_strings):
+        length, = _COUNT.unpack_from(msg, offset)
+        offset += _COUNT.size
+        strings.append(msg[offset:offset + length].decode("utf-8"))
+        offset += length
+
+    n_games, = _COUNT.unpack_from(msg, offset)
+    offset += _COUNT.size
+    games = []
+    for _ in range(n_games):
+        if version == 1:
+            name, map_name, n_bots = _GAME_V1.unpack_from(msg, offset)
+            tournament = NO_STRING
+            offset += _GAME_V1.size
+        else:
+            name, map_name, tournament, n_bots = _GAME.unpack_from(msg, offset)
+            offset += _GAME.size
+        bots = struct.unpack_from(f"<{n_bots}H", msg, offset)
+        offset += 2 * n_bots
+        games.append(PlayMessage([strings[bot] for bot in bots], strings[map_name], strings[name],
+                                 None if tournament == NO_STRING else strings[tournament]))
+
+    return games
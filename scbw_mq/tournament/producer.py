@@ -1,21 +1,29 @@
 import logging
 import os
 from argparse import Namespace
-from random import choice, shuffle
-from typing import Iterable, Optional
+from datetime import timedelta
+from functools import lru_cache
+from typing import Iterable, Iterator, List, Optional, Set, Tuple, Union
 
 import pika
-from pika import PlainCredentials
-from pika.adapters.blocking_connection import BlockingChannel
+from pika import BasicProperties, PlainCredentials
 from scbw.bot_factory import retrieve_bots
 from scbw.bot_storage import LocalBotStorage, SscaitBotStorage
 from scbw.map import check_map_exists
 
-from .message import PlayMessage
+from .durations import predict_makespan, read_durations
+from .message import PlayMessage, serialize_games
+from .schedule import AllVsAllSchedule, LongestFirstSchedule, OneVsAllSchedule, RoundRobinSchedule
+from .schedule import Schedule, ScheduleException
+from .schedule import Checkpoint, random_seed
+from ..rabbitmq_publisher import ConfirmPublisher, PERSISTENT_PROPERTIES
 from ..utils import read_lines
 
 logger = logging.getLogger(__name__)
 
+# Highest priority of games, the x-max-priority of the play queue, see docker/definitions.json
+MAX_PRIORITY = 10
+
 
 class ProducerConfig(Namespace):
     # rabbit connection
@@ -33,57 +41,127 @@ class ProducerConfig(Namespace):
     map_dir: str
     game_dir: str
 
+    # publishing
+    publish_window: int
+    publish_batch_size: int
+    publish_retries: int
+    wire_format: str
+    games_per_message: int
+
+    # games of higher priority are played before games already waiting in the queue
+    priority: int
+
+    # carried in games and their events, so that watchers count games of this tournament only
+    tournament: Optional[str]
+
+    # schedule
+    seed: Optional[int]
+    shards: int
+    shard: int
+    checkpoint_file: Optional[str]
+    round_workers: int
+
+    # order by durations of earlier games
+    durations_from: Optional[List[str]]
+    workers: int
+
+
+def all_vs_all_games(repeat_games: int, bots: List[str], maps: Iterable[str],
+                     seed: Optional[int] = None) -> Iterator[PlayMessage]:
+    schedule = AllVsAllSchedule(bots, list(maps), repeat_games,
+                                random_seed() if seed is None else seed)
+    return schedule.games()
+
+
+def one_vs_all_games(one_bot: str, repeat_games: int,
+                     bots: Iterable[str], maps: Iterable[str],
+                     seed: Optional[int] = None) -> Iterator[PlayMessage]:
+    schedule = OneVsAllSchedule(one_bot, list(bots), list(maps), repeat_games,
+                                random_seed() if seed is None else seed)
+    return schedule.games()
+
+
+def create_schedule(args: ProducerConfig, bots: List[str], maps: List[str],
+                    seed: int) -> Schedule:
+    if args.test_bot is not None:
+        return OneVsAllSchedule(args.test_bot, bots, maps, args.repeat_games, seed)
+    if args.round_workers > 0:
+        return RoundRobinSchedule(bots, maps, args.repeat_games, seed, args.round_workers)
+    return AllVsAllSchedule(bots, maps, args.repeat_games, seed)
+
+
+def order_longest_first(args: ProducerConfig, schedule: Schedule) -> LongestFirstSchedule:
+    """
+    Order games by their durations predicted from earlier games, longest first.
+    Games of bots that haven't played each other are predicted to take the mean time
+    of all earlier games, they keep their random order among games of that length.
+    """
+    if args.round_workers > 0:
+        raise ScheduleException("Games cannot be ordered both in rounds and by durations, "
+                                "use either --round_workers or --durations_from")
+    model = read_durations(args.durations_from)
+    if not len(model):
+        raise ScheduleException(f"No game times found in {', '.join(args.durations_from)}")
 
-def publish_all_vs_all(channel: BlockingChannel, repeat_games: int,
-                       bots: Iterable[str], maps: Iterable[str]) -> int:
+    unseen = 0
 
-    # randomize order of bots playing against each other
-    bot_combinations = []
-    j = 0
-    for i, bot_a in enumerate(bots):
-        for bot_b in bots[(i + 1):]:
-            bot_combinations.append((bot_a, bot_b, j))
-            j += 1
-    shuffle(bot_combinations)
+    def predict(game: PlayMessage) -> float:
+        nonlocal unseen
+        duration = model.predict(game.bots, game.map)
+        if duration is None:
+            unseen += 1
+            return model.mean
+        return duration
 
-    n = 0
-    for _ in range(repeat_games):
-        for map_name in maps:
-            for bot_a, bot_b, j in bot_combinations:
-                game_name = "%06d" % (n+j)
-                msg = PlayMessage([bot_a, bot_b], map_name, game_name).serialize()
-                publish_msg(channel, msg)
+    ordered = LongestFirstSchedule(schedule, predict)
+    logger.info(f"Predicted durations of {len(ordered) - unseen} games, "
+                f"{unseen} games of bots that haven't played each other take the mean time")
 
-            n += len(bot_combinations)
-    return n
+    workers = max(1, args.workers)
+    longest_first = predict_makespan(ordered.predicted_durations(), workers)
+    random_order = predict_makespan(ordered.durations, workers)
+    lower_bound = max(sum(ordered.durations) / workers, max(ordered.durations, default=0.))
+    logger.info(f"Predicted makespan with {workers} games at once: "
+                f"{timedelta(seconds=int(longest_first))} longest first, "
+                f"{timedelta(seconds=int(random_order))} in random order, "
+                f"at least {timedelta(seconds=int(lower_bound))}")
+    return ordered
 
 
-def publish_one_vs_all(channel: BlockingChannel, one_bot: str,
-                       repeat_games: int, bots: Iterable[str], maps: Iterable[str]) -> int:
-    n = 0
-    for _ in range(repeat_games):
-        for other_bot in bots:
-            for map_name in maps:
-                game_name = "".join(choice("0123456789ABCDEF")
-                                    for _ in range(8)) + "_%06d" % n
-                msg = PlayMessage([one_bot, other_bot], map_name, game_name).serialize()
-                publish_msg(channel, msg)
+def game_messages(games: Iterable[PlayMessage], wire_format: str = "json",
+                  games_per_message: int = 1) -> Iterator[Union[str, bytes]]:
+    batch = []
+    for game in games:
+        batch.append(game)
+        if len(batch) == games_per_message:
+            yield serialize_games(batch, wire_format)
+            batch = []
 
-                n += 1
-    return n
+    if batch:
+        yield serialize_games(batch, wire_format)
 
 
-def publish_msg(channel, msg):
+@lru_cache(maxsize=None)
+def play_properties(priority: Optional[int] = None) -> BasicProperties:
+    if not priority:
+        return PERSISTENT_PROPERTIES
+    if not 0 < priority <= MAX_PRIORITY:
+        raise ValueError(f"Priority must be between 0 and {MAX_PRIORITY}, got {priority}")
+    return BasicProperties(delivery_mode=2, priority=priority)
+
+
+def publish_msg(channel, msg, exchange='', routing_key='play', properties=PERSISTENT_PROPERTIES):
     channel.basic_publish(
-        exchange='',
-        routing_key='play',
+        exchange=exchange,
+        routing_key=routing_key,
         body=msg,
-        properties=pika.BasicProperties(
-            delivery_mode=2,  # make message persistent
-        ))
+        properties=properties)
 
 
-def launch_producer(args: ProducerConfig) -> int:
+def prepare_tournament(args: ProducerConfig) -> Tuple[List[str], List[str]]:
+    """
+    :returns: bots and maps of the tournament, all of them available
+    """
     bots = read_lines(args.bot_file)
     maps = read_lines(args.map_file)
 
@@ -96,28 +174,92 @@ def launch_producer(args: ProducerConfig) -> int:
     for map in maps:
         check_map_exists(args.map_dir + "/" + map)
     os.makedirs(args.game_dir, exist_ok=True)
+    return bots, maps
+
 
-    if len(os.listdir(args.game_dir)) != 0:
-        raise Exception(f"Result dir '{args.game_dir}' is not empty!"
+def check_empty_game_dir(game_dir: str) -> None:
+    if len(os.listdir(game_dir)) != 0:
+        raise Exception(f"Result dir '{game_dir}' is not empty!"
                         "Please empty the dir or use different result dir as destination.")
 
-    connection = pika.BlockingConnection(pika.ConnectionParameters(
-        host=args.host,
-        port=args.port,
-        connection_attempts=5,
-        retry_delay=3,
-        credentials=PlainCredentials(args.user, args.password)
-    ))
 
-    try:
-        channel = connection.channel()
+def tournament_id(seed: int) -> str:
+    """
+    Shards and restarts of a tournament share its seed, and so the id.
+    """
+    return f"{seed:08x}"
+
+
+def launch_producer(args: ProducerConfig, game_names: Optional[Set[str]] = None) -> int:
+    """
+    :param game_names: collects names of the published games
+    :returns: number of published games
+    """
+    bots, maps = prepare_tournament(args)
+
+    checkpoint = None
+    resuming = False
+    seed = args.seed
+    if args.checkpoint_file is not None:
+        checkpoint = Checkpoint(args.checkpoint_file)
+        resuming = checkpoint.load()
+        if resuming and seed is None:
+            seed = checkpoint.seed
+    if seed is None:
+        if args.shards > 1:
+            raise ScheduleException("All shards of a tournament need the same --seed")
+        seed = random_seed()
+        logger.info(f"Using seed {seed}")
+
+    tournament = args.tournament or tournament_id(seed)
+    logger.info(f"Publishing games of tournament {tournament}")
+
+    schedule = create_schedule(args, bots, maps, seed)
+    if args.durations_from:
+        schedule = order_longest_first(args, schedule)
+    start = 0
+    if resuming:
+        checkpoint.check(schedule, args.shard, args.shards)
+        start = checkpoint.position
+        logger.info(f"Resuming shard {args.shard} of {args.shards} at game {start} "
+                    f"of {schedule.shard_len(args.shard, args.shards)}")
+    elif args.shards == 1:
+        # games of shards published earlier may have been played already
+        check_empty_game_dir(args.game_dir)
+
+    def save_progress(n_messages: int):
+        if checkpoint is not None:
+            position = min(start + n_messages * args.games_per_message,
+                           schedule.shard_len(args.shard, args.shards))
+            checkpoint.save(schedule, args.shard, args.shards, position)
+
+    publisher = ConfirmPublisher(
+        pika.ConnectionParameters(
+            host=args.host,
+            port=args.port,
+            connection_attempts=5,
+            retry_delay=3,
+            credentials=PlainCredentials(args.user, args.password)
+        ),
+        routing_key='play',
+        properties=play_properties(args.priority),
+        window=args.publish_window,
+        batch_size=args.publish_batch_size,
+        max_retries=args.publish_retries,
+        on_progress=save_progress)
+
+    games = schedule.games(start, args.shard, args.shards)
 
-        if args.test_bot is not None:
-            n = publish_one_vs_all(channel, args.test_bot, args.repeat_games, bots, maps)
-        else:
-            n = publish_all_vs_all(channel, args.repeat_games, bots, maps)
+    n_games = 0
 
-        return n
+    def counted(games: Iterable[PlayMessage]) -> Iterator[PlayMessage]:
+        nonlocal n_games
+        for game in games:
+            n_games += 1
+            game.tournament = tournament
+            if game_names is not None:
+                game_names.add(game.game_name)
+            yield game
 
-    finally:
-        connection.close()
+    publisher.publish(game_messages(counted(games), args.wire_format, args.games_per_message))
+    return n_games
@@ -0,0 +1,358 @@
+import hashlib
+import json
+import logging
+import math
+import os
+import random
+from array import array
+from typing import Callable, Iterator, List, Optional, Tuple
+
+from .message import PlayMessage
+
+logger = logging.getLogger(__name__)
+
+FEISTEL_ROUNDS = 4
+
+
+class ScheduleException(Exception):
+    pass
+
+
+def keyed_hash(seed: int, *values) -> int:
+    data = ":".join(str(value) for value in (seed,) + values).encode("utf-8")
+    return int.from_bytes(hashlib.blake2b(data, digest_size=8).digest(), "little")
+
+
+class KeyedPermutation:
+    """
+    Seeded bijection of range(n) that is computed for one index at a time,
+    so that a shuffled order never has to be kept in memory.
+
+    A Feistel network permutes the smallest even power of two that holds n,
+    indices that fall outside of range(n) are permuted again until they don't.
+    """
+
+    def __init__(self, n: int, seed: int):
+        self.n = n
+        self.seed = seed
+        self.half_bits = max(1, (max(n - 1, 1).bit_length() + 1) // 2)
+        self.mask = (1 << self.half_bits) - 1
+
+    def __call__(self, index: int) -> int:
+        if not 0 <= index < self.n:
+            raise IndexError(f"Index {index} is out of range {self.n}")
+        # the domain is less than four times n, so this takes a few rounds on average
+        index = self.encrypt(index)
+        while index >= self.n:
+            index = self.encrypt(index)
+        return index
+
+    def encrypt(self, value: int) -> int:
+        left, right = value >> self.half_bits, value & self.mask
+        for round in range(FEISTEL_ROUNDS):
+            left, right = right, left ^ (keyed_hash(self.seed, round, right) & self.mask)
+        return (left << self.half_bits) | right
+
+
+def pair_count(n: int) -> int:
+    return n * (n - 1) // 2
+
+
+def rank_pair(i: int, k: int, n: int) -> int:
+    if i > k:
+        i, k = k, i
+    return pair_count(n) - pair_count(n - i) + k - i - 1
+
+
+def unrank_pair(j: int, n: int) -> Tuple[int, int]:
+    """
+    Inverse of enumerating pairs (i, k), i < k < n, row by row.
+    """
+    i = n - 2 - int(math.sqrt(-8 * j + 4 * n * (n - 1) - 7) / 2. - 0.5)
+    # floating point may be off by one for many bots
+    while i > 0 and pair_count(n) - pair_count(n - i) > j:
+        i -= 1
+    while pair_count(n) - pair_count(n - i - 1) <= j:
+        i += 1
+    k = j - (pair_count(n) - pair_count(n - i)) + i + 1
+    return i, k
+
+
+class Schedule:
+    """
+    Deterministic order of the games of a tournament.
+
+    Each game is computed from its position alone, so the schedule is produced lazily,
+    it can be split into disjoint shards and resumed from any position.
+    """
+
+    def __init__(self, bots: List[str], maps: List[str], repeat_games: int, seed: int):
+        self.bots = list(bots)
+        self.maps = list(maps)
+        self.repeat_games = repeat_games
+        self.seed = seed
+
+    def __len__(self) -> int:
+        raise NotImplementedError
+
+    def game(self, position: int) -> PlayMessage:
+        raise NotImplementedError
+
+    def fingerprint(self) -> str:
+        """
+        Identifies the schedule, so that a checkpoint is not used with other games.
+        """
+        spec = json.dumps([type(self).__name__, self.bots, self.maps,
+                           self.repeat_games, self.seed])
+        return hashlib.sha1(spec.encode("utf-8")).hexdigest()
+
+    def shard_len(self, shard: int = 0, shards: int = 1) -> int:
+        return max(0, (len(self) - shard + shards - 1) // shards)
+
+    def games(self, start: int = 0, shard: int = 0, shards: int = 1) -> Iterator[PlayMessage]:
+        """
+        Yields games of the shard, which takes every `shards`-th game of the schedule.
+
+        :param start: position within the shard to start from
+        """
+        if not 0 <= shard < shards:
+            raise ScheduleException(f"Shard {shard} is not one of {shards} shards")
+        for position in range(shard + start * shards, len(self), shards):
+            yield self.game(position)
+
+
+class AllVsAllSchedule(Schedule):
+    """
+    Each pair of bots plays on every map, repeatedly.
+    The order of pairs is shuffled, the same way for every map and repetition.
+    Game names number the pairs in the order they are listed, as before shuffling.
+    """
+
+    def __init__(self, bots: List[str], maps: List[str], repeat_games: int, seed: int):
+        super(AllVsAllSchedule, self).__init__(bots, maps, repeat_games, seed)
+        self.n_pairs = pair_count(len(self.bots))
+        self.permutation = KeyedPermutation(self.n_pairs, seed)
+
+    def __len__(self) -> int:
+        return self.repeat_games * len(self.maps) * self.n_pairs
+
+    def game(self, position: int) -> PlayMessage:
+        block, slot = divmod(position, self.n_pairs)
+        j = self.permutation(slot)
+        bot_a, bot_b = unrank_pair(j, len(self.bots))
+        game_name = "%06d" % (block * self.n_pairs + j)
+        return PlayMessage([self.bots[bot_a], self.bots[bot_b]],
+                           self.maps[block % len(self.maps)], game_name)
+
+
+class OneVsAllSchedule(Schedule):
+    """
+    One bot plays against all bots on every map, repeatedly.
+    """
+
+    def __init__(self, one_bot: str, bots: List[str], maps: List[str], repeat_games: int,
+                 seed: int):
+        super(OneVsAllSchedule, self).__init__(bots, maps, repeat_games, seed)
+        self.one_bot = one_bot
+
+    def __len__(self) -> int:
+        return self.repeat_games * len(self.bots) * len(self.maps)
+
+    def game(self, position: int) -> PlayMessage:
+        other_bot = self.bots[(position // len(self.maps)) % len(self.bots)]
+        map_name = self.maps[position % len(self.maps)]
+        # random-looking prefix, which is the same when the game is produced again
+        game_name = "%08X" % (keyed_hash(self.seed, position) & 0xFFFFFFFF) + "_%06d" % position
+        return PlayMessage([self.one_bot, other_bot], map_name, game_name)
+
+    def fingerprint(self) -> str:
+        spec = json.dumps([super(OneVsAllSchedule, self).fingerprint(), self.one_bot])
+        return hashlib.sha1(spec.encode("utf-8")).hexdigest()
+
+
+def circle_rounds(n: int) -> List[List[Tuple[int, int]]]:
+    """
+    Round robin of n players by the circle method: every round is a set of disjoint pairs,
+    and every pair plays in exactly one round. With an odd number of players,
+    one of them sits out each round.
+    """
+    m = n + n % 2
+    rounds = []
+    for r in range(m - 1):
+        pairs = [(r, m - 1)]
+        for i in range(1, m // 2):
+            pairs.append(((r + i) % (m - 1), (r - i) % (m - 1)))
+        rounds.append([(a, b) for a, b in pairs if b < n and a < n])
+    return rounds
+
+
+class RoundRobinSchedule(Schedule):
+    """
+    All-vs-all games published in rounds of pairs that share no bot, for consumers
+    that play with read_overwrite and cannot run two games of one bot at once.
+
+    Consumers that play up to `workers` games at once, taking them in order, get
+    no conflicting games within a round. Where one round hands over to the next,
+    the pairs that share no bot with the last `workers - 1` games of the previous round
+    are put first, so that windows of `workers` consecutive games stay conflict-free
+    whenever the round has enough such pairs.
+
+    Bots are assigned to the circle and rounds are ordered by the seed. The order of one
+    map block is kept in memory, it is the same for every map and repetition.
+    """
+
+    def __init__(self, bots: List[str], maps: List[str], repeat_games: int, seed: int,
+                 workers: int):
+        super(RoundRobinSchedule, self).__init__(bots, maps, repeat_games, seed)
+        self.n_pairs = pair_count(len(self.bots))
+        max_workers = max(1, len(self.bots) // 2)
+        if workers > max_workers:
+            logger.warning(f"Only {max_workers} games of {len(self.bots)} bots can be "
+                           f"played at once, rounds are smaller than {workers} workers")
+        self.workers = max(1, min(workers, max_workers))
+        self._block: Optional[array] = None
+
+    def __len__(self) -> int:
+        return self.repeat_games * len(self.maps) * self.n_pairs
+
+    @property
+    def block(self) -> array:
+        """
+        Pair indices of all games on one map, in the order they are published.
+        """
+        if self._block is None:
+            # blocks follow each other, so the first round is ordered
+            # after the last round of the same order
+            _, tail = self.order_block([])
+            self._block, _ = self.order_block(tail)
+        return self._block
+
+    def order_block(self, tail: List[Tuple[int, int]]) -> Tuple[array, List[Tuple[int, int]]]:
+        """
+        :param tail: last games played before the block
+        :returns: the block and its last games
+        """
+        n = len(self.bots)
+        bot_of_slot = KeyedPermutation(n, self.seed)
+        rounds = circle_rounds(n)
+        round_order = KeyedPermutation(len(rounds), self.seed + 1)
+
+        block = array('I')
+        for r in range(len(rounds)):
+            pairs = [(bot_of_slot(a), bot_of_slot(b)) for a, b in rounds[round_order(r)]]
+            busy = {bot for pair in tail for bot in pair}
+            free = [pair for pair in pairs if busy.isdisjoint(pair)]
+            ordered = free + [pair for pair in pairs if not busy.isdisjoint(pair)]
+            block.extend(rank_pair(a, b, n) for a, b in ordered)
+            tail = ordered[len(ordered) - self.workers + 1:] if self.workers > 1 else []
+        return block, tail
+
+    def game(self, position: int) -> PlayMessage:
+        block, slot = divmod(position, self.n_pairs)
+        j = self.block[slot]
+        bot_a, bot_b = unrank_pair(j, len(self.bots))
+        game_name = "%06d" % (block * self.n_pairs + j)
+        return PlayMessage([self.bots[bot_a], self.bots[bot_b]],
+                           self.maps[block % len(self.maps)], game_name)
+
+    def fingerprint(self) -> str:
+        spec = json.dumps([super(RoundRobinSchedule, self).fingerprint(), self.workers])
+        return hashlib.sha1(spec.encode("utf-8")).hexdigest()
+
+
+class LongestFirstSchedule(Schedule):
+    """
+    Games of another schedule ordered by their predicted duration, longest first,
+    so that long games don't end up last while the other workers are idle.
+
+    Games of the same predicted duration keep the order of the other schedule.
+    The order is kept in memory.
+    """
+
+    def __init__(self, schedule: Schedule, predict: Callable[[PlayMessage], float]):
+        super(LongestFirstSchedule, self).__init__(schedule.bots, schedule.maps,
+                                                   schedule.repeat_games, schedule.seed)
+        self.schedule = schedule
+        # predicted durations by the position in the other schedule
+        self.durations = array('d', (predict(game) for game in schedule.games()))
+        self.order = array('I', sorted(range(len(schedule)),
+                                       key=lambda position: -self.durations[position]))
+
+    def __len__(self) -> int:
+        return len(self.schedule)
+
+    def game(self, position: int) -> PlayMessage:
+        return self.schedule.game(self.order[position])
+
+    def predicted_durations(self) -> Iterator[float]:
+        return (self.durations[position] for position in self.order)
+
+    def fingerprint(self) -> str:
+        # predictions change with new results, and with them the order
+        spec = json.dumps([self.schedule.fingerprint(),
+                           hashlib.sha1(self.order.tobytes()).hexdigest()])
+        return hashlib.sha1(spec.encode("utf-8")).hexdigest()
+
+
+def random_seed() -> int:
+    return random.SystemRandom().getrandbits(32)
+
+
+class Checkpoint:
+    """
+    Cursor of a producer into its shard of the schedule, saved in a json file.
+
+    The position counts games of the shard that the broker has confirmed,
+    so a restarted producer publishes the rest of the games exactly once.
+    """
+    path: str
+    fingerprint: Optional[str]
+    seed: Optional[int]
+    shard: int
+    shards: int
+    position: int
+
+    def __init__(self, path: str):
+        self.path = path
+        self.fingerprint = None
+        self.seed = None
+        self.shard = 0
+        self.shards = 1
+        self.position = 0
+
+    def load(self) -> bool:
+        """
+        :returns: if there was a checkpoint to resume from
+        """
+        if not os.path.exists(self.path):
+            return False
+        with open(self.path, "r") as f:
+            state = json.load(f)
+        self.fingerprint = state['fingerprint']
+        self.seed = state['seed']
+        self.shard = state['shard']
+        self.shards = state['shards']
+        self.position = state['position']
+        return True
+
+    def check(self, schedule: Schedule, shard: int, shards: int) -> None:
+        if self.fingerprint != schedule.fingerprint() \
+                or (self.shard, self.shards) != (shard, shards):
+            raise ScheduleException(
+                f"Checkpoint {self.path} belongs to a different schedule or shard, "
+                f"remove it to start the tournament again")
+
+    def save(self, schedule: Schedule, shard: int, shards: int, position: int) -> None:
+        self.fingerprint = schedule.fingerprint()
+        self.seed = schedule.seed
+        self.shard = shard
+        self.shards = shards
+        self.position = position
+
+        # replace the file at once, a producer may be killed at any moment
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(dict(fingerprint=self.fingerprint, seed=self.seed,
+                           shard=shard, shards=shards, position=position,
+                           total=schedule.shard_len(shard, shards)), f)
+        os.replace(tmp_path, self.path)
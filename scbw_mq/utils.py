@@ -1,3 +1,4 @@
+import os
 from typing import List
 
 
@@ -7,3 +8,13 @@ def read_lines(file) -> List[str]:
         lines = [line.rstrip('\n') for line in lines]
 
     return lines
+
+
+def pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
@@ -0,0 +1,194 @@
+import logging
+import os
+import selectors
+import time
+from subprocess import Popen, PIPE, DEVNULL
+from typing import Callable, Iterator, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# How often to service the connection (heartbeats etc.) while waiting.
+SERVICE_INTERVAL = 1.
+
+
+class Waiter(object):
+    """
+    Waits on a file descriptor that becomes readable when something has happened,
+    while servicing the connection regularly.
+    """
+
+    def __init__(self, fd: int):
+        self._fd = fd
+        self._selector = selectors.DefaultSelector()
+        self._selector.register(fd, selectors.EVENT_READ)
+
+    def fileno(self) -> int:
+        return self._fd
+
+    def on_readable(self) -> bool:
+        """
+        Consume the event, return True if it is the one we wait for.
+        """
+        raise NotImplemented
+
+    def wait(self, timeout: Optional[float] = None,
+             service: Optional[Callable[[], None]] = None) -> bool:
+        """
+        Block until the event happens or timeout (in seconds) expires.
+
+        :param service: called at least every SERVICE_INTERVAL seconds while waiting
+        :returns: True if the event happened
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            remaining = None if deadline is None else max(deadline - time.time(), 0)
+            interval = SERVICE_INTERVAL if remaining is None else min(SERVICE_INTERVAL, remaining)
+
+            ready = self._selector.select(interval) and self.on_readable()
+            if service is not None:
+                service()
+            if ready:
+                return True
+            if remaining is not None and remaining <= interval:
+                return False
+
+    def close(self):
+        self._selector.close()
+        os.close(self._fd)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def pidfd_supported() -> bool:
+    if not hasattr(os, "pidfd_open"):
+        return False
+    try:
+        os.close(os.pidfd_open(os.getpid()))
+        return True
+    except OSError:
+        return False
+
+
+PIDFD_SUPPORTED = pidfd_supported()
+
+
+class ProcessWaiter(Waiter):
+    """
+    Wakes up as soon as the child process exits.
+
+    Uses a pidfd where the platform supports it (Linux 5.3+, Python 3.9+),
+    otherwise a pipe that is inherited by the child and hits EOF once it exits.
+    """
+
+    def __init__(self, cmd: List[str], **popen_kwargs):
+        if PIDFD_SUPPORTED:
+            self.process = Popen(cmd, **popen_kwargs)
+            fd = os.pidfd_open(self.process.pid)
+        else:
+            fd, write_fd = os.pipe()
+            try:
+                self.process = Popen(cmd, pass_fds=(write_fd,), **popen_kwargs)
+            finally:
+                os.close(write_fd)
+
+        super(ProcessWaiter, self).__init__(fd)
+
+    def on_readable(self) -> bool:
+        return self.process.poll() is not None
+
+    def wait(self, timeout: Optional[float] = None,
+             service: Optional[Callable[[], None]] = None) -> bool:
+        if self.process.poll() is not None:
+            return True
+        return super(ProcessWaiter, self).wait(timeout, service)
+
+    @property
+    def returncode(self) -> Optional[int]:
+        return self.process.poll()
+
+
+class ProcessOutputWaiter(Waiter):
+    """
+    Reads the lines the child process writes to stdout as they come,
+    until the process closes it, usually when it exits.
+    """
+
+    def __init__(self, cmd: List[str], **popen_kwargs):
+        self.process = Popen(cmd, stdout=PIPE, **popen_kwargs)
+        self._buffer = b""
+        self._eof = False
+        super(ProcessOutputWaiter, self).__init__(self.process.stdout.fileno())
+
+    def on_readable(self) -> bool:
+        data = os.read(self._fd, 65536)
+        self._eof = not data
+        self._buffer += data
+        return True
+
+    def lines(self, service: Optional[Callable[[], None]] = None) -> Iterator[str]:
+        """
+        :param service: called at least every SERVICE_INTERVAL seconds while waiting
+        """
+        while not self._eof:
+            self.wait(service=service)
+            *lines, self._buffer = self._buffer.split(b"\n")
+            for line in lines:
+                yield line.decode("utf-8", "replace")
+        if self._buffer:
+            yield self._buffer.decode("utf-8", "replace")
+            self._buffer = b""
+        self.process.wait()
+
+    @property
+    def returncode(self) -> Optional[int]:
+        return self.process.poll()
+
+    def close(self):
+        self._selector.close()
+        self.process.stdout.close()
+
+
+class ContainerExitWatcher(Waiter):
+    """
+    Wakes up as soon as a container whose name starts with given prefix dies.
+
+    Follows `docker events`, so it should be created before the containers are started.
+    If the event stream is not available, waiting falls back to sleeping.
+    """
+
+    def __init__(self, name_prefix: str):
+        self.name_prefix = name_prefix
+        self.process = Popen(["docker", "events",
+                              "--filter", "type=container",
+                              "--filter", "event=die",
+                              "--format", "{{.Actor.Attributes.name}}"],
+                             stdout=PIPE, stderr=DEVNULL)
+        self._buffer = b""
+        self._eof = False
+        super(ContainerExitWatcher, self).__init__(self.process.stdout.fileno())
+
+    def on_readable(self) -> bool:
+        if self._eof:
+            time.sleep(SERVICE_INTERVAL)
+            return False
+
+        data = os.read(self._fd, 4096)
+        if not data:
+            logger.warning("Docker event stream has ended, falling back to sleeping")
+            self._eof = True
+            return False
+
+        self._buffer += data
+        *lines, self._buffer = self._buffer.split(b"\n")
+        return any(line.decode("utf-8").strip().startswith(self.name_prefix)
+                   for line in lines)
+
+    def close(self):
+        self.process.kill()
+        self.process.wait()
+        self._selector.close()
+        self.process.stdout.close()
@@ -40,8 +40,7 @@ setup(
                       'tqdm',
                       'scbw',
                       'pandas',
-                      'matplotlib',
-                      "elo"],
+                      'matplotlib'],
     extras_require={
     },
     packages=['scbw_mq',